@@ -0,0 +1,47 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+This script rebuilds and queries the catalog of the backups of a folder
+"""
+import logging
+import configargparse
+import sys
+from lib import catalog
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('catalog')
+
+
+def main(main_args):
+    """ Main function
+    """
+    parser = configargparse.ArgumentParser()
+    parser.add_argument("action", choices=['rescan', 'list', 'latest'],
+                        help=("rescan: rebuild the catalog from disk, list: show the backups,"
+                              " latest: show the most recent backup"))
+    parser.add_argument("backup_dir", help="Backup folder")
+    parser.add_argument("-d", "--database", help="Only backups of this database",
+                        default=None)
+    parser.add_argument("--full",
+                        help="rescan forgetting the database and reason of known backups",
+                        action='store_true', default=False)
+
+    args = parser.parse_args(main_args)
+    # backups copied into the folder by hand are cataloged before listing them
+    if args.action == 'rescan' or catalog.is_stale(args.backup_dir):
+        catalog.rescan(args.backup_dir, args.full)
+    if args.action == 'list':
+        for item in catalog.list_backups(args.backup_dir, args.database):
+            print '{created}  {size:>14}  {database:<30}  {name}'.format(**item)
+    elif args.action == 'latest':
+        latest = catalog.latest_backup(args.backup_dir, args.database)
+        if not latest:
+            logger.error("There are no backups in %s", args.backup_dir)
+            return 1
+        print latest
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
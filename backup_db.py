@@ -8,6 +8,8 @@ import logging
 import configargparse
 import sys
 from lib import utils
+from lib import metrics
+from lib import throttle
 from tempfile import gettempdir
 
 
@@ -34,14 +36,78 @@ def main(main_args):
                help='Config file path', is_config_file=True)
     parser.add("-t", "--temp_dir", help="Temp working dir",
                default=gettempdir())
-    parser.add("-b", "--backup_dir", help="Where to store backups",
+    parser.add("-b", "--backup_dir", help="Where to store backups, a folder or s3://bucket/prefix",
                default=".")
     parser.add("-r", "--reason",
                help="Reason why are  making this backup",
                default=False)
     parser.add("-F", "--format",
-               help="Compression format you wish (only bz2 and gz are supported)",
-               default='bz2')
+               help="Compression format you wish (bz2, gz, xz, zstd or lz4)",
+               choices=sorted(utils.COMPRESSION_FORMATS), default='bz2')
+    parser.add("-l", "--level", help="Compression level, format default if not set",
+               type=int, default=None)
+    parser.add("-s", "--stream",
+               help="Pipe pg_dump output straight into the backup file (no temp dump)",
+               action='store_true', default=False)
+    parser.add("-j", "--jobs",
+               help=("Number of processes (threads for xz and zstd) used to compress the backup"
+                     " and of pg_dump jobs for directory format"),
+               type=int, default=1)
+    parser.add("-D", "--dump_format",
+               help="pg_dump format (plain, custom or directory)",
+               choices=sorted(utils.DUMP_FORMATS), default='plain')
+    parser.add("-i", "--incremental",
+               help=("Store the filestore in a content addressed store inside the backup dir"
+                     " so only new attachments are written"),
+               action='store_true', default=False)
+    parser.add("-x", "--index",
+               help=("Save an index next to the backup so single files can be"
+                     " extracted with extract_backup.py"),
+               action='store_true', default=False)
+    parser.add("-S", "--snapshot",
+               help=("Make a snapshot folder: compressed dump plus the filestore as files"
+                     " hard-linked to the previous snapshot when they did not change"),
+               action='store_true', default=False)
+    parser.add("--delta",
+               help=("Store the plain dump as a zstd patch against the dump of the previous"
+                     " backup, the last dump is kept in the dump_bases folder of the backup dir"),
+               action='store_true', default=False)
+    parser.add("--full_every",
+               help="Backups in a delta chain, the full one included ({0} at most)".format(
+                   utils.DELTA_MAX_CHAIN),
+               type=int, default=7)
+    parser.add("--delta_max_size",
+               help=("MB of the biggest dump stored as a delta, bigger ones are backed up"
+                     " full ({0} at most)").format(utils.DELTA_MAX_SIZE // 2 ** 20),
+               type=int, default=utils.DELTA_MAX_SIZE // 2 ** 20)
+    parser.add("--profile",
+               help=("Dump the schema but not the data of the log-like tables of this profile"
+                     " (logs, test) or Json file"),
+               default=None)
+    parser.add("--read_limit", help="Max MB per second read while compressing",
+               type=float, default=None)
+    parser.add("--write_limit", help="Max MB per second written into the backup",
+               type=float, default=None)
+    parser.add("--nice", help="Niceness of the backup, pg_dump and compressors included",
+               type=int, default=None)
+    parser.add("--ionice_class",
+               help="ionice class of the backup: 1 realtime, 2 best-effort, 3 idle",
+               type=int, choices=[1, 2, 3], default=None)
+    parser.add("--ionice_level", help="ionice priority for best-effort class (0-7)",
+               type=int, choices=range(8), default=None)
+    parser.add("--max_load",
+               help="Pause the backup while the load average per cpu is higher",
+               type=float, default=None)
+    parser.add("--max_connections",
+               help="Pause the backup while postgres has more active connections",
+               type=int, default=None)
+    parser.add("--check_interval", help="Seconds between load checks",
+               type=int, default=10)
+    parser.add("--metrics_json", help="Json file where the stage timings are saved",
+               default=False)
+    parser.add("--metrics_prom",
+               help="Prometheus textfile collector file where the stage timings are saved",
+               default=False)
 
     args = parser.parse_args(main_args)
     utils.check_installation()
@@ -50,8 +116,20 @@ def main(main_args):
     elif args.from_docker:
         odoo_cfg = utils.parse_docker_config(args.from_docker)
     odoo_cfg.update({'database': args.database})
-    utils.backup_database_direct(odoo_cfg, args.backup_dir,
-                                 reason=args.reason, cformat=args.format)
+    throttle.set_priority(args.nice, args.ionice_class, args.ionice_level)
+    limits = throttle.build_throttle(args.read_limit, args.write_limit, args.max_load,
+                                     args.max_connections, odoo_cfg, args.check_interval)
+    metrics.start_run('backup', database=args.database)
+    res = utils.backup_database_direct(odoo_cfg, args.backup_dir,
+                                       reason=args.reason, cformat=args.format,
+                                       stream=args.stream, jobs=args.jobs,
+                                       level=args.level, dump_format=args.dump_format,
+                                       incremental=args.incremental, index=args.index,
+                                       throttle=limits, snapshot=args.snapshot,
+                                       delta=args.delta, full_every=args.full_every,
+                                       profile=args.profile,
+                                       delta_max_size=args.delta_max_size * 2 ** 20)
+    metrics.save_run(metrics.finish_run(res), args.metrics_json, args.metrics_prom)
     #utils.pase_odoo_configfile('config.conf')
 
 
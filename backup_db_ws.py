@@ -7,6 +7,8 @@ import logging
 import configargparse
 import sys
 from lib import utils
+from lib import metrics
+from lib import throttle
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -21,7 +23,8 @@ def main(main_args):
                         default=False)
     parser.add_argument("-t", "--temp_dir", help="Temp working dir",
                         default="/tmp")
-    parser.add_argument("-d", "--backup_dir", help="Where to store backups",
+    parser.add_argument("-d", "--backup_dir",
+                        help="Where to store backups, a folder or s3://bucket/prefix",
                         default=".")
     parser.add_argument("-r", "--reason",
                         help="Reason why are  making this backup",
@@ -34,6 +37,40 @@ def main(main_args):
                         help="Odoo super user", default="admin")
     parser.add_argument("-w", "--password", help="Odoo super user pass",
                         default="admin")
+    parser.add_argument("-j", "--jobs",
+                        help="Number of processes used to compress the backup",
+                        type=int, default=1)
+    parser.add_argument("-F", "--format",
+                        help="Compression format you wish (bz2, gz, xz, zstd or lz4)",
+                        choices=sorted(utils.COMPRESSION_FORMATS), default='bz2')
+    parser.add_argument("-l", "--level",
+                        help="Compression level, format default if not set",
+                        type=int, default=None)
+    parser.add_argument("-s", "--stream",
+                        help=("Store the zip of the database manager as it is instead of"
+                              " its members"),
+                        action='store_true', default=False)
+    parser.add_argument("--read_limit", help="Max MB per second read while compressing",
+                        type=float, default=None)
+    parser.add_argument("--write_limit", help="Max MB per second written into the backup",
+                        type=float, default=None)
+    parser.add_argument("--nice", help="Niceness of the backup, pg_dump and compressors included",
+                        type=int, default=None)
+    parser.add_argument("--ionice_class",
+                        help="ionice class of the backup: 1 realtime, 2 best-effort, 3 idle",
+                        type=int, choices=[1, 2, 3], default=None)
+    parser.add_argument("--ionice_level", help="ionice priority for best-effort class (0-7)",
+                        type=int, choices=range(8), default=None)
+    parser.add_argument("--max_load",
+                        help="Pause the backup while the load average per cpu is higher",
+                        type=float, default=None)
+    parser.add_argument("--check_interval", help="Seconds between load checks",
+                        type=int, default=10)
+    parser.add_argument("--metrics_json", help="Json file where the stage timings are saved",
+                        default=False)
+    parser.add_argument("--metrics_prom",
+                        help="Prometheus textfile collector file where the stage timings are saved",
+                        default=False)
 
     args = parser.parse_args(main_args)
     db_list = [x.strip() for x in args.dbs.split(',')]
@@ -41,9 +78,15 @@ def main(main_args):
                                  args.user, args.password,
                                  only_connection=True):
         return 1
+    throttle.set_priority(args.nice, args.ionice_class, args.ionice_level)
+    limits = throttle.build_throttle(args.read_limit, args.write_limit, args.max_load,
+                                     check_interval=args.check_interval)
+    metrics.start_run('backup', database=','.join(db_list))
     utils.backup_databases(db_list, args.backup_dir, args.user,
                            args.password, args.host, args.port,
-                           args.reason, args.temp_dir)
+                           args.reason, args.temp_dir, args.jobs,
+                           args.format, args.level, args.stream, limits)
+    metrics.save_run(metrics.finish_run(), args.metrics_json, args.metrics_prom)
 
 
 if __name__ == '__main__':
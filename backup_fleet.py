@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+This script backs up many databases from many Odoo instances or docker containers
+at the same time using an inventory file
+"""
+import logging
+import configargparse
+import sys
+from lib import utils
+from lib import fleet
+from lib import metrics
+
+logging.basicConfig(level=logging.DEBUG,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('backup')
+
+
+def main(main_args):
+    """ Main function
+    """
+    parser = configargparse.ArgParser()
+    parser.add("-i", "--inventory", help="Json file with the databases to backup",
+               required=True)
+    parser.add('-c', '--config_file',
+               help='Config file path', is_config_file=True)
+    parser.add("-w", "--workers", help="Number of backups running at the same time",
+               type=int, default=4)
+    parser.add("--host_limit",
+               help="Max number of backups running against the same postgres server",
+               type=int, default=2)
+    parser.add("--disk_limit",
+               help="Max number of backups writing into the same disk",
+               type=int, default=2)
+    parser.add("-s", "--state_file",
+               help="Json file with the last successful backup of every database",
+               default=False)
+    parser.add("-R", "--report", help="Json file where the result of every job is saved",
+               default=False)
+    parser.add("--metrics_json", help="Json file where the stage timings are saved",
+               default=False)
+    parser.add("--metrics_prom",
+               help="Prometheus textfile collector file where the stage timings are saved",
+               default=False)
+
+    args = parser.parse_args(main_args)
+    utils.check_installation()
+    jobs = fleet.load_inventory(args.inventory)
+    results = fleet.backup_fleet(jobs, args.state_file, args.workers,
+                                 args.host_limit, args.disk_limit)
+    if args.report:
+        utils.save_json(results, args.report)
+    runs = [res['metrics'] for res in results if res.get('metrics')]
+    if args.metrics_json:
+        metrics.save_runs_json(runs, args.metrics_json)
+    if args.metrics_prom:
+        metrics.save_runs_prometheus(runs, args.metrics_prom)
+    failed = [res for res in results if res['status'] != 'ok']
+    for res in failed:
+        logger.error("Backup of %s failed: %s", res['key'], res['error'])
+    logger.info("%s backups done, %s failed", len(results) - len(failed), len(failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    logger.info("Starting backup process")
+    sys.exit(main(sys.argv[1:]))
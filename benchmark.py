@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+This script benchmarks the backup and restore code paths with a synthetic
+database and filestore, so the results of different commits can be compared
+"""
+import os
+import sys
+import logging
+import configargparse
+from tempfile import gettempdir
+from lib import utils
+from lib import benchmark
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('benchmark')
+
+
+def main(main_args):
+    """ Main function
+    """
+    parser = configargparse.ArgParser()
+    parser.add("cases", nargs='*', help="Cases to run ({0}), all by default".format(
+        ', '.join(benchmark.BENCHMARK_CASES)), default=benchmark.BENCHMARK_CASES)
+    parser.add('-c', '--config_file',
+               help='Config file path', is_config_file=True)
+    parser.add("--dump_size", help="Size of the synthetic sql dump in MB",
+               type=int, default=200)
+    parser.add("--files", help="Number of files of the synthetic filestore",
+               type=int, default=2000)
+    parser.add("--file_size", help="Mean size of the filestore files in KB",
+               type=int, default=100)
+    parser.add("--distribution", help="Size distribution of the filestore files",
+               choices=benchmark.SIZE_DISTRIBUTIONS, default='lognormal')
+    parser.add("--text_ratio", help="Fraction of compressible filestore files",
+               type=float, default=0.2)
+    parser.add("--seed", help="Seed of the synthetic data", type=int, default=0)
+    parser.add("-F", "--format", help="Compression format",
+               choices=sorted(utils.COMPRESSION_FORMATS), default='bz2')
+    parser.add("-l", "--level", help="Compression level, format default if not set",
+               type=int, default=None)
+    parser.add("-j", "--jobs", help="Number of compression and pg_restore jobs",
+               type=int, default=1)
+    parser.add("-s", "--stream", help="Stream pg_dump output in backup_direct",
+               action='store_true', default=False)
+    parser.add("-n", "--repeat", help="Runs per case, the median is reported",
+               type=int, default=3)
+    parser.add("--data_dir", help="Where the synthetic data sets are kept between runs",
+               default=os.path.join(gettempdir(), 'backupws_bench_data'))
+    parser.add("-t", "--temp_dir", help="Work dir, the temp disk usage is measured there",
+               default=gettempdir())
+    parser.add("-o", "--output", help="Json file where the results are saved",
+               default=False)
+    parser.add("-B", "--baseline", help="Json results of another commit to compare with",
+               default=False)
+    parser.add("--threshold", help="Percent slower or bigger than the baseline that is a "
+               "regression", type=float, default=10.0)
+
+    args = parser.parse_args(main_args)
+    for case in args.cases:
+        if case not in benchmark.BENCHMARK_CASES:
+            parser.error('Unknown case {0}'.format(case))
+    params = {
+        'dump_size': args.dump_size * 1000000,
+        'files': args.files,
+        'file_size': args.file_size * 1000,
+        'distribution': args.distribution,
+        'text_ratio': args.text_ratio,
+        'seed': args.seed,
+    }
+    options = {'cformat': args.format, 'level': args.level, 'jobs': args.jobs,
+               'stream': args.stream}
+    work_root = os.path.join(args.temp_dir, 'backupws_bench_{0}'.format(os.getpid()))
+    os.makedirs(work_root)
+    try:
+        res = benchmark.run_benchmark(args.cases, params, options, args.data_dir,
+                                      work_root, args.repeat)
+    finally:
+        utils.clean_files(work_root)
+    print '{0:<16}{1:>10}{2:>10}{3:>12}{4:>12}'.format(
+        'case', 'seconds', 'MB/s', 'peak RSS MB', 'peak tmp MB')
+    for case in res['results']:
+        if case['error']:
+            print '{0:<16} failed: {1}'.format(case['case'], case['error'])
+            continue
+        print '{case:<16}{seconds:>10}{mb_per_second:>10}{peak_rss_mb:>12}{peak_tmp_mb:>12}' \
+            .format(**case)
+    if args.output:
+        utils.save_json(res, args.output)
+    failed = [case for case in res['results'] if case['error']]
+    if not args.baseline:
+        return 1 if failed else 0
+    baseline = utils.load_json(args.baseline)
+    regressions = 0
+    print '\nCompared with {0} ({1})'.format(baseline.get('commit'), args.baseline)
+    for case, key, before, after, change, regressed in benchmark.compare_results(
+            res, baseline, args.threshold):
+        print '{0:<16}{1:<14}{2:>10}{3:>10}{4:>+9}%{5}'.format(
+            case, key, before, after, change, '  REGRESSION' if regressed else '')
+        regressions += regressed
+    return 1 if failed or regressions else 0
+
+
+if __name__ == '__main__':
+    logger.info("Starting benchmark")
+    sys.exit(main(sys.argv[1:]))
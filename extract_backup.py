@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+This script extracts some files (the dump, the filestore or a single attachment)
+from a backup made with the index option without decompressing the whole backup
+"""
+import logging
+import configargparse
+import sys
+from lib import utils
+
+logging.basicConfig(level=logging.DEBUG,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('extract')
+
+
+def main(main_args):
+    """ Main function
+    """
+    parser = configargparse.ArgumentParser()
+    parser.add_argument("backup", help="Backup file, its .idx file must be next to it")
+    parser.add_argument("members", nargs='*',
+                        help=("Files or folders to extract relative to the backup folder"
+                              " (ie: database_dump.sql, filestore, filestore/ab/abcd...),"
+                              " everything if not set"))
+    parser.add_argument("-d", "--dest_dir", help="Where to extract the files",
+                        default=".")
+
+    args = parser.parse_args(main_args)
+    extracted = utils.extract_indexed(args.backup, args.dest_dir, args.members)
+    if not extracted:
+        logger.error("Nothing found to extract")
+        return 1
+    logger.info("%s files extracted", len(extracted))
+    return 0
+
+
+if __name__ == '__main__':
+    logger.info("Starting extraction process")
+    sys.exit(main(sys.argv[1:]))
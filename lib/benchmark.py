@@ -0,0 +1,464 @@
+"""
+Benchmark of the backup and restore code paths with synthetic databases and
+filestores, postgres client tools are replaced by stand-ins that read and write
+a pre-generated dump, so the results only depend on this code, the compressors
+and the disk.
+"""
+import os
+import sys
+import json
+import time
+import stat
+import base64
+import random
+import shutil
+import socket
+import hashlib
+import logging
+import platform
+import resource
+import threading
+import subprocess
+import multiprocessing
+from lib import utils
+from lib import metrics
+
+logger = logging.getLogger('benchmark')
+
+# Stand-in for pg_dump, pg_restore, psql, createdb and dropdb, the tool is chosen
+# by the name it is called with
+FAKE_PG_TOOL = '''#!{python}
+import os
+import sys
+import shutil
+
+DUMP = os.environ['BACKUPWS_BENCH_DUMP']
+tool = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+
+
+def drain(fin):
+    while fin.read(1024 * 1024):
+        pass
+
+if tool == 'pg_dump':
+    if '-f' in args:
+        dest = args[args.index('-f') + 1]
+        if '-Fd' in args:
+            os.mkdir(dest)
+            dest = os.path.join(dest, 'toc.dat')
+        shutil.copyfile(DUMP, dest)
+    else:
+        with open(DUMP, 'rb') as fin:
+            shutil.copyfileobj(fin, sys.stdout, 1024 * 1024)
+elif tool == 'psql' and '-c' in args:
+    sys.stdout.write('8.0.1.3\\n')
+elif tool == 'psql' and '-f' in args:
+    with open(args[args.index('-f') + 1], 'rb') as fin:
+        drain(fin)
+elif tool == 'psql':
+    drain(sys.stdin)
+elif tool == 'pg_restore':
+    path = args[-1]
+    if os.path.isdir(path):
+        path = os.path.join(path, 'toc.dat')
+    with open(path, 'rb') as fin:
+        drain(fin)
+'''
+FAKE_PG_TOOLS = ['pg_dump', 'pg_restore', 'psql', 'createdb', 'dropdb']
+
+# Words used to build the rows of the synthetic dump and the text attachments
+WORDS = ['account', 'move', 'line', 'partner', 'product', 'sale', 'order', 'stock',
+         'picking', 'invoice', 'journal', 'tax', 'company', 'currency', 'draft',
+         'posted', 'cancel', 'done', 'True', 'False', '\\N', 'res', 'users', 'mail',
+         'message', 'followers', 'ir', 'attachment', 'model', 'data']
+
+SIZE_DISTRIBUTIONS = ['fixed', 'uniform', 'lognormal']
+
+BENCHMARK_CASES = ['compress', 'decompress', 'decode_b64', 'backup_direct', 'restore_direct']
+
+DATABASE_NAME = 'bench'
+
+
+def random_bytes(seed, size):
+    """ Deterministic incompressible bytes, like the pdfs and images of a filestore
+    """
+    res = []
+    counter = 0
+    while size > 0:
+        block = hashlib.sha512('{0}:{1}'.format(seed, counter)).digest()
+        res.append(block[:size])
+        size -= len(block)
+        counter += 1
+    return ''.join(res)
+
+
+def text_bytes(rand, size):
+    """ Deterministic compressible text made of WORDS and numbers
+    """
+    res = []
+    length = 0
+    while length < size:
+        line = '\t'.join([str(rand.randint(1, 10 ** 6))] +
+                         [rand.choice(WORDS) for _ in range(rand.randint(3, 12))]) + '\n'
+        res.append(line)
+        length += len(line)
+    return ''.join(res)[:size]
+
+
+def make_dump(filename, size, seed=0):
+    """ Write a synthetic sql dump of about size bytes made of COPY blocks
+
+    Args:
+        filename (str): Dump file name
+        size (int): Size in bytes
+        seed (int): Seed of the generated data
+    Returns:
+        The file name
+    """
+    rand = random.Random(seed)
+    written = 0
+    table = 0
+    with open(filename, 'wb') as fout:
+        while written < size:
+            rows = text_bytes(rand, min(4 * 1024 * 1024, size - written))
+            block = 'COPY public.table_{0} (id, name, state) FROM stdin;\n{1}\\.\n\n'.format(
+                table, rows)
+            fout.write(block)
+            written += len(block)
+            table += 1
+    return filename
+
+
+def file_sizes(count, mean_size, distribution, rand):
+    """ Sizes of the files of a synthetic filestore
+
+    Args:
+        count (int): Number of files
+        mean_size (int): Mean size in bytes
+        distribution (str): One of SIZE_DISTRIBUTIONS
+        rand (Random): Random generator
+    Returns:
+        List of sizes
+    """
+    if distribution == 'fixed':
+        return [mean_size] * count
+    if distribution == 'uniform':
+        return [rand.randint(0, 2 * mean_size) for _ in range(count)]
+    if distribution == 'lognormal':
+        # sigma 1.5 gives the long tail of real filestores: many small files, a few
+        # big ones, scaled so the mean is mean_size
+        sigma = 1.5
+        return [int(rand.lognormvariate(0, sigma) * mean_size / (2.718281828 ** (sigma ** 2 / 2)))
+                for _ in range(count)]
+    raise RuntimeError('Unknown size distribution: {0}'.format(distribution))
+
+
+def make_filestore(folder, count, mean_size, distribution='lognormal', text_ratio=0.2, seed=0):
+    """ Write a synthetic filestore with the same layout of Odoo (sha1[:2]/sha1)
+
+    Args:
+        folder (str): Filestore folder
+        count (int): Number of files
+        mean_size (int): Mean file size in bytes
+        distribution (str): One of SIZE_DISTRIBUTIONS
+        text_ratio (float): Fraction of compressible text files, the rest are random bytes
+        seed (int): Seed of the generated data
+    Returns:
+        The total size in bytes
+    """
+    rand = random.Random(seed)
+    total = 0
+    for number, size in enumerate(file_sizes(count, mean_size, distribution, rand)):
+        if rand.random() < text_ratio:
+            data = text_bytes(rand, size)
+        else:
+            data = random_bytes('{0}:{1}'.format(seed, number), size)
+        sha1 = hashlib.sha1(data).hexdigest()
+        subfolder = os.path.join(folder, sha1[:2])
+        if not os.path.isdir(subfolder):
+            os.makedirs(subfolder)
+        with open(os.path.join(subfolder, sha1), 'wb') as fout:
+            fout.write(data)
+        total += size
+    return total
+
+
+def install_fake_pg_tools(bin_dir):
+    """ Write the postgres client tools stand-ins into bin_dir
+
+    Returns:
+        bin_dir
+    """
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    for tool in FAKE_PG_TOOLS:
+        tool_name = os.path.join(bin_dir, tool)
+        with open(tool_name, 'w') as fout:
+            fout.write(FAKE_PG_TOOL.format(python=sys.executable))
+        os.chmod(tool_name, os.stat(tool_name).st_mode | stat.S_IXUSR | stat.S_IXGRP)
+    return bin_dir
+
+
+def prepare_data(data_dir, params):
+    """ Generate the synthetic dump, b64 dump and filestore of params, they are kept in
+        a folder named after the parameters so runs with the same parameters reuse them
+
+    Args:
+        data_dir (str): Folder where the data sets are kept
+        params (dict): dump_size, files, file_size, distribution, text_ratio and seed
+    Returns:
+        dict with the dump, b64, filestore and bin_dir paths
+    """
+    key = hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()[:12]
+    folder = os.path.join(data_dir, key)
+    data = {
+        'dump': os.path.join(folder, 'database_dump.sql'),
+        'b64': os.path.join(folder, 'database_dump.b64'),
+        'filestore': os.path.join(folder, 'filestore'),
+        'bin_dir': os.path.join(folder, 'bin'),
+    }
+    done = os.path.join(folder, 'params.json')
+    if os.path.exists(done):
+        return data
+    logger.info('Generating data set %s: %s', key, params)
+    clean = [folder] if os.path.exists(folder) else []
+    utils.clean_files(clean)
+    os.makedirs(data['filestore'])
+    make_dump(data['dump'], params['dump_size'], params['seed'])
+    with open(data['dump'], 'rb') as fin:
+        with open(data['b64'], 'w') as fout:
+            base64.encode(fin, fout)
+    make_filestore(data['filestore'], params['files'], params['file_size'],
+                   params['distribution'], params['text_ratio'], params['seed'])
+    install_fake_pg_tools(data['bin_dir'])
+    utils.save_json(params, done)
+    return data
+
+
+class DiskSampler(threading.Thread):
+    """ Poll the size of a folder and keep the biggest one
+    """
+
+    def __init__(self, folder, interval=0.05):
+        super(DiskSampler, self).__init__()
+        self.daemon = True
+        self.folder = folder
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.peak = max(self.peak, metrics.path_size(self.folder))
+            except OSError:
+                # files removed while walking
+                pass
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, metrics.path_size(self.folder))
+        return self.peak
+
+
+def odoo_config(data_dir):
+    return {'database': DATABASE_NAME, 'db_host': 'localhost', 'db_port': 5432,
+            'db_user': 'odoo', 'db_password': 'False', 'data_dir': data_dir}
+
+
+def setup_case(case, data, work_dir, options):
+    """ Prepare the input of a case inside work_dir
+
+    Returns:
+        A function without arguments that runs the case and returns its output path
+        and the number of bytes it processes
+    """
+    tmp_dir = os.path.join(work_dir, 'tmp')
+    out_dir = os.path.join(work_dir, 'out')
+    os.makedirs(tmp_dir)
+    os.makedirs(out_dir)
+    files = [(data['dump'], 'database_dump.sql'), (data['filestore'], 'filestore')]
+    size = metrics.path_size(data['dump']) + metrics.path_size(data['filestore'])
+
+    def archive():
+        return utils.compress_files('bench', files, dest_folder=work_dir,
+                                    cformat=options['cformat'], jobs=options['jobs'],
+                                    level=options['level'])
+
+    if case == 'compress':
+        return lambda: utils.compress_files('bench', files, dest_folder=out_dir,
+                                            cformat=options['cformat'], jobs=options['jobs'],
+                                            level=options['level']), size
+    if case == 'decompress':
+        name = archive()
+        return lambda: utils.decompress_files(name, tmp_dir), size
+    if case == 'decode_b64':
+        dst = os.path.join(tmp_dir, 'backup.zip')
+        return lambda: utils.decode_b64_file(data['b64'], dst) or dst, \
+            os.path.getsize(data['b64'])
+    instance_dir = os.path.join(work_dir, 'instance')
+    os.makedirs(os.path.join(instance_dir, 'filestore'))
+    if case == 'backup_direct':
+        shutil.copytree(data['filestore'],
+                        os.path.join(instance_dir, 'filestore', DATABASE_NAME))
+        return lambda: utils.backup_database_direct(
+            odoo_config(instance_dir), out_dir, tmp_dir=tmp_dir, cformat=options['cformat'],
+            stream=options['stream'], jobs=options['jobs'], level=options['level']), size
+    if case == 'restore_direct':
+        name = archive()
+        return lambda: utils.restore_direct(name, odoo_config(instance_dir), tmp_dir,
+                                            options['jobs']) and instance_dir, size
+    raise RuntimeError('Unknown benchmark case: {0}'.format(case))
+
+
+def _run_case(case, data, work_dir, options, queue):
+    """ Run a case in a child process so its peak RSS is not mixed with the other cases
+    """
+    try:
+        os.environ['BACKUPWS_BENCH_DUMP'] = data['dump']
+        os.environ['PATH'] = data['bin_dir'] + os.pathsep + os.environ.get('PATH', '')
+        func, size = setup_case(case, data, work_dir, options)
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        sampler = DiskSampler(os.path.join(work_dir, 'tmp'))
+        sampler.start()
+        metrics.start_run('benchmark', case=case)
+        start = time.time()
+        output = func()
+        seconds = time.time() - start
+        run = metrics.finish_run(output)
+        peak_tmp = sampler.stop()
+        queue.put({
+            'seconds': seconds,
+            'bytes': size,
+            'output_bytes': metrics.path_size(output),
+            # ru_maxrss is in KB on Linux
+            'peak_rss_mb': round(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                     resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+                                 / 1024.0, 1),
+            'start_rss_mb': round(start_rss / 1024.0, 1),
+            'peak_tmp_mb': round(peak_tmp / 1000000.0, 1),
+            'stages': run.stages,
+            'error': None if output else 'The case returned no output',
+        })
+    except Exception as error:
+        logger.exception('Case %s failed', case)
+        queue.put({'error': str(error)})
+
+
+def run_case(case, data, work_root, options, repeat=3):
+    """ Run a case repeat times, every time in a new process and work folder
+
+    Args:
+        case (str): One of BENCHMARK_CASES
+        data (dict): Data set as returned by prepare_data
+        work_root (str): Folder where the work folders are created
+        options (dict): cformat, jobs, level and stream
+        repeat (int): Number of runs
+    Returns:
+        dict with the median seconds and throughput and the max peak RSS and temp disk
+    """
+    runs = []
+    for number in range(repeat):
+        work_dir = os.path.join(work_root, '{0}_{1}'.format(case, number))
+        utils.clean_files([work_dir] if os.path.exists(work_dir) else [])
+        os.makedirs(work_dir)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_case,
+                                          args=(case, data, work_dir, options, queue))
+        process.start()
+        res = queue.get()
+        process.join()
+        utils.clean_files(work_dir)
+        if res['error']:
+            return {'case': case, 'error': res['error']}
+        runs.append(res)
+    runs.sort(key=lambda res: res['seconds'])
+    median = runs[len(runs) // 2]
+    return {
+        'case': case,
+        'seconds': round(median['seconds'], 3),
+        'mb_per_second': round(median['bytes'] / 1000000.0 / median['seconds'], 2)
+        if median['seconds'] else 0,
+        'input_mb': round(median['bytes'] / 1000000.0, 1),
+        'output_mb': round(median['output_bytes'] / 1000000.0, 1),
+        'peak_rss_mb': max(res['peak_rss_mb'] for res in runs),
+        'peak_tmp_mb': max(res['peak_tmp_mb'] for res in runs),
+        'stages': median['stages'],
+        'runs': [round(res['seconds'], 3) for res in runs],
+        'error': None,
+    }
+
+
+def git_commit():
+    """ Commit of the working copy, so results of different commits can be told apart
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(cases, params, options, data_dir, work_root, repeat=3):
+    """ Run the benchmark cases
+
+    Args:
+        cases (list): Cases to run, from BENCHMARK_CASES
+        params (dict): Data set parameters (see prepare_data)
+        options (dict): cformat, jobs, level and stream
+        data_dir (str): Folder where data sets are kept between runs
+        work_root (str): Folder where cases write, its disk is the one measured
+        repeat (int): Runs per case
+    Returns:
+        dict with the environment, the parameters and the result of every case
+    """
+    data = prepare_data(data_dir, params)
+    results = []
+    for case in cases:
+        logger.info('Running %s', case)
+        res = run_case(case, data, work_root, options, repeat)
+        logger.info('%s: %s', case, dict((key, value) for key, value in res.items()
+                                         if key not in ('stages', 'runs')))
+        results.append(res)
+    return {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'cpus': multiprocessing.cpu_count(),
+        'params': params,
+        'options': options,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare_results(current, baseline, threshold=10.0):
+    """ Compare two benchmark results, a case regresses if it is slower, uses more
+        memory or more temp disk than threshold percent of the baseline
+
+    Args:
+        current (dict): Result of run_benchmark
+        baseline (dict): Result of run_benchmark of the reference commit
+        threshold (float): Tolerance percent
+    Returns:
+        List of (case, metric, baseline value, current value, change percent, regressed)
+    """
+    if current['params'] != baseline['params'] or current['options'] != baseline['options']:
+        logger.warn('Baseline was run with other parameters, results are not comparable')
+    base_cases = dict((res['case'], res) for res in baseline['results'] if not res['error'])
+    res = []
+    for case in current['results']:
+        base = base_cases.get(case['case'])
+        if not base or case['error']:
+            continue
+        for key in ['seconds', 'peak_rss_mb', 'peak_tmp_mb']:
+            change = (case[key] - base[key]) * 100.0 / base[key] if base[key] else 0
+            res.append((case['case'], key, base[key], case[key], round(change, 1),
+                        change > threshold))
+    return res
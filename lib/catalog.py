@@ -0,0 +1,223 @@
+"""
+Catalog of the backups of a folder, a SQLite database kept next to the backups
+that is updated every time a backup is written, so the latest backup of a
+database is found without listing the folder.
+"""
+import os
+import re
+import time
+import logging
+import sqlite3
+import datetime
+from lib import metrics
+
+logger = logging.getLogger('catalog')
+
+CATALOG_NAME = 'backups.sqlite'
+
+# Information file of the snapshot backups, which are folders instead of archives
+SNAPSHOT_NAME = 'snapshot.json'
+
+# database_name[_reason]_YYYYmmdd_HHMMSS.tar.<ext> as made by utils.generate_backup_name,
+# without extension for the snapshot folders
+BACKUP_NAME_RE = re.compile(
+    r'^(?P<prefix>.+)_(?P<date>\d{8}_\d{6})(?:\.tar\.(?P<ext>\w+))?$')
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS backups (
+        name TEXT PRIMARY KEY,
+        database TEXT NOT NULL,
+        reason TEXT,
+        created TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        extension TEXT,
+        recorded REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS backups_created ON backups (created)',
+    'CREATE INDEX IF NOT EXISTS backups_database_created ON backups (database, created)',
+]
+
+
+def connect(folder):
+    """ Open the catalog of a folder, creating it if it does not exist
+
+    Args:
+        folder (str): Backup folder
+    Returns:
+        sqlite3 connection
+    """
+    # the timeout lets concurrent backups into the same folder wait for the lock
+    conn = sqlite3.connect(os.path.join(folder, CATALOG_NAME), timeout=60)
+    # the journal is kept between transactions, creating and deleting it would change
+    # the mtime of the folder that is_stale compares with
+    conn.execute('PRAGMA journal_mode=PERSIST')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def parse_backup_name(fname):
+    """ Get the prefix (database and reason), date and extension of a backup file name
+
+    Args:
+        fname (str): Backup file name
+    Returns:
+        dict with prefix, created (YYYY-mm-dd HH:MM:SS) and extension (None for snapshot
+        folders) or None if it is not a backup name
+    """
+    match = BACKUP_NAME_RE.match(os.path.basename(fname))
+    if not match:
+        return None
+    try:
+        created = datetime.datetime.strptime(match.group('date'), '%Y%m%d_%H%M%S')
+    except ValueError:
+        return None
+    return {'prefix': match.group('prefix'),
+            'created': created.strftime('%Y-%m-%d %H:%M:%S'),
+            'extension': match.group('ext')}
+
+
+def is_backup(full_name):
+    """ Whether a path is a backup archive or a snapshot backup folder
+
+    Args:
+        full_name (str): Full path to check
+    Returns:
+        True if it has a backup name and is an archive file, or a folder with SNAPSHOT_NAME
+    """
+    info = parse_backup_name(full_name)
+    if not info:
+        return False
+    if info['extension']:
+        return os.path.isfile(full_name)
+    return os.path.isfile(os.path.join(full_name, SNAPSHOT_NAME))
+
+
+def _upsert(conn, full_name, database=None, reason=None):
+    if not is_backup(full_name):
+        logger.warn('%s is not a backup, not added to the catalog', full_name)
+        return False
+    info = parse_backup_name(full_name)
+    conn.execute('INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?, ?)', (
+        os.path.basename(full_name), database or info['prefix'], reason or None,
+        info['created'], metrics.path_size(full_name), info['extension'], time.time()))
+    return True
+
+
+def record_backup(full_name, database=None, reason=None):
+    """ Add a backup just written to the catalog of its folder
+
+    Args:
+        full_name (str): Full path to the backup archive or snapshot folder
+        database (str): Database name, taken from the file name if not given
+        reason (str): Reason of the backup
+    Returns:
+        True if it was added, a catalog error never makes the backup fail
+    """
+    try:
+        conn = connect(os.path.dirname(os.path.abspath(full_name)))
+        try:
+            with conn:
+                return _upsert(conn, full_name, database, reason)
+        finally:
+            conn.close()
+    except sqlite3.Error as error:
+        logger.error('Could not add %s to the catalog: %s', full_name, error)
+        return False
+
+
+def is_stale(folder):
+    """ Whether the catalog of a folder may miss backups: it does not exist or the folder
+        changed after the newest backup was recorded, e.g. because backups were copied or
+        rsynced into it by hand
+
+    Args:
+        folder (str): Backup folder
+    Returns:
+        True if the catalog should be rebuilt with rescan
+    """
+    if not os.path.exists(os.path.join(folder, CATALOG_NAME)):
+        return True
+    conn = connect(folder)
+    try:
+        recorded = conn.execute('SELECT MAX(recorded) FROM backups').fetchone()[0]
+    finally:
+        conn.close()
+    return recorded is None or recorded < os.path.getmtime(folder)
+
+
+def latest_backup(folder, database=None):
+    """ Get the most recent backup of a folder, using the created index of the catalog.
+        Rows of files that no longer exist are removed on the way
+
+    Args:
+        folder (str): Backup folder
+        database (str): Only backups of this database
+    Returns:
+        Full path to the backup (an archive or a snapshot folder) or None if there is none
+    """
+    query = 'SELECT name FROM backups {0} ORDER BY created DESC LIMIT 1'.format(
+        'WHERE database = ?' if database else '')
+    conn = connect(folder)
+    try:
+        with conn:
+            while True:
+                row = conn.execute(query, (database,) if database else ()).fetchone()
+                if not row:
+                    return None
+                full_name = os.path.join(folder, row[0])
+                if os.path.exists(full_name):
+                    return full_name
+                logger.warn('%s is in the catalog but does not exist, removing it', full_name)
+                conn.execute('DELETE FROM backups WHERE name = ?', row)
+    finally:
+        conn.close()
+
+
+def list_backups(folder, database=None):
+    """ Get the backups of a folder, newest first
+
+    Returns:
+        List of dicts with the catalog columns
+    """
+    query = 'SELECT * FROM backups {0} ORDER BY created DESC'.format(
+        'WHERE database = ?' if database else '')
+    conn = connect(folder)
+    try:
+        cursor = conn.execute(query, (database,) if database else ())
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+    finally:
+        conn.close()
+
+
+def rescan(folder, full=False):
+    """ Rebuild the catalog of a folder from the archives and snapshot folders on disk.
+        The database and reason of backups already in the catalog are kept unless full
+        is True, new backups get the database from their name (database and reason can
+        not be told apart there)
+
+    Args:
+        folder (str): Backup folder
+        full (bool): Forget everything the catalog knows
+    Returns:
+        Number of backups in the catalog
+    """
+    conn = connect(folder)
+    try:
+        with conn:
+            known = {} if full else dict(
+                (row[0], row[1:]) for row in conn.execute(
+                    'SELECT name, database, reason FROM backups'))
+            conn.execute('DELETE FROM backups')
+            count = 0
+            for fname in os.listdir(folder):
+                full_name = os.path.join(folder, fname)
+                if not is_backup(full_name):
+                    continue
+                database, reason = known.get(fname, (None, None))
+                count += _upsert(conn, full_name, database, reason)
+    finally:
+        conn.close()
+    logger.info('%s backups in the catalog of %s', count, folder)
+    return count
@@ -0,0 +1,300 @@
+"""
+Scheduler to backup many databases from many Odoo instances or docker containers
+at the same time, limiting how many backups run against the same postgres server
+and write into the same disk.
+"""
+import os
+import time
+import datetime
+import logging
+import threading
+from tempfile import mkdtemp
+from lib import utils
+from lib import metrics
+from lib import storage
+
+logger = logging.getLogger('fleet')
+
+# Inventory job keys that are passed to utils.backup_database_direct
+BACKUP_OPTIONS = ['reason', 'cformat', 'stream', 'jobs', 'level', 'dump_format',
+                  'incremental', 'index', 'snapshot', 'delta', 'full_every',
+                  'profile', 'delta_max_size']
+
+
+def load_inventory(filename):
+    """ Load a fleet inventory, a Json file with the following structure:
+
+        {
+            "defaults": {"backup_dir": "/backups", "cformat": "zstd", ...},
+            "jobs": [
+                {"database": "db1", "from_docker": "container1"},
+                {"database": "db2", "odoo_configfile": "/etc/odoo/odoo.conf",
+                 "backup_dir": "/other/disk"},
+                ...
+            ]
+        }
+
+        Every job takes the values it does not have from defaults, the available
+        options are backup_dir, tmp_dir and BACKUP_OPTIONS
+
+    Args:
+        filename (str): Inventory file name
+    Returns:
+        List of dicts, one per job
+    """
+    inventory = utils.load_json(filename)
+    defaults = inventory.get('defaults', {})
+    res = []
+    for job in inventory.get('jobs', []):
+        item = dict(defaults)
+        item.update(job)
+        item.setdefault('backup_dir', '.')
+        res.append(item)
+    return res
+
+
+def resolve_job(job):
+    """ Get the odoo configuration of a job using utils.parse_docker_config or
+        utils.pase_odoo_configfile
+
+    Args:
+        job (dict): Inventory job
+    Returns:
+        dict with the odoo configuration or None if it could not be gotten
+    """
+    if job.get('from_docker'):
+        odoo_cfg = utils.parse_docker_config(job['from_docker'])
+    elif job.get('odoo_configfile'):
+        odoo_cfg = utils.pase_odoo_configfile(job['odoo_configfile'])
+    else:
+        logger.error('Job for database %s has no from_docker nor odoo_configfile',
+                     job.get('database'))
+        return None
+    if odoo_cfg is None:
+        return None
+    odoo_cfg.update({'database': job['database']})
+    return odoo_cfg
+
+
+def job_key(job):
+    """ Key used to identify a job in the state file
+    """
+    return '{0}@{1}'.format(job['database'],
+                            job.get('from_docker') or job.get('odoo_configfile'))
+
+
+def disk_key(backup_dir):
+    """ Key of the disk a backup dir is in, the bucket for object storage urls
+
+    Raises:
+        OSError if backup_dir does not exist
+    """
+    if storage.is_url(backup_dir):
+        return storage.split_url(backup_dir)[0]
+    return os.stat(backup_dir).st_dev
+
+
+def failed_result(job, error):
+    """ Result of a job that could not be run
+    """
+    return {'key': job_key(job), 'database': job['database'], 'status': 'failed',
+            'backup': None, 'size': 0, 'error': error}
+
+
+def prioritize(jobs, state):
+    """ Sort jobs so the ones that never succeeded or have the oldest successful backup
+        go first and, between them, the biggest ones, so long backups do not end up
+        being started last
+
+    Args:
+        jobs (list): Inventory jobs
+        state (dict): State with last_success and size per job key
+    Returns:
+        The sorted list
+    """
+    def priority(job):
+        job_state = state.get(job_key(job), {})
+        return (job_state.get('last_success', 0), -job_state.get('size', 0))
+    return sorted(jobs, key=priority)
+
+
+class FleetScheduler(object):
+    """ Run backup jobs in a pool of worker threads. A job is only started if there are
+        less than host_limit backups running against its postgres server and less than
+        disk_limit backups writing into its backup disk, the next runnable job in
+        priority order is taken so a busy server does not block the others.
+        The disk of every job must be set in its disk key (see disk_key)
+    """
+
+    def __init__(self, jobs, workers=4, host_limit=2, disk_limit=2):
+        self.pending = list(jobs)
+        self.workers = workers
+        self.host_limit = host_limit
+        self.disk_limit = disk_limit
+        self.running_hosts = {}
+        self.running_disks = {}
+        self.results = []
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def host_of(job):
+        odoo_cfg = job['odoo_config']
+        return '{0}:{1}'.format(odoo_cfg.get('db_host'), odoo_cfg.get('db_port'))
+
+    @staticmethod
+    def disk_of(job):
+        return job['disk']
+
+    def _runnable(self, job):
+        return self.running_hosts.get(self.host_of(job), 0) < self.host_limit and \
+            self.running_disks.get(self.disk_of(job), 0) < self.disk_limit
+
+    def _take(self):
+        """ Wait for a runnable job and mark it as running
+
+        Returns:
+            The job or None if there are no more jobs
+        """
+        with self.condition:
+            while self.pending:
+                for job in self.pending:
+                    if self._runnable(job):
+                        self.pending.remove(job)
+                        for counter, key in [(self.running_hosts, self.host_of(job)),
+                                             (self.running_disks, self.disk_of(job))]:
+                            counter[key] = counter.get(key, 0) + 1
+                        return job
+                self.condition.wait()
+            return None
+
+    def _release(self, job, result):
+        with self.condition:
+            for counter, key in [(self.running_hosts, self.host_of(job)),
+                                 (self.running_disks, self.disk_of(job))]:
+                counter[key] -= 1
+            self.results.append(result)
+            self.condition.notify_all()
+
+    def _worker(self, func):
+        while True:
+            job = self._take()
+            if job is None:
+                return
+            try:
+                # the cpu time of a stage would include the other jobs running
+                result = run_job(job, func, cpu=self.workers == 1)
+            except Exception as error:
+                # a job must never stop its worker, the other jobs would not be run
+                logger.exception('Job %s failed', job_key(job))
+                result = failed_result(job, str(error))
+            self._release(job, result)
+
+    def run(self, func=None):
+        """ Run all the jobs
+
+        Args:
+            func (callable): Function that receives a job and returns the backup file name,
+                             backup_job by default
+        Returns:
+            List with the result of every job
+        """
+        threads = [threading.Thread(target=self._worker, args=(func or backup_job,))
+                   for _ in range(min(self.workers, len(self.pending)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # join with timeout so the main thread can still get KeyboardInterrupt
+            while thread.is_alive():
+                thread.join(1)
+        return self.results
+
+
+def backup_job(job):
+    """ Backup the database of a job with utils.backup_database_direct, the dump is
+        written into a temp folder of its own inside tmp_dir, so the jobs running at
+        the same time do not overwrite the dumps of each other
+
+    Returns:
+        The backup file name or None if it failed
+    """
+    kwargs = dict((key, job[key]) for key in BACKUP_OPTIONS if key in job)
+    tmp_dir = mkdtemp(prefix='vxBackup_', dir=job.get('tmp_dir') or None)
+    try:
+        return utils.backup_database_direct(job['odoo_config'], job['backup_dir'],
+                                            tmp_dir=tmp_dir, **kwargs)
+    finally:
+        utils.clean_files(tmp_dir)
+
+
+def run_job(job, func, cpu=True):
+    """ Run a job catching its errors, cpu is given to metrics.start_run
+
+    Returns:
+        dict with the job result: key, database, status (ok or failed), backup, size,
+        start, end, seconds, error and metrics (stage timings)
+    """
+    logger.info('Starting backup of %s', job_key(job))
+    start = time.time()
+    metrics.start_run('backup', cpu, database=job['database'], job=job_key(job))
+    result = {'key': job_key(job), 'database': job['database'], 'backup': None,
+              'size': 0, 'error': None}
+    try:
+        result['backup'] = func(job)
+    except Exception as error:
+        logger.exception('Backup of %s failed', job_key(job))
+        result['error'] = str(error)
+    end = time.time()
+    result['metrics'] = metrics.finish_run(result['backup']).to_dict()
+    if result['backup']:
+        result.update({'status': 'ok', 'size': storage.size_of(result['backup'])})
+    else:
+        result['status'] = 'failed'
+    result.update({
+        'start': datetime.datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S"),
+        'end': datetime.datetime.fromtimestamp(end).strftime("%Y-%m-%d %H:%M:%S"),
+        'seconds': round(end - start, 2),
+    })
+    logger.info('Backup of %s finished: %s in %.2f seconds', job_key(job),
+                result['status'], end - start)
+    return result
+
+
+def backup_fleet(jobs, state_file=None, workers=4, host_limit=2, disk_limit=2):
+    """ Backup every job of an inventory
+
+    Args:
+        jobs (list): Jobs as returned by load_inventory
+        state_file (str): Json file where the last successful backup time and size of
+                          every job are kept to prioritize the next run
+        workers (int): Number of backups running at the same time
+        host_limit (int): Max number of backups running against the same postgres server
+        disk_limit (int): Max number of backups writing into the same disk
+    Returns:
+        List with the result of every job
+    """
+    state = {}
+    if state_file and os.path.exists(state_file):
+        state = utils.load_json(state_file)
+    results = []
+    runnable = []
+    for job in jobs:
+        job['odoo_config'] = resolve_job(job)
+        if job['odoo_config'] is None:
+            results.append(failed_result(job, 'Could not get the configuration'))
+            continue
+        try:
+            job['disk'] = disk_key(job['backup_dir'])
+        except OSError as error:
+            logger.error('Backup dir of %s not available: %s', job_key(job), error)
+            results.append(failed_result(job, 'Backup dir not available: {0}'.format(error)))
+            continue
+        runnable.append(job)
+    scheduler = FleetScheduler(prioritize(runnable, state), workers, host_limit, disk_limit)
+    results.extend(scheduler.run())
+    for result in results:
+        if result['status'] == 'ok':
+            state[result['key']] = {'last_success': time.time(), 'size': result['size']}
+    if state_file:
+        utils.save_json(state, state_file)
+    return results
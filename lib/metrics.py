@@ -0,0 +1,233 @@
+"""
+Timing and throughput metrics of every stage (dump, compression, extraction, restore,
+cleanup...) of a backup or restore run, exported as Json or as a Prometheus
+textfile collector file.
+"""
+import os
+import time
+import json
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('metrics')
+
+_local = threading.local()
+
+
+def cpu_time():
+    """ CPU time (user + system) used by this process and its finished children,
+        so pg_dump, psql and the compression processes are included
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class Run(object):
+    """ Metrics of a backup or restore run, stages are added with the stage context manager
+        while the run is the current one of the thread. The cpu time is process wide, so
+        it is only measured (cpu True) when no other run is going on at the same time
+    """
+
+    def __init__(self, operation, cpu=True, **labels):
+        self.operation = operation
+        self.cpu = cpu
+        self.labels = labels
+        self.stages = []
+        self.start = time.time()
+        self.end = None
+        self.success = None
+
+    def to_dict(self):
+        end = self.end or time.time()
+        return {
+            'operation': self.operation,
+            'labels': self.labels,
+            'host': socket.gethostname(),
+            'start': self.start,
+            'seconds': round(end - self.start, 3),
+            'success': self.success,
+            'stages': self.stages,
+        }
+
+
+def start_run(operation, cpu=True, **labels):
+    """ Start a run and make it the current one of the thread
+
+    Args:
+        operation (str): backup or restore
+        cpu (bool): Measure the cpu time of the stages, False for runs in threads that
+                    run at the same time as other ones (backup_fleet.py)
+        labels: Extra labels (database, container...)
+    Returns:
+        The new Run
+    """
+    _local.run = Run(operation, cpu, **labels)
+    return _local.run
+
+
+def current_run():
+    """ The current run of the thread or None
+    """
+    return getattr(_local, 'run', None)
+
+
+def finish_run(success=True):
+    """ Mark the current run as finished
+
+    Returns:
+        The finished Run or None if there was no current run
+    """
+    run = current_run()
+    if run:
+        run.end = time.time()
+        run.success = bool(success)
+        _local.run = None
+    return run
+
+
+@contextmanager
+def stage(name):
+    """ Measure a stage of the current run, the caller can set bytes_in and bytes_out
+        in the yielded dict. If there is no current run nothing is recorded, if its cpu
+        is False the stage has no cpu_seconds
+
+    Args:
+        name (str): Stage name
+    """
+    record = {'stage': name, 'bytes_in': 0, 'bytes_out': 0}
+    run = current_run()
+    cpu = not run or run.cpu
+    wall_start, cpu_start = time.time(), cpu_time() if cpu else None
+    try:
+        yield record
+    finally:
+        wall = time.time() - wall_start
+        record.update({
+            'seconds': round(wall, 3),
+            'mb_per_second': round(max(record['bytes_in'], record['bytes_out']) /
+                                   1000000.0 / wall, 3) if wall else 0,
+        })
+        if cpu:
+            record['cpu_seconds'] = round(cpu_time() - cpu_start, 3)
+        logger.debug("Stage %s: %s", name, record)
+        if run:
+            run.stages.append(record)
+
+
+def path_size(path):
+    """ Size in bytes of a file or of all the files inside a folder, 0 if it does not exist
+    """
+    if not path or not os.path.exists(path):
+        return 0
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    res = 0
+    for root, _, fnames in os.walk(path):
+        for fname in fnames:
+            full_name = os.path.join(root, fname)
+            if not os.path.islink(full_name):
+                res += os.path.getsize(full_name)
+    return res
+
+
+def _run_dict(run):
+    return run.to_dict() if isinstance(run, Run) else run
+
+
+def save_runs_json(runs, filename):
+    """ Save runs into a Json file
+
+    Args:
+        runs (list): Run objects or their to_dict result
+        filename (str): Json file name
+    """
+    with open(filename, 'w') as fout:
+        json.dump([_run_dict(run) for run in runs], fout, sort_keys=True, indent=4)
+    logger.debug("Metrics saved in %s", filename)
+
+
+def _prometheus_labels(labels):
+    return ','.join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\')
+                                       .replace('"', '\\"'))
+                    for key, value in sorted(labels.items()))
+
+
+def _merge_stages(stages):
+    """ Add up the stages with the same name, Prometheus does not accept repeated series
+    """
+    res = []
+    by_name = {}
+    for record in stages:
+        if record['stage'] not in by_name:
+            by_name[record['stage']] = dict(record)
+            res.append(by_name[record['stage']])
+            continue
+        merged = by_name[record['stage']]
+        for key in ['seconds', 'cpu_seconds', 'bytes_in', 'bytes_out']:
+            if key in merged:
+                merged[key] += record[key]
+        merged['mb_per_second'] = round(max(merged['bytes_in'], merged['bytes_out']) /
+                                        1000000.0 / merged['seconds'], 3) \
+            if merged['seconds'] else 0
+    return res
+
+
+def save_runs_prometheus(runs, filename):
+    """ Save runs into a file for the node exporter textfile collector, it is written
+        into a temp file and renamed so the collector never reads it half written
+
+    Args:
+        runs (list): Run objects or their to_dict result
+        filename (str): File name, it should end with .prom
+    """
+    metrics = [
+        ('backupws_stage_seconds', 'gauge', 'Wall time of the stage'),
+        ('backupws_stage_cpu_seconds', 'gauge', 'CPU time of the stage, children included'),
+        ('backupws_stage_bytes_in', 'gauge', 'Bytes read by the stage'),
+        ('backupws_stage_bytes_out', 'gauge', 'Bytes written by the stage'),
+        ('backupws_stage_mb_per_second', 'gauge', 'Throughput of the stage in MB/s'),
+        ('backupws_run_seconds', 'gauge', 'Wall time of the run'),
+        ('backupws_run_success', 'gauge', '1 if the run was successful'),
+        ('backupws_run_timestamp_seconds', 'gauge', 'Start time of the run'),
+    ]
+    lines = []
+    for metric, mtype, help_text in metrics:
+        lines.append('# HELP {0} {1}'.format(metric, help_text))
+        lines.append('# TYPE {0} {1}'.format(metric, mtype))
+        for run in runs:
+            info = _run_dict(run)
+            labels = dict(info['labels'], operation=info['operation'])
+            if metric.startswith('backupws_run_'):
+                value = {'backupws_run_seconds': info['seconds'],
+                         'backupws_run_success': int(bool(info['success'])),
+                         'backupws_run_timestamp_seconds': int(info['start'])}[metric]
+                lines.append('{0}{{{1}}} {2}'.format(metric, _prometheus_labels(labels), value))
+                continue
+            key = metric[len('backupws_stage_'):]
+            for record in _merge_stages(info['stages']):
+                if key not in record:
+                    continue
+                lines.append('{0}{{{1}}} {2}'.format(
+                    metric, _prometheus_labels(dict(labels, stage=record['stage'])),
+                    record[key]))
+    tmp_name = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(tmp_name, 'w') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    os.rename(tmp_name, filename)
+    logger.debug("Metrics saved in %s", filename)
+
+
+def save_run(run, json_name=None, prom_name=None):
+    """ Save a run in the formats requested in the command line
+
+    Args:
+        run (Run): Finished run
+        json_name (str): Json file name, not saved if empty
+        prom_name (str): Prometheus textfile collector file name, not saved if empty
+    """
+    if run and json_name:
+        save_runs_json([run], json_name)
+    if run and prom_name:
+        save_runs_prometheus([run], prom_name)
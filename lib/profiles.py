@@ -0,0 +1,200 @@
+"""
+Table data exclusion profiles, used to make test databases faster: the schema of the
+big log-like tables is kept but their data is skipped, either when dumping (pg_dump
+--exclude-table-data) or when restoring an existing full backup (filtering the sql
+dump or the pg_restore list).
+
+A profile has:
+    exclude_data: Table name patterns (shell style, like pg_dump ones) whose rows
+                  are skipped
+    null_columns: {table: [columns]} set to NULL in every row, only for sql dumps
+
+The rows that are kept may reference the skipped ones, so the foreign keys to the
+excluded tables are restored NOT VALID: they are enforced for new rows but the
+existing ones are not checked.
+"""
+import os
+import re
+import json
+import fnmatch
+import logging
+
+logger = logging.getLogger('profiles')
+
+LOG_TABLES = ['ir_logging', 'bus_bus', 'bus_presence', 'mail_tracking_value',
+              'auditlog_log*']
+
+PROFILES = {
+    'logs': {
+        'exclude_data': LOG_TABLES,
+        'null_columns': {},
+    },
+    'test': {
+        # the tables of the stock modules that reference mail_message are skipped too,
+        # the foreign keys of other modules are restored NOT VALID
+        'exclude_data': LOG_TABLES + ['mail_message', 'mail_message_res_partner_*',
+                                      'mail_message_mail_channel_rel', 'mail_notification',
+                                      'message_attachment_rel', 'mail_mail',
+                                      'mail_mail_res_partner_rel', 'mail_message_reaction',
+                                      'mail_message_schedule', 'mail_link_preview',
+                                      'mail_compose_message*', 'mail_resend_message*',
+                                      'rating_rating', 'snailmail_letter*', 'sms_sms'],
+        'null_columns': {'ir_attachment': ['db_datas']},
+    },
+}
+
+COPY_RE = re.compile(r'^COPY (?:"?[\w$]+"?\.)?"?(?P<table>[\w$]+)"? \((?P<columns>[^)]*)\)'
+                     r' FROM stdin;$')
+TOC_DATA_RE = re.compile(r'^\d+; \d+ \d+ TABLE DATA (?:\S+ )?(?P<table>\S+) ')
+TOC_FK_RE = re.compile(r'^\d+; \d+ \d+ FK CONSTRAINT (?:\S+ )?(?P<table>\S+) (?P<name>\S+) ')
+# pg_dump writes every foreign key as ALTER TABLE ONLY table and ADD CONSTRAINT lines
+ALTER_TABLE_RE = re.compile(r'^ALTER TABLE ONLY (?:"?[\w$]+"?\.)?"?(?P<table>[\w$]+)"?$')
+FK_RE = re.compile(r'^\s+ADD CONSTRAINT "?(?P<name>[\w$]+)"? FOREIGN KEY \([^)]*\)'
+                   r' REFERENCES (?:"?[\w$]+"?\.)?"?(?P<table>[\w$]+)"?\(.*;$')
+
+
+def get_profile(name):
+    """ Get a profile by name, or load it from a Json file with the same keys
+
+    Args:
+        name (str): One of PROFILES or a Json file name
+    Returns:
+        dict with the profile
+    """
+    if name in PROFILES:
+        return PROFILES[name]
+    if os.path.isfile(name):
+        with open(name) as fin:
+            profile = json.load(fin)
+        profile.setdefault('exclude_data', [])
+        profile.setdefault('null_columns', {})
+        return profile
+    raise RuntimeError('Unknown profile "{0}", use one of {1} or a Json file'.format(
+        name, ', '.join(sorted(PROFILES))))
+
+
+def excluded(profile, table):
+    """ True if the data of table is skipped by the profile
+    """
+    return any(fnmatch.fnmatchcase(table, pattern) for pattern in profile['exclude_data'])
+
+
+def not_valid(line, profile):
+    """ Add NOT VALID to the ADD CONSTRAINT line of a foreign key to an excluded table
+
+    Args:
+        line (str): Line of a sql dump
+        profile (dict): Profile
+    Returns:
+        The line to restore, None if it is not a foreign key to an excluded table
+    """
+    match = FK_RE.match(line.rstrip('\n'))
+    if not match or not excluded(profile, match.group('table')):
+        return None
+    return line.rstrip('\n')[:-1] + ' NOT VALID;\n'
+
+
+def pg_dump_args(profile):
+    """ pg_dump arguments that skip the data of the profile tables
+    """
+    return ['--exclude-table-data={0}'.format(pattern) for pattern in profile['exclude_data']]
+
+
+def filter_sql(fin, fout, profile):
+    """ Copy a plain sql dump skipping the COPY blocks of the excluded tables and
+        setting to NULL the columns of null_columns, line by line so the memory used
+        does not depend on the dump size
+
+    Args:
+        fin (file): Dump opened for reading
+        fout (file): Where the filtered dump is written
+        profile (dict): Profile
+    Returns:
+        dict with the number of rows skipped and changed and of foreign keys made
+        NOT VALID
+    """
+    stats = {'skipped': 0, 'changed': 0, 'not_valid': 0}
+    lines = iter(fin.readline, '')
+    for line in lines:
+        match = COPY_RE.match(line.rstrip('\n'))
+        if not match:
+            fk_line = line.startswith('    ADD CONSTRAINT ') and not_valid(line, profile)
+            if fk_line:
+                stats['not_valid'] += 1
+            fout.write(fk_line or line)
+            continue
+        table = match.group('table')
+        if excluded(profile, table):
+            logger.debug('Skipping data of %s', table)
+            for line in lines:
+                if line == '\\.\n':
+                    break
+                stats['skipped'] += 1
+            continue
+        fout.write(line)
+        columns = [column.strip().strip('"') for column in match.group('columns').split(',')]
+        positions = [columns.index(column)
+                     for column in profile['null_columns'].get(table, [])
+                     if column in columns]
+        if not positions:
+            continue
+        # tabs and newlines inside the values are escaped in the COPY text format
+        for line in lines:
+            if line == '\\.\n':
+                fout.write(line)
+                break
+            values = line.rstrip('\n').split('\t')
+            for position in positions:
+                values[position] = '\\N'
+            fout.write('\t'.join(values) + '\n')
+            stats['changed'] += 1
+    return stats
+
+
+def not_valid_fks(post_data, profile):
+    """ Get the foreign keys to excluded tables of the post-data section of a dump,
+        made NOT VALID
+
+    Args:
+        post_data (str): Output of pg_restore --section=post-data (without -d)
+        profile (dict): Profile
+    Returns:
+        dict {(table, constraint name): ALTER TABLE statement with NOT VALID}
+    """
+    res = {}
+    alter_line = None
+    for line in post_data.splitlines(True):
+        match = ALTER_TABLE_RE.match(line.rstrip('\n'))
+        if match:
+            alter_line, table = line, match.group('table')
+            continue
+        fk_line = alter_line and not_valid(line, profile)
+        if fk_line:
+            res[(table, FK_RE.match(line).group('name'))] = alter_line + fk_line
+        alter_line = None
+    return res
+
+
+def filter_toc(toc, profile, fks=()):
+    """ Remove the TABLE DATA entries of the excluded tables from a pg_restore -l list,
+        and the FK CONSTRAINT entries in fks, that are restored NOT VALID afterwards
+
+    Args:
+        toc (str): Output of pg_restore -l
+        profile (dict): Profile
+        fks (dict): Foreign keys given by not_valid_fks
+    Returns:
+        The list to give to pg_restore -L
+    """
+    res = []
+    for line in toc.splitlines(True):
+        match = TOC_DATA_RE.match(line)
+        if match and excluded(profile, match.group('table')):
+            logger.debug('Skipping data of %s', match.group('table'))
+            continue
+        match = TOC_FK_RE.match(line)
+        if match and (match.group('table'), match.group('name')) in fks:
+            logger.debug('Restoring %s NOT VALID', match.group('name'))
+            continue
+        res.append(line)
+    return ''.join(res)
@@ -0,0 +1,162 @@
+"""
+Split plain sql dumps into their pre-data, data and post-data sections, so the indexes
+and constraints (post-data) are built once the data is loaded and on several connections,
+like pg_restore -j does with custom dumps. The entries are found with the comment that
+pg_dump writes before every object:
+
+    --
+    -- Name: res_partner res_partner_pkey; Type: CONSTRAINT; Schema: public; Owner: odoo
+    --
+
+so the dumps of any pg_dump version can be split, not only new ones.
+"""
+import re
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger('sections')
+
+HEADER_RE = re.compile(r'^-- (?:Data for )?Name: .*; Type: (?P<type>[A-Z ]+); Schema: ')
+# pg_dump changes the session settings (search_path, default_tablespace...) between the
+# entries, they are replayed on the connections that build the post-data
+SETTING_RE = re.compile(r"^(?:SET (?:SESSION )?(?P<name>\w+)"
+                        r"|SELECT pg_catalog\.set_config\('(?P<config>\w+)').*;$")
+INDEX_RE = re.compile(r'^CREATE (?:UNIQUE )?INDEX \S+ ON (?:ONLY )?(?P<table>\S+)', re.M)
+ALTER_RE = re.compile(r'^ALTER TABLE (?:ONLY )?(?P<table>\S+)', re.M)
+REFERENCES_RE = re.compile(r'REFERENCES (?P<table>[^\s(]+)')
+
+# Entry types always loaded with the data, even if they come after the post-data
+DATA_TYPES = ('TABLE DATA', 'SEQUENCE SET', 'BLOBS', 'LARGE OBJECTS')
+# Entry types built one job per table, the foreign keys after the rest
+INDEX_TYPES = ('INDEX', 'CONSTRAINT')
+FK_TYPES = ('FK CONSTRAINT',)
+# Entry types that start the post-data section, what comes after them (triggers,
+# comments, grants...) is run after the indexes and constraints
+POST_DATA_TYPES = INDEX_TYPES + FK_TYPES + (
+    'INDEX ATTACH', 'TRIGGER', 'EVENT TRIGGER', 'RULE', 'MATERIALIZED VIEW DATA', 'POLICY',
+    'ROW SECURITY', 'PUBLICATION', 'PUBLICATION TABLE', 'SUBSCRIPTION')
+
+
+class SectionSplitter(object):
+    """ File like object that writes the pre-data and data sections of a plain sql dump
+        into fileobj and keeps the post-data entries in memory (they are only DDL), to be
+        built later with post_data_jobs. The rows of the COPY blocks are passed through
+        by chunks, without splitting them in lines
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.buf = ''
+        self.in_copy = False
+        self.post_data = False
+        self.entry = None
+        self.entries = []
+        self.settings = OrderedDict()
+        self.settings_sql = ''
+
+    def write(self, data):
+        buf = self.buf + data
+        pos = 0
+        while pos < len(buf):
+            if self.in_copy:
+                if buf.startswith('\\.\n', pos):
+                    end = pos + 3
+                else:
+                    end = buf.find('\n\\.\n', pos)
+                    end = end + 4 if end >= 0 else -1
+                if end < 0:
+                    # the end of the block is not here, keep a partial last line
+                    end = buf.rfind('\n', pos) + 1
+                    if end <= pos:
+                        break
+                else:
+                    self.in_copy = False
+                self.fileobj.write(buf[pos:end])
+                pos = end
+                continue
+            end = buf.find('\n', pos)
+            if end < 0:
+                break
+            self._line(buf[pos:end + 1])
+            pos = end + 1
+        self.buf = buf[pos:]
+
+    def _line(self, line):
+        match = HEADER_RE.match(line)
+        if match:
+            entry_type = match.group('type')
+            if entry_type in POST_DATA_TYPES:
+                self.post_data = True
+            self.entry = None
+            if self.post_data and entry_type not in DATA_TYPES:
+                self.entry = {'type': entry_type, 'lines': [line],
+                              'settings': self.settings_sql}
+                self.entries.append(self.entry)
+                return
+        match = SETTING_RE.match(line)
+        if match:
+            self.settings[match.group('name') or match.group('config')] = line
+            self.settings_sql = ''.join(self.settings.values())
+            self.fileobj.write(line)
+            return
+        if self.entry is not None:
+            if line.startswith('\\'):
+                # psql meta commands (\restrict, \unrestrict) are not sent to the jobs
+                logger.debug('Skipping %s', line.strip())
+            else:
+                self.entry['lines'].append(line)
+            return
+        if line.startswith('COPY ') and line.endswith(' FROM stdin;\n'):
+            self.in_copy = True
+        self.fileobj.write(line)
+
+    def close(self):
+        if self.buf:
+            buf = self.buf
+            self.buf = ''
+            if self.in_copy:
+                self.fileobj.write(buf)
+            else:
+                self._line(buf)
+        self.fileobj.close()
+
+
+def post_data_jobs(entries):
+    """ Group the post-data entries kept by a SectionSplitter in the jobs of three
+        phases, every phase starts when the previous one finished:
+
+        1. Indexes, primary keys and unique constraints, a job per table
+        2. Foreign keys, a job per table that also locks the referenced tables, so they
+           need the indexes of phase 1
+        3. The rest (triggers, rules, comments, grants...) in a single job in dump order
+
+    The statements of a job run in dump order, preceded by the session settings they had
+    in the dump
+
+    Args:
+        entries (list): SectionSplitter entries
+    Returns:
+        List of phases, every one a list of dicts with the sql of the job and the tables
+        it locks (locks)
+    """
+    phases = [OrderedDict(), OrderedDict(), OrderedDict()]
+    for entry in entries:
+        sql = ''.join(entry['lines'])
+        match = INDEX_RE.search(sql) or ALTER_RE.search(sql)
+        if match and entry['type'] in INDEX_TYPES:
+            phase, table = 0, match.group('table')
+        elif match and entry['type'] in FK_TYPES:
+            phase, table = 1, match.group('table')
+        else:
+            phase, table = 2, None
+        job = phases[phase].setdefault(table, {'sql': [], 'locks': set(), 'settings': None})
+        if table:
+            job['locks'].add(table)
+        if phase == 1:
+            job['locks'].update(REFERENCES_RE.findall(sql))
+        if job['settings'] != entry['settings']:
+            job['settings'] = entry['settings']
+            job['sql'].append(entry['settings'])
+        job['sql'].append(sql)
+    return [[{'sql': ''.join(job['sql']), 'locks': job['locks']} for job in phase.values()]
+            for phase in phases if phase]
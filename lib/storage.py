@@ -0,0 +1,347 @@
+"""
+Storage targets for backups. A backup dir can be a local folder or an S3 compatible
+bucket given as s3://bucket/prefix; archives are uploaded with parallel multipart
+uploads while they are being compressed, and downloaded as a stream to restore them.
+
+The endpoint and credentials are taken from the environment:
+S3_ENDPOINT_URL (https://s3.amazonaws.com by default, the MinIO or Ceph url otherwise),
+AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_DEFAULT_REGION (us-east-1 by default).
+"""
+import os
+import hmac
+import time
+import urllib
+import hashlib
+import logging
+import datetime
+import urlparse
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+import requests
+from lib import metrics
+
+logger = logging.getLogger('storage')
+
+S3_SCHEME = 's3://'
+# S3 needs parts of 5MB at least, but the last one
+PART_SIZE = 16 * 1024 * 1024
+PART_JOBS = 4
+RETRIES = 3
+EMPTY_SHA256 = hashlib.sha256('').hexdigest()
+
+
+def is_url(name):
+    """ True if name is an object storage url instead of a local path
+    """
+    return bool(name) and name.startswith(S3_SCHEME)
+
+
+def split_url(url):
+    """ Split s3://bucket/key into (bucket, key)
+    """
+    bucket, _, key = url[len(S3_SCHEME):].partition('/')
+    return bucket, key
+
+
+def get_storage(target):
+    """ Get the storage of a backup dir
+
+    Args:
+        target (str): Local folder or s3://bucket/prefix
+    Returns:
+        S3Storage or None for local folders
+    """
+    if not is_url(target):
+        return None
+    bucket, prefix = split_url(target)
+    return S3Storage(bucket, prefix)
+
+
+def open_url(name):
+    """ Open a backup for reading, local file or object url
+    """
+    if is_url(name):
+        bucket, key = split_url(name)
+        return S3Storage(bucket).open_read(key)
+    return open(name, 'rb')
+
+
+def size_of(name):
+    """ Size in bytes of a backup, local file or folder or object url
+    """
+    if is_url(name):
+        bucket, key = split_url(name)
+        return S3Storage(bucket).size(key)
+    return metrics.path_size(name)
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg, hashlib.sha256).digest()
+
+
+class S3Storage(object):
+    """ Minimal S3 client (AWS signature version 4, path style urls) with the
+        operations needed by the backups
+
+    Args:
+        bucket (str): Bucket name
+        prefix (str): Key prefix (folder) of the backups
+        part_size (int): Multipart upload part size, memory used by an upload is
+                         part_size * (jobs + 1)
+        jobs (int): Parts uploaded at the same time
+    """
+
+    def __init__(self, bucket, prefix='', part_size=PART_SIZE, jobs=PART_JOBS):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.part_size = part_size
+        self.jobs = jobs
+        self.endpoint = os.environ.get('S3_ENDPOINT_URL', 'https://s3.amazonaws.com').rstrip('/')
+        self.access_key = os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
+        self.region = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
+        if not (self.access_key and self.secret_key):
+            raise RuntimeError('AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY must be set to'
+                               ' use {0}{1}'.format(S3_SCHEME, bucket))
+        self.session = requests.Session()
+
+    def key(self, name):
+        return '{0}/{1}'.format(self.prefix, name) if self.prefix else name
+
+    def url(self, name):
+        return '{0}{1}/{2}'.format(S3_SCHEME, self.bucket, self.key(name))
+
+    def _headers(self, method, path, query, payload_hash):
+        """ Signature version 4 headers of a request
+        """
+        now = datetime.datetime.utcnow()
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date_stamp = now.strftime('%Y%m%d')
+        host = urlparse.urlparse(self.endpoint).netloc
+        headers = {'host': host, 'x-amz-content-sha256': payload_hash, 'x-amz-date': amz_date}
+        signed_headers = ';'.join(sorted(headers))
+        canonical = '\n'.join([method, urllib.quote(path, safe='/~'), query,
+                               ''.join('{0}:{1}\n'.format(key, headers[key])
+                                       for key in sorted(headers)),
+                               signed_headers, payload_hash])
+        scope = '{0}/{1}/s3/aws4_request'.format(date_stamp, self.region)
+        to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                             hashlib.sha256(canonical).hexdigest()])
+        key = _hmac('AWS4' + self.secret_key, date_stamp)
+        for part in [self.region, 's3', 'aws4_request']:
+            key = _hmac(key, part)
+        headers['Authorization'] = (
+            'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, Signature={3}'.format(
+                self.access_key, scope, signed_headers,
+                hmac.new(key, to_sign, hashlib.sha256).hexdigest()))
+        del headers['host']
+        return headers
+
+    def request(self, method, key, params=None, data='', stream=False, expected=(200,)):
+        """ Make a signed request, retrying server and connection errors
+
+        Returns:
+            The requests response
+        """
+        path = '/{0}/{1}'.format(self.bucket, key)
+        # the query is built here so it is sent exactly as it was signed
+        query = '&'.join('{0}={1}'.format(urllib.quote(name, safe='~'),
+                                          urllib.quote(str(value), safe='~'))
+                         for name, value in sorted((params or {}).items()))
+        url = self.endpoint + urllib.quote(path, safe='/~') + ('?' + query if query else '')
+        payload_hash = hashlib.sha256(data).hexdigest() if data else EMPTY_SHA256
+        for attempt in range(RETRIES):
+            try:
+                response = self.session.request(
+                    method, url, data=data or None, stream=stream,
+                    headers=self._headers(method, path, query, payload_hash))
+            except requests.exceptions.ConnectionError as error:
+                if attempt == RETRIES - 1:
+                    raise RuntimeError('Could not connect to {0}: {1}'.format(
+                        self.endpoint, error))
+            else:
+                if response.status_code in expected:
+                    return response
+                if response.status_code < 500 or attempt == RETRIES - 1:
+                    raise RuntimeError('{0} {1} returned {2}: {3}'.format(
+                        method, path, response.status_code, response.text[:500]))
+            logger.warn('%s %s failed, retrying', method, path)
+            time.sleep(2 ** attempt)
+
+    def put(self, name, data):
+        self.request('PUT', self.key(name), data=data)
+
+    def size(self, name):
+        response = self.request('HEAD', self.key(name))
+        return int(response.headers['Content-Length'])
+
+    def delete(self, name):
+        self.request('DELETE', self.key(name), expected=(200, 204))
+
+    def open_read(self, name):
+        """ Stream an object
+
+        Returns:
+            File like object with its content
+        """
+        return S3Reader(self.request('GET', self.key(name), stream=True))
+
+    def open_write(self, name):
+        """ Upload an object while it is being written
+
+        Returns:
+            S3Writer
+        """
+        return S3Writer(self, self.key(name))
+
+    def list(self, prefix=''):
+        """ Names (relative to the storage prefix) of the objects starting with prefix
+        """
+        res = []
+        params = {'list-type': 2, 'prefix': self.key(prefix)}
+        while True:
+            root = ElementTree.fromstring(self.request('GET', '', params=params).content)
+            for element in root.iter():
+                if element.tag.endswith('}Key') or element.tag == 'Key':
+                    res.append(element.text[len(self.key('')):])
+            token = [element.text for element in root.iter()
+                     if element.tag.endswith('NextContinuationToken')]
+            if not token:
+                return res
+            params['continuation-token'] = token[0]
+
+
+def _xml_value(content, tag):
+    for element in ElementTree.fromstring(content).iter():
+        if element.tag == tag or element.tag.endswith('}' + tag):
+            return element.text
+    return None
+
+
+class S3Reader(object):
+    """ File like object with the content of a streamed GET response
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.response.raw.read()
+        return self.response.raw.read(size)
+
+    def close(self):
+        self.response.close()
+
+
+class S3Writer(object):
+    """ File like object that uploads what is written on it as a multipart upload, parts
+        are uploaded by a pool of threads while the next ones are being written, with
+        at most jobs parts in flight so memory is bounded. Objects smaller than a part
+        are uploaded with a single PUT when closed. If abort is called, or close fails,
+        the multipart upload is aborted so no partial object is left.
+    """
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.upload_id = None
+        self.pool = None
+        self.pending = deque()
+        self.parts = []
+        self.buf = []
+        self.buf_size = 0
+        self.size = 0
+        self.closed = False
+
+    def tell(self):
+        return self.size
+
+    def write(self, data):
+        if self.closed:
+            return
+        self.buf.append(data)
+        self.buf_size += len(data)
+        self.size += len(data)
+        if self.buf_size >= self.storage.part_size:
+            data = ''.join(self.buf)
+            while len(data) >= self.storage.part_size:
+                self._submit(data[:self.storage.part_size])
+                data = data[self.storage.part_size:]
+            self.buf = [data]
+            self.buf_size = len(data)
+
+    def _upload_part(self, number, data):
+        response = self.storage.request('PUT', self.key, data=data, params={
+            'partNumber': number, 'uploadId': self.upload_id})
+        return number, response.headers['ETag']
+
+    def _submit(self, data):
+        if not self.upload_id:
+            response = self.storage.request('POST', self.key, params={'uploads': ''})
+            self.upload_id = _xml_value(response.content, 'UploadId')
+            self.pool = ThreadPool(self.storage.jobs)
+            logger.debug('Multipart upload of %s started: %s', self.key, self.upload_id)
+        while len(self.pending) >= self.storage.jobs:
+            self.parts.append(self.pending.popleft().get())
+        self.pending.append(self.pool.apply_async(
+            self._upload_part, (len(self.parts) + len(self.pending) + 1, data)))
+
+    def close(self):
+        """ Upload the remaining data and complete the upload
+        """
+        if self.closed:
+            return
+        try:
+            data = ''.join(self.buf)
+            self.buf = []
+            if not self.upload_id:
+                self.storage.request('PUT', self.key, data=data)
+                self.closed = True
+                return
+            if data:
+                self._submit(data)
+            while self.pending:
+                self.parts.append(self.pending.popleft().get())
+            body = '<CompleteMultipartUpload>{0}</CompleteMultipartUpload>'.format(''.join(
+                '<Part><PartNumber>{0}</PartNumber><ETag>{1}</ETag></Part>'.format(
+                    number, etag) for number, etag in self.parts))
+            response = self.storage.request('POST', self.key, data=body,
+                                            params={'uploadId': self.upload_id})
+            # errors completing the upload can come with a 200 status
+            if _xml_value(response.content, 'Code'):
+                raise RuntimeError('Could not complete the upload of {0}: {1}'.format(
+                    self.key, response.content[:500]))
+            self.closed = True
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            if self.pool:
+                self.pool.terminate()
+                self.pool.join()
+
+    def abort(self):
+        """ Discard the upload
+        """
+        if self.closed:
+            return
+        self.closed = True
+        # parts still in flight would be uploaded after the abort
+        while self.pending:
+            try:
+                self.pending.popleft().get()
+            except Exception:
+                pass
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.upload_id:
+            logger.warn('Aborting upload of %s', self.key)
+            try:
+                self.storage.request('DELETE', self.key, params={'uploadId': self.upload_id},
+                                     expected=(200, 204))
+            except RuntimeError as error:
+                logger.error('Could not abort the upload: %s', error)
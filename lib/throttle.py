@@ -0,0 +1,192 @@
+"""
+Limits for backups running on hosts that also serve Odoo: read and write
+bandwidth caps, cpu and io priority, and an adaptive mode that pauses the
+backup while the host load or the postgres active connections are too high.
+"""
+import os
+import time
+import logging
+import subprocess
+import multiprocessing
+from lib import utils
+
+logger = logging.getLogger('throttle')
+
+# ionice scheduling classes
+IONICE_CLASSES = {1: 'realtime', 2: 'best-effort', 3: 'idle'}
+
+CHECK_SIZE = 1024 * 1024
+MAX_BACKOFF = 60
+
+
+def set_priority(nice=None, ionice_class=None, ionice_level=None):
+    """ Lower the cpu and io priority of this process, pg_dump, psql and the compression
+        processes started after it inherit them
+
+    Args:
+        nice (int): Niceness increment (0-19)
+        ionice_class (int): ionice class, one of IONICE_CLASSES
+        ionice_level (int): ionice priority inside the class (0-7), best-effort only
+    """
+    if nice:
+        logger.debug("Niceness set to %s", os.nice(nice))
+    if ionice_class:
+        cmd = ['ionice', '-c', str(ionice_class), '-p', str(os.getpid())]
+        if ionice_class == 2 and ionice_level is not None:
+            cmd[3:3] = ['-n', str(ionice_level)]
+        try:
+            subprocess.check_call(cmd)
+        except (OSError, subprocess.CalledProcessError) as error:
+            logger.warn('Could not set io priority with ionice: %s', error)
+        else:
+            logger.debug("IO class set to %s", IONICE_CLASSES[ionice_class])
+
+
+class LoadGuard(object):
+    """ Tells if the host is too busy for the backup to go on
+
+    Args:
+        max_load (float): Max 1 minute load average per cpu
+        max_connections (int): Max active postgres connections, database_config is needed
+        database_config (dict): Database configuration used to count the connections
+    """
+
+    def __init__(self, max_load=None, max_connections=None, database_config=None):
+        self.max_load = max_load
+        self.max_connections = max_connections
+        self.database_config = database_config
+        self.cpus = multiprocessing.cpu_count()
+
+    def overloaded(self):
+        """ Returns:
+                A description of why the host is overloaded or None
+        """
+        if self.max_load:
+            load = os.getloadavg()[0] / self.cpus
+            if load > self.max_load:
+                return 'load {0:.2f} per cpu'.format(load)
+        if self.max_connections and self.database_config:
+            connections = utils.get_active_connections(self.database_config)
+            if connections is not None and connections > self.max_connections:
+                return '{0} active connections'.format(connections)
+        return None
+
+
+class Throttle(object):
+    """ Keeps the bytes read and written by a backup under read_rate and write_rate
+        bytes per second, and pauses it with an exponential backoff while guard says
+        the host is overloaded. Bytes read are counted by the wrapped file and bytes
+        written by the written callable given to start.
+
+    Args:
+        read_rate (int): Max bytes read per second
+        write_rate (int): Max bytes written per second
+        guard (LoadGuard): Load guard for the adaptive mode
+        check_interval (int): Seconds between load checks
+    """
+
+    def __init__(self, read_rate=None, write_rate=None, guard=None, check_interval=10):
+        self.read_rate = read_rate
+        self.write_rate = write_rate
+        self.guard = guard
+        self.check_interval = check_interval
+        self.written = lambda: 0
+        self.read = 0
+        self.paused = 0
+        self._reset()
+
+    def _reset(self):
+        self.start_time = time.time()
+        self.start_read = self.read
+        self.start_written = self.written()
+        self.last_check = self.start_time
+        self.unchecked = 0
+
+    def start(self, written=None):
+        """ Start counting
+
+        Args:
+            written (callable): Returns the bytes written so far
+        """
+        self.written = written or (lambda: 0)
+        self.read = 0
+        self._reset()
+
+    def wrap(self, fileobj):
+        return ThrottledWriter(fileobj, self)
+
+    def _wait_load(self):
+        backoff = 1
+        reason = self.guard.overloaded()
+        if not reason:
+            return
+        start = time.time()
+        while reason:
+            logger.info('Host overloaded (%s), pausing backup %s seconds', reason, backoff)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+            reason = self.guard.overloaded()
+        self.paused += time.time() - start
+        # do not let the paused time be used to go over the rates
+        self._reset()
+
+    def consume(self, size):
+        """ Count size bytes read and sleep if needed
+        """
+        self.read += size
+        self.unchecked += size
+        if self.unchecked < CHECK_SIZE:
+            return
+        self.unchecked = 0
+        now = time.time()
+        if self.guard and now - self.last_check >= self.check_interval:
+            self.last_check = now
+            self._wait_load()
+        wait = 0
+        if self.read_rate:
+            wait = (self.read - self.start_read) / float(self.read_rate)
+        if self.write_rate:
+            wait = max(wait, (self.written() - self.start_written) / float(self.write_rate))
+        wait -= time.time() - self.start_time
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledWriter(object):
+    """ File like object that writes into fileobj counting the bytes in the throttle
+    """
+
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.throttle.consume(len(data))
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def build_throttle(read_limit=None, write_limit=None, max_load=None, max_connections=None,
+                   database_config=None, check_interval=10):
+    """ Build a Throttle from the command line options
+
+    Args:
+        read_limit (float): MB per second read
+        write_limit (float): MB per second written
+        max_load (float): Max load average per cpu
+        max_connections (int): Max active postgres connections
+        database_config (dict): Database configuration to count the connections
+        check_interval (int): Seconds between load checks
+    Returns:
+        The Throttle or None if there are no limits
+    """
+    guard = None
+    if max_load or max_connections:
+        guard = LoadGuard(max_load, max_connections, database_config)
+    if not (read_limit or write_limit or guard):
+        return None
+    return Throttle(int(read_limit * 1000000) if read_limit else None,
+                    int(write_limit * 1000000) if write_limit else None,
+                    guard, check_interval)
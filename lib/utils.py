@@ -3,30 +3,112 @@ Various helper method, soon all of them will be part of vxTools,
 this is just a PoC to try some concepts and tests.
 """
 import shutil
+import errno
 import datetime
+import time
 import tarfile
 import os
 import bz2
+import zlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
 import logging
 import oerplib
 import socket
 import json
 import ConfigParser
 from semantic_version import Version, Spec
+from lib import metrics
+from lib import catalog
+from lib import storage
+from lib import profiles
+from lib import sections
 import spur
 import shlex
 from docker import Client
 import docker.errors
-from tempfile import gettempdir
+from tempfile import gettempdir, mkdtemp, TemporaryFile
 import base64
 import zipfile
 import subprocess
 import re
+import hashlib
+import bisect
+import struct
+import uuid
+import threading
+import Queue
+import requests
+from cStringIO import StringIO
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('utils')
 
+DUMP_CHUNK_SIZE = 64 * 1024 * 1024
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+# pg_dump format: (pg_dump --format value, dump name inside the backup)
+DUMP_FORMATS = {
+    'plain': ('p', 'database_dump.sql'),
+    'custom': ('c', 'database_dump.dump'),
+    'directory': ('d', 'database_dump'),
+}
+# Content addressed store for incremental filestore backups, kept in the backup dir
+OBJECT_STORE_NAME = 'filestore_objects'
+FILESTORE_INDEX_NAME = 'filestore.json'
+# Last member of every backup, with the list of files and their checksums
+MANIFEST_NAME = 'manifest.json'
+# Name of the zip generated by the Odoo database manager inside WS backups
+WS_ZIP_NAME = 'database_dump.zip'
+# Names used in the backup for the members of the Odoo database manager zip,
+# the rest (filestore) keep their name
+WS_ZIP_MEMBERS = {
+    'dump.sql': 'database_dump.sql',
+    'manifest.json': 'odoo_manifest.json',
+}
+# Local file header of zip members (signature, version, flags, method, time, date, crc,
+# compressed size, size, name length, extra field length) and read size of ZipStreamReader
+ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+ZIP_READ_SIZE = 1024 * 1024
+# Central directory header, zip64 end of central directory record and locator, and end
+# of central directory record of the zips built while they are uploaded (OdooUploadReader)
+ZIP_CENTRAL_HEADER = struct.Struct('<4sHHHHHHLLLHHHHHLL')
+ZIP64_END = struct.Struct('<4sQHHLLQQQQ')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+ZIP_END = struct.Struct('<4sHHHHLLH')
+# Sizes and offsets from which the zip64 fields are used, 0xFFFFFFFF marks them
+ZIP64_LIMIT = 0xFFFFFFFF
+# Threads that copy the filestore when it is installed from another filesystem
+FILESTORE_COPY_JOBS = 8
+# Session settings of the psql connections of deferred restores, that load the data and
+# build the indexes and constraints (maintenance_work_mem is used by every connection)
+DEFERRED_SETTINGS = "SET synchronous_commit = off;\nSET maintenance_work_mem = '512MB';\n"
+# Sidecar file with the block and file positions of indexed backups
+INDEX_EXTENSION = '.idx'
+# Snapshot backups are folders with the compressed dump (SNAPSHOT_DUMP_NAME.tar.<ext>),
+# the filestore hard-linked to the previous snapshot and this information file
+SNAPSHOT_NAME = catalog.SNAPSHOT_NAME
+SNAPSHOT_DUMP_NAME = 'database_dump'
+# Delta backups store the plain dump as a zstd patch (DELTA_DUMP_NAME) against the dump of
+# the previous backup, the last dump of every database is kept in DELTA_BASE_NAME inside
+# the backup dir to make the next patch
+DELTA_BASE_NAME = 'dump_bases'
+DELTA_DUMP_NAME = 'database_dump.sql.delta'
+# zstd --patch-from needs a window as big as the dumps, 2GB at most (--long=31), bigger
+# dumps are backed up full
+DELTA_MAX_SIZE = 2 ** 31
+# Backups in a delta chain whatever full_every is, a restore rebuilds the whole chain
+DELTA_MAX_CHAIN = 30
+# Compression format: (file extension, magic bytes)
+COMPRESSION_FORMATS = {
+    'bz2': ('bz2', 'BZh'),
+    'gz': ('gz', '\x1f\x8b'),
+    'xz': ('xz', '\xfd7zXZ\x00'),
+    'zstd': ('zst', '\x28\xb5\x2f\xfd'),
+    'lz4': ('lz4', '\x04\x22\x4d\x18'),
+}
+
 
 def check_installation():
     """ This is a little helper that mus be executed before everything else just to check
@@ -97,16 +179,17 @@ def clean_files(files):
     Args:
         files (list): A list of absolute or relative paths thar will be erased
     """
-    items = files if hasattr(files, '__iter__') else [files]
-    for item in items:
-        fname = item[0] if hasattr(item, '__iter__') else item
-        if fname != "/":
-            if os.path.isfile(fname):
-                os.remove(fname)
-            elif os.path.isdir(fname):
-                shutil.rmtree(fname)
-        else:
-            logger.error("Invalid target path: '/'. Are you trying to delete your root path?")
+    with metrics.stage('cleanup'):
+        items = files if hasattr(files, '__iter__') else [files]
+        for item in items:
+            fname = item[0] if hasattr(item, '__iter__') else item
+            if fname != "/":
+                if os.path.isfile(fname):
+                    os.remove(fname)
+                elif os.path.isdir(fname):
+                    shutil.rmtree(fname)
+            else:
+                logger.error("Invalid target path: '/'. Are you trying to delete your root path?")
 
 
 def simplify_path(b_info):
@@ -157,7 +240,524 @@ def name_from_url(url):
     return name
 
 
-def compress_files(name, files, dest_folder=None, cformat='bz2'):
+def data_offset(tar_file, tarinfo):
+    """ Position of the data of the last member added to a tar file opened in write mode,
+        counted in the uncompressed stream
+
+    Args:
+        tar_file (TarFile): Tar file the member was just added to
+        tarinfo (TarInfo): The member
+    Returns:
+        The offset in bytes
+    """
+    blocks = (tarinfo.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+    return tar_file.offset - blocks * tarfile.BLOCKSIZE
+
+
+class HashingReader(object):
+    """ File like object that computes the SHA-256 and size of what is read from fileobj
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+def add_path(tar_file, path, arcname, manifest=None):
+    """ Add a file or a folder recursively to an open tar file like TarFile.add does,
+        but computing the checksum of every file while it is being added
+
+    Args:
+        tar_file (TarFile): Tar file opened in write mode
+        path (str): File or folder to add
+        arcname (str): Name of the member in the tar file
+        manifest (list): If set a dict with name, size and sha256 of every
+                         regular file is appended
+    """
+    tarinfo = tar_file.gettarinfo(path, arcname)
+    if tarinfo is None:
+        logger.warn('Skipping unsupported file type: %s', path)
+        return
+    if tarinfo.isreg():
+        with open(path, 'rb') as fin:
+            reader = HashingReader(fin)
+            tar_file.addfile(tarinfo, reader)
+        if manifest is not None:
+            manifest.append({'name': arcname, 'size': tarinfo.size,
+                             'sha256': reader.hexdigest(),
+                             'offset': data_offset(tar_file, tarinfo)})
+    elif tarinfo.isdir():
+        tar_file.addfile(tarinfo)
+        for fname in sorted(os.listdir(path)):
+            add_path(tar_file, os.path.join(path, fname), os.path.join(arcname, fname),
+                     manifest)
+    else:
+        tar_file.addfile(tarinfo)
+
+
+def read_full(stream, size):
+    """ Read size bytes from a stream, calling read as many times as needed because
+        sockets and some file like objects can return less data than requested
+
+    Args:
+        stream (file): File like object to read from
+        size (int): Number of bytes to read
+    Returns:
+        The data read, shorter than size only if the stream ended
+    """
+    res = []
+    missing = size
+    while missing > 0:
+        data = stream.read(missing)
+        if not data:
+            break
+        res.append(data)
+        missing -= len(data)
+    return ''.join(res)
+
+
+def add_stream(tar_file, stream, arcname, chunk_size=DUMP_CHUNK_SIZE, manifest=None):
+    """ Add the content of a stream (ie: a process stdout) to an open tar file without
+        knowing its size beforehand. The stream is split into numbered members
+        (arcname.00000, arcname.00001, ...) of at most chunk_size bytes, so only one
+        chunk is held in memory at a time and nothing is written to the temp dir.
+        The original file can be rebuilt with: cat arcname.* > arcname
+
+    Args:
+        tar_file (TarFile): Tar file opened in write mode
+        stream (file): File like object to read from
+        arcname (str): Name of the member in the tar file
+        chunk_size (int): Max size in bytes of every member
+        manifest (list): If set a dict with name, size and sha256 of every
+                         part is appended
+    Returns:
+        Total bytes added
+    """
+    total = 0
+    part = 0
+    while True:
+        data = read_full(stream, chunk_size)
+        if not data and part:
+            break
+        tarinfo = tarfile.TarInfo('{0}.{1:05d}'.format(arcname, part))
+        tarinfo.size = len(data)
+        tarinfo.mtime = time.time()
+        tar_file.addfile(tarinfo, StringIO(data))
+        if manifest is not None:
+            manifest.append({'name': tarinfo.name, 'size': tarinfo.size,
+                             'sha256': hashlib.sha256(data).hexdigest(),
+                             'offset': data_offset(tar_file, tarinfo)})
+        total += len(data)
+        part += 1
+        if len(data) < chunk_size:
+            break
+    logger.debug("Added %s bytes in %s parts as %s", total, part, arcname)
+    return total
+
+
+def add_tar(tar_file, stream, arcname, manifest=None):
+    """ Add the members of a tar stream (ie: the archive API of docker) to an open tar
+        file while it is read, the top folder of the members is renamed to arcname, so
+        nothing is written to disk
+
+    Args:
+        tar_file (TarFile): Tar file opened in write mode
+        stream (file): File like object with the tar data
+        arcname (str): Name of the top folder of the members in the tar file
+        manifest (list): If set a dict with name, size, sha256 and offset of every
+                         regular file is appended
+    """
+    src = tarfile.open(fileobj=stream, mode='r|')
+    try:
+        for tarinfo in src:
+            parts = tarinfo.name.split('/', 1)
+            tarinfo.name = os.path.join(arcname, *parts[1:])
+            tarinfo.pax_headers.pop('path', None)
+            if not tarinfo.isreg():
+                tar_file.addfile(tarinfo)
+                continue
+            reader = HashingReader(src.extractfile(tarinfo))
+            tar_file.addfile(tarinfo, reader)
+            if manifest is not None:
+                manifest.append({'name': tarinfo.name, 'size': tarinfo.size,
+                                 'sha256': reader.hexdigest(),
+                                 'offset': data_offset(tar_file, tarinfo)})
+    finally:
+        src.close()
+
+
+def join_dump_parts(folder, name):
+    """ Rebuild a file that was stored as several parts with add_stream
+
+    Args:
+        folder (str): Folder where the parts were extracted
+        name (str): Original file name w/o the part number
+    Returns:
+        The full path to the rebuilt file or None if there were no parts
+    """
+    parts = sorted(fname for fname in os.listdir(folder)
+                   if re.match(r'^{0}\.\d{{5}}$'.format(re.escape(name)), fname))
+    if not parts:
+        return None
+    full_name = os.path.join(folder, name)
+    logger.debug("Joining %s parts into %s", len(parts), full_name)
+    with open(full_name, 'wb') as fout:
+        for part in parts:
+            part_name = os.path.join(folder, part)
+            with open(part_name, 'rb') as fin:
+                shutil.copyfileobj(fin, fout, 1024 * 1024)
+            os.remove(part_name)
+    return full_name
+
+
+def compress_block(args):
+    """ Compress a block of data as an independent bz2 stream, gzip member or xz, zstd or
+        lz4 frame, it is a module level function so it can be used by a process pool
+
+    Args:
+        args (tuple): (data, cformat, level)
+    Returns:
+        The compressed block
+    """
+    data, cformat, level = args
+    if cformat == 'bz2':
+        return bz2.compress(data, level)
+    if cformat == 'gz':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    process = subprocess.Popen(compression_command(cformat, level), stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    return process.communicate(data)[0]
+
+
+def decompress_block(data, cformat):
+    """ Decompress a block compressed with compress_block
+
+    Args:
+        data (str): Compressed block
+        cformat (str): Compression format
+    Returns:
+        The decompressed block
+    """
+    if cformat == 'bz2':
+        return bz2.decompress(data)
+    if cformat == 'gz':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    process = subprocess.Popen(compression_command(cformat, decompress=True),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return process.communicate(data)[0]
+
+
+class ParallelCompressor(object):
+    """ File like object that compresses what is written on it using several processes
+        (pbzip2/pigz style). Data is split into blocks of block_size bytes that are
+        compressed independently and written in order, so the result is a multi stream
+        bz2 or multi member gzip file (or several xz, zstd or lz4 frames) that stock tools
+        can read. The position of every block is kept in frames, so a block can be
+        decompressed alone later.
+    """
+
+    def __init__(self, fileobj, cformat='bz2', jobs=None, block_size=COMPRESS_BLOCK_SIZE,
+                 level=9):
+        if cformat not in COMPRESSION_FORMATS:
+            raise RuntimeError('Unknown file format "{}"'.format(cformat))
+        self.fileobj = fileobj
+        self.cformat = cformat
+        self.level = level
+        self.block_size = block_size
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.jobs)
+        self.pending = deque()
+        self.buf = []
+        self.buf_size = 0
+        self.closed = False
+        # (uncompressed offset, uncompressed size, compressed offset, compressed size)
+        self.frames = []
+        self.offset = 0
+        self.compressed_offset = 0
+
+    def write(self, data):
+        """ Buffer data and send full blocks to the pool
+        """
+        self.buf.append(data)
+        self.buf_size += len(data)
+        if self.buf_size >= self.block_size:
+            data = ''.join(self.buf)
+            while len(data) >= self.block_size:
+                self._submit(data[:self.block_size])
+                data = data[self.block_size:]
+            self.buf = [data]
+            self.buf_size = len(data)
+
+    def _submit(self, block):
+        """ Send a block to the pool, waiting for the oldest one if there are
+            already enough blocks in flight to keep memory bounded
+        """
+        while len(self.pending) >= self.jobs * 2:
+            self._write_pending()
+        self.pending.append((self.pool.apply_async(compress_block,
+                                                   [(block, self.cformat, self.level)]),
+                             len(block)))
+
+    def _write_pending(self):
+        """ Wait for the oldest block and write it
+        """
+        result, size = self.pending.popleft()
+        data = result.get()
+        self.fileobj.write(data)
+        self.frames.append((self.offset, size, self.compressed_offset, len(data)))
+        self.offset += size
+        self.compressed_offset += len(data)
+
+    def close(self):
+        """ Compress the remaining data, write all the pending blocks and close the pool
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buf_size:
+                self._submit(''.join(self.buf))
+            self.buf = []
+            while self.pending:
+                self._write_pending()
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+
+
+class MultiStreamReader(object):
+    """ File like object that decompresses a file made of several concatenated bz2 streams
+        or gzip members, like the ones generated by ParallelCompressor, pbzip2 or pigz.
+        The bz2 module of python 2 stops after the first stream.
+    """
+
+    def __init__(self, fileobj, cformat='bz2', read_size=1024 * 1024):
+        self.fileobj = fileobj
+        self.cformat = cformat
+        self.read_size = read_size
+        self.decompressor = self._new_decompressor()
+        self.buf = ''
+        self.eof = False
+
+    def _new_decompressor(self):
+        if self.cformat == 'bz2':
+            return bz2.BZ2Decompressor()
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _decompress(self, data):
+        """ Decompress data, starting a new decompressor every time a stream ends
+        """
+        res = []
+        while data:
+            try:
+                res.append(self.decompressor.decompress(data))
+            except EOFError:
+                # bz2 raises EOFError if data is given once the stream has ended
+                self.decompressor = self._new_decompressor()
+                continue
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = self._new_decompressor()
+        return ''.join(res)
+
+    def read(self, size=-1):
+        """ Read up to size decompressed bytes, all of them if size is negative
+        """
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            data = self.fileobj.read(self.read_size)
+            if not data:
+                self.eof = True
+                break
+            self.buf += self._decompress(data)
+        if size < 0:
+            size = len(self.buf)
+        res, self.buf = self.buf[:size], self.buf[size:]
+        return res
+
+    def close(self):
+        self.fileobj.close()
+
+
+def compression_command(cformat, level=None, jobs=1, decompress=False):
+    """ Build the command line of the external tool used for the formats that are not
+        supported by the python standard library (xz, zstd and lz4)
+
+    Args:
+        cformat (str): Compression format
+        level (int): Compression level, the tool default is used if not set
+        jobs (int): Number of threads, only xz and zstd can use them
+        decompress (bool): Build the decompression command instead
+    Returns:
+        List with the command and its arguments
+    """
+    tool = {'xz': 'xz', 'zstd': 'zstd', 'lz4': 'lz4'}[cformat]
+    if decompress:
+        return [tool, '-d', '-c', '-q']
+    cmd = [tool, '-c', '-q']
+    if level is not None:
+        if cformat == 'zstd' and int(level) > 19:
+            cmd.append('--ultra')
+        cmd.append('-{0}'.format(int(level)))
+    if cformat in ['xz', 'zstd'] and jobs != 1:
+        cmd.append('-T{0}'.format(int(jobs)))
+    return cmd
+
+
+def is_os_file(fileobj):
+    """ True if fileobj is a file of the OS that can be given to a process
+    """
+    return isinstance(fileobj, file)
+
+
+def copy_thread(src, dest, close_dest=False):
+    """ Start a thread that copies src into dest, used to connect processes
+        with file like objects that are not OS files
+    """
+    def copy():
+        shutil.copyfileobj(src, dest, 1024 * 1024)
+        if close_dest:
+            dest.close()
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class PipeCompressor(object):
+    """ File like object that compresses what is written on it using an external tool,
+        the result is written into fileobj
+    """
+
+    def __init__(self, fileobj, cformat, level=None, jobs=1):
+        cmd = compression_command(cformat, level, jobs)
+        self.thread = None
+        try:
+            self.process = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE,
+                stdout=fileobj if is_os_file(fileobj) else subprocess.PIPE)
+        except OSError:
+            raise RuntimeError('Could not run "{0}", is it installed?'.format(cmd[0]))
+        if not is_os_file(fileobj):
+            self.thread = copy_thread(self.process.stdout, fileobj)
+        self.cmd = cmd
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        """ Close the tool input and wait for it to finish
+        """
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.thread:
+            self.thread.join()
+        if self.process.wait():
+            raise RuntimeError('"{0}" returned {1}'.format(' '.join(self.cmd),
+                                                          self.process.returncode))
+
+
+class PipeDecompressor(object):
+    """ File like object that returns the content of fileobj decompressed with an external tool
+    """
+
+    def __init__(self, fileobj, cformat):
+        cmd = compression_command(cformat, decompress=True)
+        try:
+            self.process = subprocess.Popen(
+                cmd, stdin=fileobj if is_os_file(fileobj) else subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        except OSError:
+            raise RuntimeError('Could not run "{0}", is it installed?'.format(cmd[0]))
+        if not is_os_file(fileobj):
+            copy_thread(fileobj, self.process.stdin, close_dest=True)
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        self.process.stdout.close()
+        self.process.wait()
+        self.fileobj.close()
+
+
+def detect_format(name, header=None):
+    """ Detect the compression format of a file using its magic bytes,
+        so files are recognized even if they were renamed
+
+    Args:
+        name (str): File name
+        header (str): First bytes of the file, read from name if not given
+    Returns:
+        The compression format (one of COMPRESSION_FORMATS keys)
+    """
+    if header is None:
+        with open(name, 'rb') as fin:
+            header = fin.read(8)
+    for cformat, (_, magic) in COMPRESSION_FORMATS.items():
+        if header.startswith(magic):
+            return cformat
+    raise RuntimeError('Unknown file format "{}"'.format(name))
+
+
+class PrefixedReader(object):
+    """ File like object that returns prefix and then the content of fileobj, used to
+        give back the bytes read from a stream to detect its format
+    """
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size < 0:
+            res, self.prefix = self.prefix + self.fileobj.read(), ''
+            return res
+        res, self.prefix = self.prefix[:size], self.prefix[size:]
+        return res
+
+    def close(self):
+        self.fileobj.close()
+
+
+def open_compressed(name, cformat=None):
+    """ Open a compressed file for reading returning a file like object with its
+        decompressed content
+
+    Args:
+        name (str): File name or object storage url, objects are streamed
+        cformat (str): Compression format, detected from the file content if not set
+    """
+    fin = storage.open_url(name)
+    if not cformat:
+        header = fin.read(8)
+        cformat = detect_format(name, header)
+        if is_os_file(fin):
+            fin.seek(0)
+        else:
+            fin = PrefixedReader(header, fin)
+    if cformat in ['bz2', 'gz']:
+        return MultiStreamReader(fin, cformat)
+    return PipeDecompressor(fin, cformat)
+
+
+def compress_files(name, files, dest_folder=None, cformat='bz2', streams=None, jobs=1,
+                   level=None, info=None, index=False, zips=None, throttle=None,
+                   archives=None):
     """ Compress a file, set of files or a folder in tar.bz2 format
 
     Args:
@@ -165,70 +765,928 @@ def compress_files(name, files, dest_folder=None, cformat='bz2'):
         files (list): A list with the absolute o relative path to the files
                       that will be added to the compressed file
         dest_folder (str): The folder where will be stored the compressed file
+        cformat (str): Compression format, one of COMPRESSION_FORMATS
+        streams (list): Optional list of (file object, name) tuples whose content
+                        is added with add_stream before the files
+        jobs (int): Number of processes used to compress, if greater than 1
+                    ParallelCompressor is used for bz2 and gz, xz and zstd use threads
+        level (int): Compression level, the format default is used if not set
+        info (dict): Extra information saved in the manifest (database, dump format, ...)
+        index (bool): If True the file is written as independent compressed blocks
+                      (ParallelCompressor) and a sidecar index file (INDEX_EXTENSION)
+                      with the position of every block and file is saved next to it,
+                      so single files can be extracted with extract_indexed
+        zips (list): Optional list of zip files generated by the Odoo database manager,
+                     their members are added with add_zip, or of file like objects
+                     with one (ie: a response of dump_database_http), read as a
+                     stream with add_zip_stream
+        throttle (Throttle): Optional throttle.Throttle that limits the bytes read and
+                             written per second
+        archives (list): Optional list of (tar stream, name) tuples, their members are
+                         added with add_tar into the name folder
+
+    dest_folder can be an object storage url (s3://bucket/prefix), the file is uploaded
+    while it is being compressed and its url is returned
+
+    The last member of the file is MANIFEST_NAME, with the host, creation date, info and
+    the size, SHA-256 and offset of every file, computed while they are being compressed
     """
     if not dest_folder:
         dest_folder = '.'
-    if cformat not in ['bz2', 'gz']:
+    if cformat not in COMPRESSION_FORMATS:
         raise RuntimeError('Unknown file format "{}"'.format(cformat))
-    if cformat == 'gz':
-        fobject, modestr = tarfile.open, 'w:gz'
-    elif cformat == 'bz2':
-        fobject, modestr = tarfile.open, 'w:bz2'
     logger.debug("Generating compressed file: %s in %s folder", name, dest_folder)
 
-    bkp_name = '{0}.tar.{1}'.format(name, cformat)
-    full_name = os.path.join(dest_folder, bkp_name)
+    bkp_name = '{0}.tar.{1}'.format(name, COMPRESSION_FORMATS[cformat][0])
+    target = storage.get_storage(dest_folder)
+    full_name = target.url(bkp_name) if target else os.path.join(dest_folder, bkp_name)
 
-    with fobject(full_name, mode=modestr) as tar_file:
-        for fname in files:
-            if hasattr(fname, '__iter__'):
-                tar_file.add(fname[0], os.path.join(name, fname[1]))
-            else:
-                tar_file.add(fname, os.path.join(name, os.path.basename(fname)))
+    fout = compressor = None
+    if cformat in ['bz2', 'gz'] and jobs <= 1 and not index and not target:
+        tar_file = tarfile.open(full_name, mode='w:{0}'.format(cformat),
+                                compresslevel=level or 9)
+    else:
+        fout = target.open_write(bkp_name) if target else open(full_name, 'wb')
+        if index and cformat not in ['bz2', 'gz']:
+            logger.debug("Compressing indexed blocks with %s processes", jobs)
+            compressor = ParallelCompressor(fout, cformat, jobs, level=level)
+        elif cformat in ['bz2', 'gz']:
+            logger.debug("Compressing with %s processes", jobs)
+            compressor = ParallelCompressor(fout, cformat, jobs, level=level or 9)
+        else:
+            compressor = PipeCompressor(fout, cformat, level, jobs)
+        tar_file = tarfile.open(fileobj=compressor, mode='w|')
+    if throttle:
+        throttle.start((lambda: fout.tell()) if target else
+                       (lambda: os.path.getsize(full_name)))
+        tar_file.fileobj = throttle.wrap(tar_file.fileobj)
+    manifest = dict(info or {})
+    manifest.update({
+        'host': socket.gethostname(),
+        'created': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'compression': cformat,
+        'files': [],
+    })
+    with metrics.stage('compress') as stage:
+        try:
+            for stream, arcname in streams or []:
+                add_stream(tar_file, stream, os.path.join(name, arcname),
+                           manifest=manifest['files'])
+            for fname in files:
+                if hasattr(fname, '__iter__'):
+                    add_path(tar_file, fname[0], os.path.join(name, fname[1]), manifest['files'])
+                else:
+                    add_path(tar_file, fname, os.path.join(name, os.path.basename(fname)),
+                             manifest['files'])
+            for stream, arcname in archives or []:
+                add_tar(tar_file, stream, os.path.join(name, arcname), manifest['files'])
+            for zip_name in zips or []:
+                if hasattr(zip_name, 'read'):
+                    add_zip_stream(tar_file, zip_name, name, manifest['files'])
+                else:
+                    add_zip(tar_file, zip_name, name, manifest['files'])
+            manifest_data = json.dumps(manifest, sort_keys=True, indent=4)
+            tarinfo = tarfile.TarInfo(os.path.join(name, MANIFEST_NAME))
+            tarinfo.size = len(manifest_data)
+            tarinfo.mtime = time.time()
+            tar_file.addfile(tarinfo, StringIO(manifest_data))
+            manifest_offset = data_offset(tar_file, tarinfo)
+        except BaseException:
+            if target:
+                # do not leave half backups in the bucket
+                fout.abort()
+            raise
+        finally:
+            tar_file.close()
+            if compressor:
+                compressor.close()
+                fout.close()
+        stage['bytes_in'] = sum(item['size'] for item in manifest['files'])
+        stage['bytes_out'] = fout.tell() if target else os.path.getsize(full_name)
+    if index:
+        index_info = {
+            'compression': cformat,
+            'frames': compressor.frames,
+            'manifest': [tarinfo.name, tarinfo.size, manifest_offset],
+            'files': [[item['name'], item['size'], item['offset']]
+                      for item in manifest['files']],
+        }
+        if target:
+            target.put(bkp_name + INDEX_EXTENSION, json.dumps(index_info))
+        else:
+            save_json(index_info, full_name + INDEX_EXTENSION)
     return full_name
 
 
-def decompress_files(name, dest_folder):
-    """ Decompress a file, set of files or a folder compressed in tar.bz2 format
+def decompress_files(name, dest_folder, filestore_folder=None):
+    """ Decompress a file, set of files or a folder compressed in any of
+        COMPRESSION_FORMATS, the format is detected from the file content
 
     Args:
-        name (str): Compressed file name
+        name (str): Compressed file name or object storage url (s3://bucket/key)
         dest_folder (str): Folder where the compressed file will be stored
+        filestore_folder (str): Optional folder where the filestore members are extracted
+                                instead, ie: a staging folder in the filesystem of the
+                                instance (see install_filestore)
     Returns:
         The absolute path to decompressed folder or file
     """
     logger.debug("Decompressing file: %s", name)
-    if name.endswith('tar.gz'):
-        fobject, modestr = tarfile.open, 'r:gz'
-    elif name.endswith('tar.bz2'):
-        fobject, modestr = tarfile.open, 'r:bz2'
-    else:
-        raise RuntimeError('Unknown file format "{}"'.format(name))
-    tar = fobject(name, mode=modestr)
-    try:
-        tar.extractall(dest_folder)
-    except IOError as error:
-        logger.error("I/O ERROR: %s", error.strerror)
-        clean_files([dest_folder])
-        raise
-    name_list = tar.getmembers()
-    tar.close()
+    with metrics.stage('extract') as stage:
+        reader = open_compressed(name)
+        tar = tarfile.open(fileobj=reader, mode='r|')
+        try:
+            if filestore_folder:
+                for member in tar:
+                    rel_name = member.name.partition('/')[2]
+                    if rel_name == 'filestore' or rel_name.startswith('filestore/'):
+                        member.name = rel_name[len('filestore/'):]
+                        if member.name:
+                            tar.extract(member, filestore_folder)
+                    else:
+                        tar.extract(member, dest_folder)
+            else:
+                tar.extractall(dest_folder)
+        except IOError as error:
+            logger.error("I/O ERROR: %s", error.strerror)
+            clean_files([dest_folder] + ([filestore_folder] if filestore_folder else []))
+            raise
+        name_list = tar.getmembers()
+        tar.close()
+        reader.close()
+        stage['bytes_in'] = storage.size_of(name)
+        stage['bytes_out'] = sum(member.size for member in name_list)
     base_folder = None
     for fname in name_list:
         if os.path.basename(fname.name) == 'database_dump.b64' or \
-           os.path.basename(fname.name) == 'database_dump.sql':
+           os.path.basename(fname.name) == 'database_dump.sql' or \
+           os.path.basename(fname.name) == 'database_dump.dump' or \
+           os.path.basename(fname.name) == DELTA_DUMP_NAME or \
+           re.match(r'^database_dump\.zip(\.\d{5})?$', os.path.basename(fname.name)) or \
+           (os.path.basename(fname.name) == 'database_dump' and fname.isdir()) or \
+           re.match(r'^database_dump\.(sql|dump)\.\d{5}$', os.path.basename(fname.name)):
             base_folder = os.path.dirname(fname.name)
             break
 
     logger.debug("Destination folder: %s", dest_folder)
     logger.debug("Bakcup folder: %s", base_folder)
-    if name.endswith('tar.bz2') or name.endswith('tar.gz'):
-        fname = os.path.basename(name)
+    if base_folder:
         dest_folder = os.path.join(dest_folder, base_folder)
     logger.debug("Destination folder: %s", dest_folder)
+    join_dump_parts(dest_folder, 'database_dump.sql')
+    join_dump_parts(dest_folder, 'database_dump.dump')
+    join_dump_parts(dest_folder, WS_ZIP_NAME)
     return dest_folder
 
 
+def read_indexed(fin, index, offset, size, cache=None):
+    """ Read a range of the uncompressed stream of an indexed backup decompressing
+        only the blocks that contain it
+
+    Args:
+        fin (file): Backup file opened for reading
+        index (dict): Index of the backup
+        offset (int): Position in the uncompressed stream
+        size (int): Number of bytes to read
+        cache (dict): Optional dict used to keep the last decompressed block
+    Returns:
+        The data read
+    """
+    if cache is None:
+        cache = {}
+    if 'starts' not in cache:
+        cache['starts'] = [frame[0] for frame in index['frames']]
+    starts = cache['starts']
+    res = []
+    end = offset + size
+    pos = max(bisect.bisect_right(starts, offset) - 1, 0)
+    while offset < end and pos < len(index['frames']):
+        uoffset, usize, coffset, csize = index['frames'][pos]
+        if cache.get('pos') != pos:
+            fin.seek(coffset)
+            cache.update({'pos': pos,
+                          'data': decompress_block(fin.read(csize), index['compression'])})
+        data = cache['data'][offset - uoffset:min(end, uoffset + usize) - uoffset]
+        res.append(data)
+        offset += len(data)
+        pos += 1
+    return ''.join(res)
+
+
+def extract_indexed(name, dest_folder, members=None):
+    """ Extract some files of an indexed backup without decompressing the whole file.
+        Dumps stored in parts are joined back
+
+    Args:
+        name (str): Backup file name, its index must be next to it
+        dest_folder (str): Folder where the files will be extracted
+        members (list): Names of the files or folders to extract, relative to the backup
+                        folder (ie: database_dump.sql, filestore or filestore/ab/abcd...).
+                        Everything is extracted if not set
+    Returns:
+        The list of extracted files
+    """
+    index = load_json(name + INDEX_EXTENSION)
+    res = []
+    cache = {}
+    with open(name, 'rb') as fin:
+        for fname, size, offset in index['files'] + [index['manifest']]:
+            rel_name = fname.split('/', 1)[1]
+            if members and not any(rel_name == item or rel_name.startswith(item + '/') or
+                                   re.match(r'^{0}\.\d{{5}}$'.format(re.escape(item)),
+                                            rel_name)
+                                   for item in members):
+                continue
+            dest_name = os.path.join(dest_folder, fname)
+            if not os.path.isdir(os.path.dirname(dest_name)):
+                os.makedirs(os.path.dirname(dest_name))
+            logger.debug("Extracting %s", fname)
+            with open(dest_name, 'wb') as fout:
+                while size > 0:
+                    data = read_indexed(fin, index, offset, min(size, COMPRESS_BLOCK_SIZE),
+                                        cache)
+                    if not data:
+                        raise RuntimeError('Index of "{0}" does not match the file'.format(name))
+                    fout.write(data)
+                    offset += len(data)
+                    size -= len(data)
+            res.append(dest_name)
+    for folder in set(os.path.dirname(fname) for fname in res):
+        join_dump_parts(folder, DUMP_FORMATS['plain'][1])
+        join_dump_parts(folder, DUMP_FORMATS['custom'][1])
+        join_dump_parts(folder, WS_ZIP_NAME)
+    return res
+
+
+def verify_archive(name):
+    """ Check a backup against its manifest, every member is decompressed and hashed in
+        memory, nothing is written to disk
+
+    Args:
+        name (str): Backup file name
+    Returns:
+        Tuple (backup file name, list of errors found), the backup is fine if the list is empty
+    """
+    logger.debug("Verifying %s", name)
+    errors = []
+    found = {}
+    manifest = None
+    try:
+        reader = open_compressed(name)
+        tar = tarfile.open(fileobj=reader, mode='r|')
+        for member in tar:
+            if os.path.basename(member.name) == MANIFEST_NAME:
+                manifest = json.loads(tar.extractfile(member).read())
+            elif member.isreg():
+                hreader = HashingReader(tar.extractfile(member))
+                for _ in iter(lambda: hreader.read(1024 * 1024), ''):
+                    pass
+                found[member.name] = (hreader.size, hreader.hexdigest())
+        tar.close()
+        reader.close()
+    except (IOError, EOFError, zlib.error, tarfile.TarError, RuntimeError, ValueError) as error:
+        errors.append('Could not read the file: {0}'.format(error))
+        return name, errors
+    if manifest is None:
+        errors.append('There is no manifest')
+        return name, errors
+    for item in manifest.get('files', []):
+        if item['name'] not in found:
+            errors.append('Missing {0}'.format(item['name']))
+        elif found[item['name']] != (item['size'], item['sha256']):
+            errors.append('Checksum mismatch in {0}'.format(item['name']))
+    return name, errors
+
+
+def verify_archives(names, jobs=None):
+    """ Check several backups in parallel with verify_archive
+
+    Args:
+        names (list): Backup file names
+        jobs (int): Number of processes, one per cpu by default
+    Returns:
+        Dict with the file names as keys and the list of errors found as value
+    """
+    res = {}
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+    try:
+        for name, errors in pool.imap_unordered(verify_archive, names):
+            if errors:
+                logger.error("%s is corrupt: %s", name, '; '.join(errors))
+            else:
+                logger.info("%s is ok", name)
+            res[name] = errors
+    finally:
+        pool.close()
+        pool.join()
+    return res
+
+
+class Base64Reader(object):
+    """ File like object that decodes the base64 text read from fileobj by fixed size
+        chunks, line breaks are ignored and it does not matter if the text is a single
+        line, so memory usage does not depend on the file size
+    """
+
+    def __init__(self, fileobj, read_size=1024 * 1024):
+        self.fileobj = fileobj
+        self.read_size = read_size - read_size % 4
+        self.pending = ''
+        self.buf = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        """ Read up to size decoded bytes, all of them if size is negative
+        """
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            data = self.fileobj.read(self.read_size)
+            if not data:
+                self.eof = True
+                data = self.pending
+                self.pending = ''
+            else:
+                data = self.pending + ''.join(data.split())
+                cut = len(data) - len(data) % 4
+                data, self.pending = data[:cut], data[cut:]
+            self.buf += base64.b64decode(data)
+        if size < 0:
+            size = len(self.buf)
+        res, self.buf = self.buf[:size], self.buf[size:]
+        return res
+
+    def close(self):
+        self.fileobj.close()
+
+
+class ZipStreamReader(object):
+    """ Reads the members of a zip sequentially from its local file headers, without
+        seeking to the central directory, so a zip can be read while it is decoded or
+        downloaded. Stored and deflated members, zip64 sizes and deflated members
+        followed by a data descriptor are supported, the CRC of every member is checked
+
+    Iterating it gives (name, size, reader) tuples, size is None if it is only known
+    at the end (data descriptor), the reader must be used before going to the next
+    member and what is not read is skipped
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pending = ''
+        self.member = None
+
+    def read_raw(self, size):
+        res = self.pending[:size]
+        self.pending = self.pending[size:]
+        while len(res) < size:
+            data = self.fileobj.read(size - len(res))
+            if not data:
+                break
+            res += data
+        return res
+
+    def unread(self, data):
+        self.pending = data + self.pending
+
+    def __iter__(self):
+        while True:
+            if self.member:
+                self.member.skip()
+            header = self.read_raw(ZIP_LOCAL_HEADER.size)
+            if header[:4] != 'PK\x03\x04':
+                # central directory, nothing else to read
+                return
+            if len(header) < ZIP_LOCAL_HEADER.size:
+                raise RuntimeError('The zip file is truncated')
+            (_, _, flags, method, _, _, crc, csize, usize, name_len,
+             extra_len) = ZIP_LOCAL_HEADER.unpack(header)
+            name = self.read_raw(name_len)
+            extra = self.read_raw(extra_len)
+            zip64 = False
+            pos = 0
+            while pos + 4 <= len(extra):
+                tag, length = struct.unpack('<HH', extra[pos:pos + 4])
+                if tag == 1:
+                    zip64 = True
+                    values = list(struct.unpack('<{0}Q'.format(length // 8),
+                                                extra[pos + 4:pos + 4 + length - length % 8]))
+                    if usize == 0xFFFFFFFF and values:
+                        usize = values.pop(0)
+                    if csize == 0xFFFFFFFF and values:
+                        csize = values.pop(0)
+                pos += 4 + length
+            if flags & 0x1:
+                raise RuntimeError('Encrypted zip member {0}'.format(name))
+            if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                raise RuntimeError('Unsupported compression of zip member {0}'.format(name))
+            if flags & 0x8:
+                csize = usize = crc = None
+                if method == zipfile.ZIP_STORED:
+                    # only empty ones, as streaming zip tools write them, can be read
+                    peek = self.read_raw(4)
+                    self.unread(peek)
+                    if peek != 'PK\x07\x08':
+                        raise RuntimeError('Stored zip member {0} with a data descriptor can'
+                                           ' not be read as a stream'.format(name))
+                    csize = 0
+            self.member = ZipMemberReader(self, name, method, csize, usize, crc, zip64)
+            yield name, usize, self.member
+
+
+class ZipMemberReader(object):
+    """ File like object with the content of a member of a ZipStreamReader, decompressed
+        by chunks of at most ZIP_READ_SIZE bytes
+    """
+
+    def __init__(self, stream, name, method, csize, usize, crc, zip64=False):
+        self.stream = stream
+        self.name = name
+        # compressed bytes left, None if the end is only known when it is reached
+        self.remaining = csize
+        self.usize = usize
+        self.expected_crc = crc
+        self.zip64 = zip64
+        self.decompressor = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+        self.buf = ''
+        self.crc = 0
+        self.size = 0
+        self.done = False
+
+    def _read_compressed(self):
+        if self.remaining is None:
+            return self.stream.read_raw(ZIP_READ_SIZE)
+        data = self.stream.read_raw(min(self.remaining, ZIP_READ_SIZE))
+        self.remaining -= len(data)
+        return data
+
+    def _fill(self):
+        if self.decompressor:
+            data = self.decompressor.unconsumed_tail
+            if not data and self.remaining != 0:
+                data = self._read_compressed()
+                if not data:
+                    raise RuntimeError('Zip member {0} is truncated'.format(self.name))
+            try:
+                out = self.decompressor.decompress(data, ZIP_READ_SIZE)
+            except zlib.error as error:
+                raise RuntimeError('Zip member {0} is corrupt: {1}'.format(self.name, error))
+            ended = bool(self.decompressor.unused_data) or \
+                (self.remaining == 0 and not self.decompressor.unconsumed_tail)
+            if ended:
+                out += self.decompressor.flush()
+                self.stream.unread(self.decompressor.unused_data)
+        else:
+            out = self._read_compressed()
+            if not out and self.remaining:
+                raise RuntimeError('Zip member {0} is truncated'.format(self.name))
+            ended = self.remaining == 0
+        self.crc = zlib.crc32(out, self.crc)
+        self.size += len(out)
+        self.buf += out
+        if ended:
+            self._finish()
+
+    def _finish(self):
+        self.done = True
+        if self.expected_crc is None:
+            descriptor = self.stream.read_raw(4)
+            if descriptor == 'PK\x07\x08':
+                descriptor = self.stream.read_raw(4)
+            self.expected_crc = struct.unpack('<L', descriptor)[0]
+            sizes = self.stream.read_raw(16 if self.zip64 else 8)
+            self.usize = struct.unpack('<QQ' if self.zip64 else '<LL', sizes)[1]
+        if self.crc & 0xFFFFFFFF != self.expected_crc or self.size != self.usize:
+            raise RuntimeError('Zip member {0} is corrupt'.format(self.name))
+
+    def read(self, size=-1):
+        """ Read up to size bytes, all of them if size is negative
+        """
+        while not self.done and (size < 0 or len(self.buf) < size):
+            self._fill()
+        if size < 0:
+            size = len(self.buf)
+        res, self.buf = self.buf[:size], self.buf[size:]
+        return res
+
+    def skip(self):
+        """ Read and discard the rest of the member
+        """
+        while not self.done:
+            self._fill()
+            self.buf = ''
+        self.buf = ''
+
+
+def add_zip(tar_file, zip_name, arcname, manifest=None):
+    """ Add the members of a zip generated by the Odoo database manager to an open tar file,
+        renamed according WS_ZIP_MEMBERS, so the backup has the same layout than the ones
+        made with pg_dump (database_dump.sql and filestore)
+
+    Args:
+        tar_file (TarFile): Tar file opened in write mode
+        zip_name (str): Zip file name
+        arcname (str): Folder inside the tar file where the members are added
+        manifest (list): If set a dict with name, size, sha256 and offset of every
+                         member is appended
+    """
+    zfile = zipfile.ZipFile(zip_name)
+    try:
+        for zinfo in zfile.infolist():
+            if zinfo.filename.endswith('/'):
+                continue
+            tarinfo = tarfile.TarInfo(os.path.join(
+                arcname, WS_ZIP_MEMBERS.get(zinfo.filename, zinfo.filename)))
+            tarinfo.size = zinfo.file_size
+            tarinfo.mtime = time.mktime(zinfo.date_time + (0, 0, -1))
+            reader = HashingReader(zfile.open(zinfo))
+            tar_file.addfile(tarinfo, reader)
+            if manifest is not None:
+                manifest.append({'name': tarinfo.name, 'size': tarinfo.size,
+                                 'sha256': reader.hexdigest(),
+                                 'offset': data_offset(tar_file, tarinfo)})
+    finally:
+        zfile.close()
+
+
+def add_zip_stream(tar_file, stream, arcname, manifest=None):
+    """ Add the members of a zip generated by the Odoo database manager to an open tar
+        file while the zip is read from a stream (ie: downloaded), renamed like add_zip
+        does. The tar header needs the size of the member, the few members whose size
+        is only known at the end (data descriptor) are spooled into a temp file
+
+    Args:
+        tar_file (TarFile): Tar file opened in write mode
+        stream (file): File like object with the zip
+        arcname (str): Folder inside the tar file where the members are added
+        manifest (list): If set a dict with name, size, sha256 and offset of every
+                         member is appended
+    """
+    for name, size, member in ZipStreamReader(stream):
+        if name.endswith('/'):
+            continue
+        tarinfo = tarfile.TarInfo(os.path.join(arcname, WS_ZIP_MEMBERS.get(name, name)))
+        tarinfo.mtime = time.time()
+        spool = None
+        if size is None:
+            spool = TemporaryFile()
+            shutil.copyfileobj(member, spool, ZIP_READ_SIZE)
+            size = spool.tell()
+            spool.seek(0)
+        tarinfo.size = size
+        reader = HashingReader(spool or member)
+        try:
+            tar_file.addfile(tarinfo, reader)
+        finally:
+            if spool:
+                spool.close()
+        if manifest is not None:
+            manifest.append({'name': tarinfo.name, 'size': tarinfo.size,
+                             'sha256': reader.hexdigest(),
+                             'offset': data_offset(tar_file, tarinfo)})
+
+
+def build_odoo_zip(folder, zip_name):
+    """ Build a zip like the ones generated by the Odoo database manager from an
+        extracted backup with database_dump.sql and filestore, so it can be restored
+        through the database manager
+
+    Args:
+        folder (str): Extracted backup folder
+        zip_name (str): Zip file to create, or a file like object to write it into
+    Returns:
+        The zip file name
+    """
+    logger.debug("Building %s from %s", zip_name, folder)
+    names = dict((value, key) for key, value in WS_ZIP_MEMBERS.items())
+    with zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_STORED, allowZip64=True) as zfile:
+        for fname in names:
+            if os.path.exists(os.path.join(folder, fname)):
+                zfile.write(os.path.join(folder, fname), names[fname])
+        filestore = os.path.join(folder, 'filestore')
+        for root, _, fnames in os.walk(filestore):
+            for fname in fnames:
+                full_name = os.path.join(root, fname)
+                zfile.write(full_name, os.path.relpath(full_name, folder))
+    return zip_name
+
+
+def zip_dos_time(timestamp):
+    """ Time and date fields of a zip header for a timestamp
+    """
+    local = time.localtime(timestamp)
+    if local.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((local.tm_hour << 11) | (local.tm_min << 5) | (local.tm_sec // 2),
+            ((local.tm_year - 1980) << 9) | (local.tm_mon << 5) | local.tm_mday)
+
+
+def zip_flags(name):
+    """ General purpose flags of a zip member, bit 11 means utf-8 name
+    """
+    try:
+        name.decode('ascii')
+    except UnicodeDecodeError:
+        return 0x800
+    return 0
+
+
+def zip_local_header(entry):
+    """ Local file header of a stored zip member, with a zip64 extra field if it is
+        too big for the 32 bits sizes
+
+    Args:
+        entry (dict): name, size, crc and mtime of the member
+    Returns:
+        The header
+    """
+    size = entry['size']
+    extra = ''
+    if size >= ZIP64_LIMIT:
+        extra = struct.pack('<HHQQ', 1, 16, size, size)
+        size = 0xFFFFFFFF
+    dos_time, dos_date = zip_dos_time(entry['mtime'])
+    return ZIP_LOCAL_HEADER.pack('PK\x03\x04', 45 if extra else 20, zip_flags(entry['name']),
+                                 zipfile.ZIP_STORED, dos_time, dos_date, entry['crc'], size,
+                                 size, len(entry['name']), len(extra)) + entry['name'] + extra
+
+
+def zip_central_header(entry):
+    """ Central directory header of a stored zip member, the sizes and offset that do
+        not fit in 32 bits go to a zip64 extra field
+
+    Args:
+        entry (dict): name, size, crc, mtime and offset of the member
+    Returns:
+        The header
+    """
+    size = entry['size']
+    offset = entry['offset']
+    values = []
+    if size >= ZIP64_LIMIT:
+        values += [size, size]
+        size = 0xFFFFFFFF
+    if offset >= ZIP64_LIMIT:
+        values.append(offset)
+        offset = 0xFFFFFFFF
+    extra = ''
+    if values:
+        extra = struct.pack('<HH{0}Q'.format(len(values)), 1, 8 * len(values), *values)
+    dos_time, dos_date = zip_dos_time(entry['mtime'])
+    return ZIP_CENTRAL_HEADER.pack('PK\x01\x02', (3 << 8) | 45, 45 if extra else 20,
+                                   zip_flags(entry['name']), zipfile.ZIP_STORED, dos_time,
+                                   dos_date, entry['crc'], size, size, len(entry['name']),
+                                   len(extra), 0, 0, 0, 0o100644 << 16,
+                                   offset) + entry['name'] + extra
+
+
+def zip_end_records(count, cd_offset, cd_size):
+    """ End of central directory record, preceded by the zip64 ones if there are too
+        many members or the zip is too big for it
+
+    Args:
+        count (int): Number of members
+        cd_offset (int): Position of the central directory
+        cd_size (int): Size of the central directory
+    Returns:
+        The records
+    """
+    res = ''
+    if count >= 0xFFFF or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+        res = ZIP64_END.pack('PK\x06\x06', ZIP64_END.size - 12, (3 << 8) | 45, 45, 0, 0,
+                             count, count, cd_size, cd_offset)
+        res += ZIP64_LOCATOR.pack('PK\x06\x07', 0, cd_offset + cd_size, 1)
+        count = min(count, 0xFFFF)
+        cd_offset = min(cd_offset, 0xFFFFFFFF)
+        cd_size = min(cd_size, 0xFFFFFFFF)
+    return res + ZIP_END.pack('PK\x05\x06', 0, 0, count, count, cd_size, cd_offset, 0)
+
+
+def scan_odoo_upload(backup):
+    """ Read a backup once to know what restore_database_stream uploads to the database
+        manager and its exact size, which the Content-Length of the upload needs before
+        the first byte is sent:
+
+        zip: the Odoo zip (database_dump.zip, or its parts in stream backups), the scan
+             stops at the header of a database_dump.zip member
+        b64: the zip decoded from database_dump.b64
+        members: a stored zip built from the decoded members (database_dump.sql and
+                 filestore), the CRC of every member is computed here
+
+    Everything but the first case decompresses the backup one more time, nothing is
+    written to disk
+
+    Args:
+        backup (str): Backup file name or object storage url
+    Returns:
+        dict with the kind, the size of the upload and, for members, the zip entries
+    """
+    zip_member = re.compile(r'^{0}(\.\d{{5}})?$'.format(re.escape(WS_ZIP_NAME)))
+    sql_member = re.compile(r'^{0}(\.\d{{5}})?$'.format(re.escape(DUMP_FORMATS['plain'][1])))
+    names = dict((value, key) for key, value in WS_ZIP_MEMBERS.items())
+    plan = {'kind': None, 'size': 0, 'entries': []}
+    with metrics.stage('scan') as stage:
+        reader = open_compressed(backup)
+        tar = tarfile.open(fileobj=reader, mode='r|')
+        try:
+            for member in tar:
+                rel_name = member.name.partition('/')[2]
+                if not member.isreg():
+                    continue
+                if zip_member.match(rel_name):
+                    plan['kind'] = 'zip'
+                    plan['size'] += member.size
+                    if rel_name == WS_ZIP_NAME:
+                        break
+                elif rel_name == 'database_dump.b64':
+                    plan['kind'] = 'b64'
+                    decoded = Base64Reader(tar.extractfile(member))
+                    for data in iter(lambda: decoded.read(ZIP_READ_SIZE), ''):
+                        plan['size'] += len(data)
+                    break
+                elif sql_member.match(rel_name) or rel_name in names or \
+                        rel_name.startswith('filestore/'):
+                    name = names[DUMP_FORMATS['plain'][1]] if sql_member.match(rel_name) \
+                        else names.get(rel_name, rel_name)
+                    if not plan['entries'] or plan['entries'][-1]['name'] != name:
+                        plan['entries'].append({'name': name, 'size': 0, 'crc': 0,
+                                                'mtime': member.mtime, 'members': []})
+                    entry = plan['entries'][-1]
+                    fin = tar.extractfile(member)
+                    for data in iter(lambda: fin.read(ZIP_READ_SIZE), ''):
+                        entry['crc'] = zlib.crc32(data, entry['crc'])
+                    entry['size'] += member.size
+                    entry['members'].append(rel_name)
+        finally:
+            tar.close()
+            reader.close()
+        if plan['kind'] is None and names[DUMP_FORMATS['plain'][1]] in \
+                [entry['name'] for entry in plan['entries']]:
+            plan['kind'] = 'members'
+            offset = 0
+            for entry in plan['entries']:
+                entry['crc'] &= 0xFFFFFFFF
+                entry['offset'] = offset
+                offset += len(zip_local_header(entry)) + entry['size']
+            plan['cd_offset'] = offset
+            plan['cd_size'] = sum(len(zip_central_header(entry)) for entry in plan['entries'])
+            plan['size'] = offset + plan['cd_size'] + \
+                len(zip_end_records(len(plan['entries']), offset, plan['cd_size']))
+        stage['bytes_out'] = plan['size']
+    if plan['kind'] is None:
+        raise RuntimeError('No Odoo zip, base64 or sql dump found in {0}, it can not be '
+                           'restored through the database manager'.format(backup))
+    logger.debug("Uploading %s from %s", plan['kind'], backup)
+    return plan
+
+
+class OdooUploadReader(object):
+    """ File like object with the zip planned by scan_odoo_upload, read from the tar
+        stream of the backup by chunks of at most ZIP_READ_SIZE bytes, so the backup is
+        uploaded without extracting it
+    """
+
+    def __init__(self, backup, plan):
+        self.backup = backup
+        self.plan = plan
+        self.chunks = self._chunks()
+        self.buf = ''
+        self.pos = 0
+        self.sent = 0
+
+    def _members(self):
+        reader = open_compressed(self.backup)
+        tar = tarfile.open(fileobj=reader, mode='r|')
+        try:
+            for member in tar:
+                if member.isreg():
+                    yield member.name.partition('/')[2], tar.extractfile(member)
+        finally:
+            tar.close()
+            reader.close()
+
+    def _chunks(self):
+        if self.plan['kind'] == 'zip':
+            zip_member = re.compile(r'^{0}(\.\d{{5}})?$'.format(re.escape(WS_ZIP_NAME)))
+            for rel_name, fin in self._members():
+                if zip_member.match(rel_name):
+                    for data in iter(lambda: fin.read(ZIP_READ_SIZE), ''):
+                        yield data
+                    if rel_name == WS_ZIP_NAME:
+                        break
+        elif self.plan['kind'] == 'b64':
+            for rel_name, fin in self._members():
+                if rel_name == 'database_dump.b64':
+                    decoded = Base64Reader(fin)
+                    for data in iter(lambda: decoded.read(ZIP_READ_SIZE), ''):
+                        yield data
+                    break
+        else:
+            for chunk in self._zip_chunks():
+                yield chunk
+
+    def _zip_chunks(self):
+        entries = self.plan['entries']
+        by_member = dict((name, entry) for entry in entries for name in entry['members'])
+        current = None
+        crc = size = 0
+        for rel_name, fin in self._members():
+            entry = by_member.get(rel_name)
+            if entry is None:
+                continue
+            if entry is not current:
+                self._check(current, crc, size)
+                current = entry
+                crc = size = 0
+                yield zip_local_header(entry)
+            for data in iter(lambda: fin.read(ZIP_READ_SIZE), ''):
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                yield data
+        self._check(current, crc, size)
+        for entry in entries:
+            yield zip_central_header(entry)
+        yield zip_end_records(len(entries), self.plan['cd_offset'], self.plan['cd_size'])
+
+    def _check(self, entry, crc, size):
+        if entry is not None and (crc & 0xFFFFFFFF, size) != (entry['crc'], entry['size']):
+            raise RuntimeError('{0} changed in {1} since it was scanned'.format(
+                entry['name'], self.backup))
+
+    def read(self, size=-1):
+        """ Read up to size bytes, all of them if size is negative
+        """
+        while self.chunks is not None and (size < 0 or len(self.buf) - self.pos < size):
+            try:
+                data = next(self.chunks)
+            except StopIteration:
+                self.chunks = None
+                if self.sent + len(self.buf) - self.pos != self.plan['size']:
+                    raise RuntimeError('{0} is not the size it had when it was scanned'
+                                       .format(self.backup))
+                break
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
+        if size < 0:
+            size = len(self.buf) - self.pos
+        res = self.buf[self.pos:self.pos + size]
+        self.pos += len(res)
+        self.sent += len(res)
+        return res
+
+    def close(self):
+        if self.chunks is not None:
+            self.chunks.close()
+            self.chunks = None
+
+
+def filter_backup_folder(folder, profile):
+    """ Apply a profile to an extracted backup restored through the Odoo database manager
+        (restore_database): the Odoo zip or base64 dump is unpacked into decoded members,
+        the data of the profile tables is removed from database_dump.sql and the zip is
+        built again on disk in place of the members, so restore_database uploads it by
+        chunks
+
+    Args:
+        folder (str): Extracted backup folder
+        profile (str): profiles.PROFILES name or file
+    Returns:
+        The zip file name
+    """
+    b64_name = os.path.join(folder, 'database_dump.b64')
+    zip_name = os.path.join(folder, WS_ZIP_NAME)
+    if os.path.exists(b64_name):
+        decode_b64_file(b64_name, zip_name)
+        clean_files(b64_name)
+    if os.path.exists(zip_name):
+        zfile = zipfile.ZipFile(zip_name)
+        try:
+            for zinfo in zfile.infolist():
+                if zinfo.filename.endswith('/'):
+                    continue
+                dest_name = member_path(folder, WS_ZIP_MEMBERS.get(zinfo.filename,
+                                                                   zinfo.filename))
+                if not os.path.isdir(os.path.dirname(dest_name)):
+                    os.makedirs(os.path.dirname(dest_name))
+                with open(dest_name, 'wb') as fout:
+                    shutil.copyfileobj(zfile.open(zinfo), fout, 1024 * 1024)
+        finally:
+            zfile.close()
+        clean_files(zip_name)
+    dump_name = os.path.join(folder, DUMP_FORMATS['plain'][1])
+    if not os.path.exists(dump_name):
+        raise RuntimeError('There is no sql dump in {0}'.format(folder))
+    logger.info('Filtering %s with profile %s', dump_name, profile)
+    with open(dump_name, 'rb') as fin:
+        with open(dump_name + '.filtered', 'wb') as fout:
+            stats = profiles.filter_sql(fin, fout, profiles.get_profile(profile))
+    os.rename(dump_name + '.filtered', dump_name)
+    logger.info('%s rows skipped and %s changed by the profile, %s foreign keys NOT VALID',
+                stats['skipped'], stats['changed'], stats['not_valid'])
+    build_odoo_zip(folder, zip_name)
+    clean_files([os.path.join(folder, fname) for fname in WS_ZIP_MEMBERS.values()] +
+                [os.path.join(folder, 'filestore')])
+    return zip_name
+
+
 def dump_database(dest_folder, database_name, super_user_pass, host, port):
     """ Dumps database using Oerplib in Base64 format
 
@@ -251,6 +1709,145 @@ def dump_database(dest_folder, database_name, super_user_pass, host, port):
     return dump_name
 
 
+def dump_database_zip(dest_folder, database_name, super_user_pass, host, port):
+    """ Dumps database with the database manager HTTP endpoint (dump_database_http) and
+        saves the zip generated by Odoo by chunks, so it is never held in memory
+
+    Args:
+        dest_folder (str): Folder where the function will save the dump
+        database_name (str): Database name that will be dumped
+        super_user_pass (str): Super user password to be used
+                               to connect with odoo instance
+        host (str): Host name or IP address to connect
+        port (int): Port number which Odoo instance is listening to
+    Returns:
+        The full dump path and name with .zip extension
+    """
+    logger.debug("Dumping database %s into %s folder", database_name, dest_folder)
+    dump_name = os.path.join(dest_folder, WS_ZIP_NAME)
+    with metrics.stage('dump') as stage:
+        response = dump_database_http(database_name, super_user_pass, host, port)
+        try:
+            with open(dump_name, "wb") as fout:
+                shutil.copyfileobj(response.raw, fout, ZIP_READ_SIZE)
+        finally:
+            response.close()
+        stage['bytes_out'] = os.path.getsize(dump_name)
+    return dump_name
+
+
+def odoo_http_params(odoo_version, action, database_name, super_user_pass):
+    """ Form fields expected by the database manager controllers (/web/database/backup
+        and /web/database/restore), they changed in Odoo 9
+
+    Args:
+        odoo_version (str): Odoo server version
+        action (str): backup or restore
+        database_name (str): Database to backup or to create
+        super_user_pass (str): Super user password
+    Returns:
+        Tuple with the dict of fields and the name of the file field for restore
+    """
+    if int(str(odoo_version).split('.')[0].split('~')[-1] or 0) < 9:
+        if action == 'backup':
+            return {'backup_db': database_name, 'backup_pwd': super_user_pass,
+                    'token': ''}, None
+        return {'new_db': database_name, 'restore_pwd': super_user_pass,
+                'mode': 'restore'}, 'db_file'
+    if action == 'backup':
+        return {'name': database_name, 'master_pwd': super_user_pass,
+                'backup_format': 'zip'}, None
+    return {'name': database_name, 'master_pwd': super_user_pass}, 'backup_file'
+
+
+def dump_database_http(database_name, super_user_pass, host, port, odoo_version=None):
+    """ Starts a database backup using the database manager HTTP endpoint, the zip file
+        is not downloaded, it must be read by chunks from the returned response raw
+        attribute, so the dump is never held in memory
+
+    Args:
+        database_name (str): Database name that will be dumped
+        super_user_pass (str): Super user password
+        host (str): Host name or IP address to connect
+        port (int): Port number which Odoo instance is listening to
+        odoo_version (str): Odoo server version, gotten from the server if not set
+    Returns:
+        The requests response, it must be closed when it is consumed
+    """
+    if not odoo_version:
+        oerp = oerplib.OERP(host, protocol='xmlrpc', port=port, timeout=3000)
+        odoo_version = oerp.db.server_version()
+    params, _ = odoo_http_params(odoo_version, 'backup', database_name, super_user_pass)
+    url = 'http://{0}:{1}/web/database/backup'.format(host, port)
+    logger.debug("Dumping database %s from %s", database_name, url)
+    response = requests.post(url, data=params, stream=True, timeout=3000,
+                             headers={'Accept-Encoding': 'identity'})
+    if response.status_code != 200 or \
+       response.headers.get('Content-Type', '').startswith('text/html'):
+        response.close()
+        raise RuntimeError('Could not dump database {0}, the server answered {1}'
+                           .format(database_name, response.status_code))
+    return response
+
+
+class MultipartFile(object):
+    """ File like object with a multipart/form-data body whose file part is read from
+        fileobj by chunks, so it can be uploaded with requests without loading it in
+        memory. The len attribute lets requests send the Content-Length header
+    """
+
+    def __init__(self, fields, file_field, fileobj, file_size, file_name):
+        boundary = uuid.uuid4().hex
+        head = ''.join('--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n{2}\r\n'
+                       .format(boundary, key, value) for key, value in fields.items())
+        head += ('--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+                 'Content-Type: application/octet-stream\r\n\r\n').format(boundary, file_field,
+                                                                         file_name)
+        tail = '\r\n--{0}--\r\n'.format(boundary)
+        self.parts = deque([StringIO(head), fileobj, StringIO(tail)])
+        self.len = len(head) + file_size + len(tail)
+        self.content_type = 'multipart/form-data; boundary={0}'.format(boundary)
+
+    def read(self, size=-1):
+        res = []
+        while self.parts and (size < 0 or size > 0):
+            data = self.parts[0].read(size)
+            if not data:
+                self.parts.popleft()
+                continue
+            res.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(res)
+
+
+def restore_database_http(fileobj, file_size, database_name, super_user_pass, host, port):
+    """ Restore a zip backup made by the database manager (or dump_database_http) using the
+        /web/database/restore HTTP endpoint, the file is uploaded by chunks
+
+    Args:
+        fileobj (file): File like object with the zip backup
+        file_size (int): Size of the zip backup
+        database_name (str): The database name that will be created to restore the dump
+        super_user_pass (str): Super user password of the instance
+        host (str): Hostname or ip where the Odoo instance is running
+        port (int): Port number where the instance is listening
+    """
+    oerp = oerplib.OERP(host, protocol='xmlrpc', port=port, timeout=3000)
+    params, file_field = odoo_http_params(oerp.db.server_version(), 'restore',
+                                          database_name, super_user_pass)
+    url = 'http://{0}:{1}/web/database/restore'.format(host, port)
+    logger.debug("Uploading %s bytes to %s", file_size, url)
+    body = MultipartFile(params, file_field, fileobj, file_size, WS_ZIP_NAME)
+    response = requests.post(url, data=body, timeout=3000, allow_redirects=False,
+                             headers={'Content-Type': body.content_type})
+    if response.status_code not in [200, 302, 303]:
+        raise RuntimeError('Could not restore database {0}, the server answered {1}'
+                           .format(database_name, response.status_code))
+    if not oerp.db.db_exist(database_name):
+        raise RuntimeError('Could not restore database {0}'.format(database_name))
+
+
 def generate_backup_name(database_name, reason=False):
     """Generates the backup name according to the following standard:
        database_name_reason_YYYYmmdd_HHMMSS
@@ -267,8 +1864,11 @@ def generate_backup_name(database_name, reason=False):
 
 
 def backup_database_ws(database_name, dest_folder, user, password,
-                       host, port, reason=False, tmp_dir=False):
-    """ Receive database name and back it up
+                       host, port, reason=False, tmp_dir=False, jobs=1,
+                       cformat='bz2', level=None, stream=False, throttle=None):
+    """ Receive database name and back it up with the database manager HTTP endpoint
+        (dump_database_http), the members of the zip generated by Odoo are stored like
+        in pg_dump backups (database_dump.sql and filestore) while it is downloaded
 
     Args:
         database_name (str): The database name
@@ -280,23 +1880,49 @@ def backup_database_ws(database_name, dest_folder, user, password,
         reason (str): Optional parameter that is used in case 
                       there is a particular reason for the backup
         tmp_dir (str): Optional parameter to store the temporary working dir, default is /tmp
+        jobs (int): Number of processes used to compress the backup
+        cformat (str): Compression format, one of COMPRESSION_FORMATS
+        level (int): Compression level
+        stream (bool): If True the zip is stored as it is (database_dump.zip), in parts
+                       like streamed pg_dump backups, instead of its members
+        throttle (Throttle): Optional throttle.Throttle for the compression
 
     Returns:
         Full path to the backup
     """
     files = []
+    streams = []
+    zips = []
     file_name = generate_backup_name(database_name, reason)
+    oerp = oerplib.OERP(host, protocol='xmlrpc', port=port, timeout=3000)
+    info = {
+        'database': database_name,
+        'dump_format': 'odoo_ws',
+        'odoo_version': oerp.db.server_version(),
+    }
     logger.info("Dumping database")
-    dbase = dump_database(tmp_dir, database_name, password, host, port)
-    files.append(os.path.join(tmp_dir, dbase))
-    logger.info("Compressing dump %s", dbase)
-    full_name = compress_files(file_name, files, dest_folder)
-    clean_files(files)
+    response = dump_database_http(database_name, password, host, port,
+                                  info['odoo_version'])
+    if stream:
+        streams.append((response.raw, WS_ZIP_NAME))
+        info['dump_format'] = 'odoo_zip'
+    else:
+        zips.append(response.raw)
+        info['dump_format'] = 'plain'
+    try:
+        full_name = compress_files(file_name, files, dest_folder, cformat=cformat,
+                                   jobs=jobs, level=level, info=info, streams=streams,
+                                   zips=zips, throttle=throttle)
+    finally:
+        response.close()
+    if not storage.is_url(full_name):
+        catalog.record_backup(full_name, database_name, reason)
     return full_name
 
 
 def backup_databases(databases_list, dest_folder,
-                     user, password, host, port, reason=False, tmp_dir=False):
+                     user, password, host, port, reason=False, tmp_dir=False, jobs=1,
+                     cformat='bz2', level=None, stream=False, throttle=None):
     """ Receive a list of databases and backup up them all
 
     Args:
@@ -304,11 +1930,14 @@ def backup_databases(databases_list, dest_folder,
     """
     for database in databases_list:
         backup_database_ws(database, dest_folder, user, password, host, port,
-                           reason, tmp_dir)
+                           reason, tmp_dir, jobs, cformat, level, stream, throttle)
 
 
 def restore_database(dest_folder, database_name, super_user_pass, host, port):
-    """ Restore database using Oerplib in Base64 format
+    """ Restore database uploading the zip by chunks with restore_database_http, for
+        backups with decoded members (database_dump.sql and filestore) the zip is built
+        in dest_folder first. Backups with a base64 dump are restored using Oerplib.
+        restore_database_stream uploads any of them by chunks without extracting them
 
     Args:
         dest_folder (str): Folder where the backup is stored
@@ -318,14 +1947,57 @@ def restore_database(dest_folder, database_name, super_user_pass, host, port):
         port (int): Port number where the instance is listening
     """
     logger.info("Restoring database %s", database_name)
-    dump_name = os.path.join(dest_folder, 'database_dump.b64')
-    logger.debug("Restore dump - reading file %s", dump_name)
-    with open(dump_name, "r") as fin:
-        b64_str = fin.read()
-        logger.debug("File loaded")
-    oerp = oerplib.OERP(host, protocol='xmlrpc', port=port, timeout=3000)
-    logger.debug("Connection to OERP established, restoring...")
-    oerp.db.restore(super_user_pass, database_name, b64_str)
+    with metrics.stage('restore_db') as stage:
+        zip_name = os.path.join(dest_folder, WS_ZIP_NAME)
+        built = not os.path.exists(zip_name) and \
+            os.path.exists(os.path.join(dest_folder, DUMP_FORMATS['plain'][1]))
+        if built or os.path.exists(zip_name):
+            try:
+                if built:
+                    # on disk, a zip as big as the database does not fit in memory
+                    logger.debug("Backup with decoded members, building zip")
+                    build_odoo_zip(dest_folder, zip_name)
+                stage['bytes_in'] = os.path.getsize(zip_name)
+                with open(zip_name, 'rb') as fin:
+                    restore_database_http(fin, os.path.getsize(zip_name), database_name,
+                                          super_user_pass, host, port)
+            finally:
+                if built:
+                    clean_files(zip_name)
+            return
+        dump_name = os.path.join(dest_folder, 'database_dump.b64')
+        logger.debug("Restore dump - reading file %s", dump_name)
+        with open(dump_name, "r") as fin:
+            b64_str = fin.read()
+            logger.debug("File loaded")
+        stage['bytes_in'] = len(b64_str)
+        oerp = oerplib.OERP(host, protocol='xmlrpc', port=port, timeout=3000)
+        logger.debug("Connection to OERP established, restoring...")
+        oerp.db.restore(super_user_pass, database_name, b64_str)
+
+
+def restore_database_stream(backup, database_name, super_user_pass, host, port):
+    """ Restore a backup through the database manager uploading it by chunks read straight
+        from the tar stream of the backup, instead of extracting it and loading the dump
+        in memory like restore_database. The zip uploaded is planned by scan_odoo_upload
+
+    Args:
+        backup (str): Backup file name or object storage url
+        database_name (str): The database name that will be created to restore the dump
+        super_user_pass (str): Super user password of the instance
+        host (str): Hostname or ip where the Odoo instance is running
+        port (int): Port number where the instance is listening
+    """
+    logger.info("Restoring database %s from %s", database_name, backup)
+    plan = scan_odoo_upload(backup)
+    with metrics.stage('restore_db') as stage:
+        stage['bytes_in'] = plan['size']
+        reader = OdooUploadReader(backup, plan)
+        try:
+            restore_database_http(reader, plan['size'], database_name, super_user_pass,
+                                  host, port)
+        finally:
+            reader.close()
 
 
 def database_exists(database_name, host, port=8069, timeout=3000):
@@ -387,47 +2059,619 @@ def test_connection(db_name, host=False, port=8069, user=False,
     return True
 
 
-def decode_b64_file(src, dst):
-    """ Read src base64 encoded file and output its content to dst file
+def decode_b64_file(src, dst):
+    """ Read src base64 encoded file and output its content to dst file, decoding it by
+        chunks with Base64Reader
+    """
+    with open(src, 'rb') as source_file:
+        with open(dst, 'wb') as destination_file:
+            shutil.copyfileobj(Base64Reader(source_file), destination_file, 1024 * 1024)
+
+
+def member_path(folder, name):
+    """ Path where an archive member is written inside folder, like zipfile.extractall
+        members can not be written out of it
+
+    Args:
+        folder (str): Folder where the member is extracted
+        name (str): Member name relative to folder
+    Returns:
+        The normalized full path
+    """
+    dest_name = os.path.normpath(os.path.join(folder, name))
+    if not dest_name.startswith(os.path.normpath(folder) + os.sep):
+        raise RuntimeError('The member {0} is out of {1}'.format(name, folder))
+    return dest_name
+
+
+def restore_odoo_zip(zip_name, odoo_config, filestore_folder, profile=None,
+                     post_data_jobs=None):
+    """ Restore a zip made by the Odoo database manager, or its base64 text, in a single
+        pass with a few MB of memory: the zip is read as a stream with ZipStreamReader
+        (decoding the base64 text by chunks), dump.sql is piped into psql and the
+        filestore is written into filestore_folder
+
+    Args:
+        zip_name (str): Zip file or base64 text of it (.b64)
+        odoo_config (dict): Odoo configuration, the database is created
+        filestore_folder (str): Folder where the filestore is written
+        profile (str): Optional profiles.PROFILES name or file applied to the dump
+        post_data_jobs (int): If set the indexes and constraints are built after the data
+                              is loaded, on this number of connections (see start_psql)
+    Returns:
+        True if the database was restored, None otherwise
+    """
+    restored = None
+    with metrics.stage('restore_zip') as stage:
+        with open(zip_name, 'rb') as fin:
+            source = Base64Reader(fin) if zip_name.endswith('.b64') else fin
+            for name, _, reader in ZipStreamReader(source):
+                if name == 'dump.sql':
+                    if not createdb_direct(odoo_config):
+                        return None
+                    process = start_psql(odoo_config, profile, post_data_jobs)
+                    try:
+                        shutil.copyfileobj(reader, process.writer, 1024 * 1024)
+                    except IOError:
+                        # psql exited, wait_psql tells why
+                        pass
+                    restored = wait_psql(process)
+                    if not restored:
+                        dropdb_direct(odoo_config)
+                        return None
+                elif name.startswith('filestore/') and not name.endswith('/'):
+                    dest_name = member_path(filestore_folder, name[len('filestore/'):])
+                    if not os.path.isdir(os.path.dirname(dest_name)):
+                        os.makedirs(os.path.dirname(dest_name))
+                    with open(dest_name, 'wb') as fout:
+                        shutil.copyfileobj(reader, fout, 1024 * 1024)
+                stage['bytes_out'] = stage.get('bytes_out', 0) + reader.size
+        stage['bytes_in'] = os.path.getsize(zip_name)
+    if not restored:
+        logger.error('There is no dump.sql in %s', zip_name)
+    return restored
+
+
+def file_sha1(fname):
+    """ Compute the SHA-1 of a file reading it by chunks
+
+    Args:
+        fname (str): File name
+    Returns:
+        The hex digest
+    """
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1024 * 1024), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def store_filestore_objects(src_folder, store_folder):
+    """ Copy the files of a filestore into a content addressed store (store_folder/ab/abcdef...)
+        skipping the ones that are already there. Odoo names the attachments with their
+        SHA-1 (filestore/db/ab/abcdef...), so for them the name is used as the object id
+        and only the new ones are read, the rest are hashed
+
+    Args:
+        src_folder (str): Filestore folder
+        store_folder (str): Folder of the content addressed store, shared by every database
+    Returns:
+        List of dicts with path (relative to src_folder), object, size and mode of every file
+    """
+    logger.info('Storing filestore %s into %s', src_folder, store_folder)
+    res = []
+    added = 0
+    for root, _, fnames in os.walk(src_folder):
+        for fname in fnames:
+            full_name = os.path.join(root, fname)
+            rel_name = os.path.relpath(full_name, src_folder)
+            if re.match(r'^[0-9a-f]{40}$', fname) and \
+               os.path.basename(root) == fname[:2]:
+                object_id = fname
+            else:
+                object_id = file_sha1(full_name)
+            object_name = os.path.join(store_folder, object_id[:2], object_id)
+            if not os.path.exists(object_name):
+                if not os.path.isdir(os.path.dirname(object_name)):
+                    try:
+                        os.makedirs(os.path.dirname(object_name))
+                    except OSError:
+                        # Created by a concurrent backup
+                        if not os.path.isdir(os.path.dirname(object_name)):
+                            raise
+                tmp_name = '{0}.{1}.tmp'.format(object_name, os.getpid())
+                shutil.copy2(full_name, tmp_name)
+                os.rename(tmp_name, object_name)
+                added += 1
+            stat = os.stat(full_name)
+            res.append({'path': rel_name, 'object': object_id,
+                        'size': stat.st_size, 'mode': stat.st_mode & 0o777})
+    logger.info('%s files in filestore, %s new objects stored', len(res), added)
+    return res
+
+
+def restore_filestore_objects(index, store_folder, dest_folder):
+    """ Rebuild a filestore from a content addressed store
+
+    Args:
+        index (list): List of files as returned by store_filestore_objects
+        store_folder (str): Folder of the content addressed store
+        dest_folder (str): Folder where the filestore will be rebuilt
+    """
+    logger.info('Rebuilding filestore in %s from %s', dest_folder, store_folder)
+    for item in index:
+        object_id = item['object']
+        dest_name = os.path.join(dest_folder, item['path'])
+        if not os.path.isdir(os.path.dirname(dest_name)):
+            os.makedirs(os.path.dirname(dest_name))
+        shutil.copyfile(os.path.join(store_folder, object_id[:2], object_id), dest_name)
+        os.chmod(dest_name, item.get('mode', 0o644))
+
+
+def delta_window(*sizes):
+    """ zstd window log (--long value) needed to patch between files of these sizes
+    """
+    return max(27, (max(sizes) - 1).bit_length())
+
+
+def make_delta(dump_name, base_name, delta_name, level=None, jobs=1):
+    """ Encode a dump as a zstd patch against another one (zstd --patch-from)
+
+    Args:
+        dump_name (str): Dump to encode
+        base_name (str): Dump the patch is made against
+        delta_name (str): Patch file name
+        level (int): zstd compression level
+        jobs (int): zstd threads
+    Returns:
+        True if the patch was made, None otherwise
+    """
+    window = delta_window(os.path.getsize(dump_name), os.path.getsize(base_name))
+    cmd = ['zstd', '-q', '-f', '--patch-from={0}'.format(base_name),
+           '--long={0}'.format(window), '-T{0}'.format(int(jobs))]
+    if level is not None:
+        if int(level) > 19:
+            cmd.append('--ultra')
+        cmd.append('-{0}'.format(int(level)))
+    with metrics.stage('delta') as stage:
+        process = subprocess.Popen(cmd + [dump_name, '-o', delta_name],
+                                   stderr=subprocess.PIPE)
+        _, stderr_output = process.communicate()
+        if process.returncode != 0:
+            logger.error('Could not make the dump delta: %s', stderr_output)
+            clean_files(delta_name)
+            return None
+        stage['bytes_in'] = os.path.getsize(dump_name)
+        stage['bytes_out'] = os.path.getsize(delta_name)
+    return True
+
+
+def apply_delta(delta_name, base_name, dest_name):
+    """ Rebuild a dump from its zstd patch and the dump it was made against
+
+    Args:
+        delta_name (str): Patch file name
+        base_name (str): Dump the patch was made against
+        dest_name (str): Rebuilt dump file name
+    """
+    with metrics.stage('patch') as stage:
+        # --long only raises the memory limit when decompressing, the window of the patch
+        # is used
+        process = subprocess.Popen(
+            ['zstd', '-d', '-q', '-f', '--patch-from={0}'.format(base_name), '--long=31',
+             delta_name, '-o', dest_name],
+            stderr=subprocess.PIPE)
+        _, stderr_output = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError('Could not apply the dump delta {0}: {1}'.format(
+                delta_name, stderr_output))
+        stage['bytes_in'] = os.path.getsize(delta_name)
+        stage['bytes_out'] = os.path.getsize(dest_name)
+
+
+def delta_dump(dump_name, dest_folder, database_name, tmp_dir, full_every=7, level=None,
+               jobs=1, max_size=DELTA_MAX_SIZE):
+    """ Encode a plain dump as a patch against the dump of the previous backup of the
+        database, kept in DELTA_BASE_NAME. A full backup is made every full_every backups
+        (DELTA_MAX_CHAIN at most), when the previous backup is gone, when a dump is bigger
+        than max_size or when the patch can not be made
+
+    Args:
+        dump_name (str): Plain dump just made
+        dest_folder (str): Backup folder
+        database_name (str): Database name
+        tmp_dir (str): Folder where the patch is written
+        full_every (int): Backups in a chain, the full one included
+        level (int): zstd compression level of the patch
+        jobs (int): zstd threads
+        max_size (int): Bytes of the biggest dump that is patched, DELTA_MAX_SIZE at most
+    Returns:
+        Tuple (patch file name or None for a full backup, info saved in the manifest)
+    """
+    info = {'delta_base': None, 'delta_depth': 0}
+    base_folder = os.path.join(dest_folder, DELTA_BASE_NAME)
+    base_name = os.path.join(base_folder, '{0}.sql'.format(database_name))
+    base_info_name = os.path.join(base_folder, '{0}.json'.format(database_name))
+    chain = min(full_every, DELTA_MAX_CHAIN)
+    max_size = min(max_size, DELTA_MAX_SIZE)
+    reason = None
+    if not (os.path.isfile(base_info_name) and os.path.isfile(base_name)):
+        reason = 'there is no previous dump'
+    else:
+        base_info = load_json(base_info_name)
+        if base_info['depth'] + 1 >= chain:
+            reason = 'the chain has {0} backups'.format(chain)
+        elif not os.path.isfile(os.path.join(dest_folder, base_info['backup'])):
+            reason = 'the previous backup {0} does not exist'.format(base_info['backup'])
+        elif os.path.getsize(base_name) != base_info['size']:
+            reason = 'the previous dump does not match its backup'
+        else:
+            size = max(os.path.getsize(base_name), os.path.getsize(dump_name))
+            if size > max_size:
+                # not a normal end of chain, every backup of the database is full now
+                logger.warn('Full dump backup, the dump has %s bytes and delta backups are'
+                            ' made of dumps of %s bytes at most', size, max_size)
+                return None, info
+    if reason:
+        logger.info('Full dump backup, %s', reason)
+        return None, info
+    delta_name = os.path.join(tmp_dir, '{0}_{1}'.format(database_name, DELTA_DUMP_NAME))
+    logger.info('Encoding the dump against the one of %s', base_info['backup'])
+    if not make_delta(dump_name, base_name, delta_name, level, jobs):
+        logger.warn('Full dump backup, the delta could not be made')
+        return None, info
+    info.update({'delta_base': base_info['backup'], 'delta_depth': base_info['depth'] + 1,
+                 'delta_base_size': base_info['size']})
+    return delta_name, info
+
+
+def save_delta_base(dump_name, full_name, database_name, depth):
+    """ Keep a dump as the base of the next delta backup of its database, the dump file
+        is moved
+
+    Args:
+        dump_name (str): Plain dump of the backup
+        full_name (str): Backup made with it
+        database_name (str): Database name
+        depth (int): Position of the backup in its chain, 0 for full backups
+    """
+    dest_folder = os.path.dirname(os.path.abspath(full_name))
+    base_folder = os.path.join(dest_folder, DELTA_BASE_NAME)
+    if not os.path.isdir(base_folder):
+        os.makedirs(base_folder)
+    base_info_name = os.path.join(base_folder, '{0}.json'.format(database_name))
+    # without its info the base is not used, so a half saved one is never used
+    clean_files(base_info_name)
+    size = os.path.getsize(dump_name)
+    shutil.move(dump_name, os.path.join(base_folder, '{0}.sql'.format(database_name)))
+    save_json({'backup': os.path.basename(full_name), 'depth': depth, 'size': size},
+              base_info_name)
+
+
+def extract_dump(backup, dest_folder):
+    """ Extract only the dump of a backup, rebuilding it if it is a delta
+
+    Args:
+        backup (str): Backup file name or object storage url
+        dest_folder (str): Folder where the dump is extracted
+    Returns:
+        Full path to the plain dump
+    """
+    names = [DUMP_FORMATS['plain'][1], DELTA_DUMP_NAME, MANIFEST_NAME]
+    folder = None
+    with metrics.stage('extract') as stage:
+        reader = open_compressed(backup)
+        tar = tarfile.open(fileobj=reader, mode='r|')
+        for member in tar:
+            if os.path.basename(member.name) in names and member.isreg():
+                tar.extract(member, dest_folder)
+                folder = os.path.join(dest_folder, os.path.dirname(member.name))
+                stage['bytes_out'] = stage.get('bytes_out', 0) + member.size
+        tar.close()
+        reader.close()
+    if not folder:
+        raise RuntimeError('There is no sql dump in {0}'.format(backup))
+    if os.path.exists(os.path.join(folder, DELTA_DUMP_NAME)):
+        return restore_delta_dump(backup, folder, dest_folder)
+    return os.path.join(folder, DUMP_FORMATS['plain'][1])
+
+
+def restore_delta_dump(backup, folder, working_dir):
+    """ Rebuild the dump of an extracted delta backup, the chain of backups it was made
+        against is extracted from the folder of the backup
+
+    Args:
+        backup (str): Backup file name or object storage url
+        folder (str): Folder where the backup was extracted
+        working_dir (str): Folder where the base dumps are extracted
+    Returns:
+        Full path to the plain dump
+    """
+    manifest = load_json(os.path.join(folder, MANIFEST_NAME))
+    base_backup = os.path.join(os.path.dirname(backup), manifest['delta_base'])
+    logger.info('Delta backup, extracting the dump of %s', manifest['delta_base'])
+    base_dir = mkdtemp(dir=working_dir)
+    try:
+        base_dump = extract_dump(base_backup, base_dir)
+        if os.path.getsize(base_dump) != manifest['delta_base_size']:
+            raise RuntimeError('The dump of {0} is not the one {1} was made against'.format(
+                base_backup, backup))
+        dump_name = os.path.join(folder, DUMP_FORMATS['plain'][1])
+        apply_delta(os.path.join(folder, DELTA_DUMP_NAME), base_dump, dump_name)
+    finally:
+        clean_files(base_dir)
+    clean_files(os.path.join(folder, DELTA_DUMP_NAME))
+    return dump_name
+
+
+def link_tree(src_folder, dest_folder, prev_folder=None):
+    """ Copy a folder like rsync --link-dest does: files of prev_folder with the same
+        relative path, size and modification time are hard-linked instead of copied.
+        If hard links can not be made (other filesystem) the files are copied
+
+    Args:
+        src_folder (str): Folder to copy
+        dest_folder (str): Destination folder, it must not exist
+        prev_folder (str): Folder the unchanged files are linked from, it can be
+                           src_folder itself to link everything
+    Returns:
+        dict with the number of files and bytes linked and copied
+    """
+    stats = {'linked': 0, 'linked_bytes': 0, 'copied': 0, 'copied_bytes': 0}
+    can_link = bool(prev_folder)
+    for root, dirs, fnames in os.walk(src_folder):
+        dirs.sort()
+        rel_path = os.path.relpath(root, src_folder)
+        target = os.path.normpath(os.path.join(dest_folder, rel_path))
+        os.makedirs(target)
+        for fname in sorted(fnames):
+            src = os.path.join(root, fname)
+            dest = os.path.join(target, fname)
+            src_stat = os.stat(src)
+            prev = os.path.join(prev_folder, rel_path, fname) if can_link else None
+            if prev and os.path.isfile(prev):
+                prev_stat = os.stat(prev)
+                if prev_stat.st_size == src_stat.st_size and \
+                        int(prev_stat.st_mtime) == int(src_stat.st_mtime):
+                    try:
+                        os.link(prev, dest)
+                    except OSError as error:
+                        if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                            raise
+                        logger.warn('Could not hard-link into %s (%s), copying files',
+                                    dest_folder, error.strerror)
+                        can_link = False
+                    else:
+                        stats['linked'] += 1
+                        stats['linked_bytes'] += src_stat.st_size
+                        continue
+            shutil.copy2(src, dest)
+            stats['copied'] += 1
+            stats['copied_bytes'] += src_stat.st_size
+    return stats
+
+
+def find_snapshot(dest_folder, database_name):
+    """ Find the latest snapshot backup of a database
+
+    Args:
+        dest_folder (str): Backup folder
+        database_name (str): Database name
+    Returns:
+        Full path to the snapshot folder or None if there is none
+    """
+    res = latest = None
+    for fname in os.listdir(dest_folder):
+        info_name = os.path.join(dest_folder, fname, SNAPSHOT_NAME)
+        if not fname.startswith(database_name) or not os.path.isfile(info_name):
+            continue
+        info = load_json(info_name)
+        if info.get('database') == database_name and \
+                (latest is None or info['created'] > latest):
+            res, latest = os.path.join(dest_folder, fname), info['created']
+    return res
+
+
+def extract_snapshot(snapshot_dir, working_dir):
+    """ Extract the dump of a snapshot backup and link its filestore next to it, so the
+        folder is like an extracted backup
+
+    Args:
+        snapshot_dir (str): Snapshot folder made by backup_database_snapshot
+        working_dir (str): Folder where the dump is extracted
+    Returns:
+        The extracted folder
     """
-    with open(src, 'r') as source_file:
-        with open(dst, 'w') as destination_file:
-            for line in source_file:
-                destination_file.write(base64.b64decode(line))
+    info = load_json(os.path.join(snapshot_dir, SNAPSHOT_NAME))
+    dest_dir = decompress_files(os.path.join(snapshot_dir, info['dump']), working_dir)
+    filestore = os.path.join(os.path.abspath(snapshot_dir), 'filestore')
+    if os.path.isdir(filestore):
+        os.symlink(filestore, os.path.join(dest_dir, 'filestore'))
+    return dest_dir
+
+
+def find_dump(folder):
+    """ Find the pg_dump generated dump inside an extracted backup folder
 
+    Args:
+        folder (str): Extracted backup folder
+    Returns:
+        Full path to the dump (file or directory), the plain sql one if none was found
+    """
+    for dump_format in ['directory', 'custom']:
+        dump_name = os.path.join(folder, DUMP_FORMATS[dump_format][1])
+        if os.path.exists(dump_name):
+            logger.debug('Dump in %s format found', dump_format)
+            return dump_name
+    return os.path.join(folder, DUMP_FORMATS['plain'][1])
+
+
+def restore_stream(backup, odoo_config, working_dir, filestore_folder, profile=None,
+                   post_data_jobs=None):
+    """ Restore a backup in a single pass over the archive, without writing the dump to
+        disk: the sql dump members are piped into psql while they are decompressed and
+        the filestore members are extracted into filestore_folder at the same time. The
+        rest of the members, and the dumps that can not be piped (custom, directory,
+        delta and WS zip ones), are extracted into working_dir as decompress_files does
 
-def restore_direct(backup, odoo_config, working_dir):
-    """ Restore a pg_dump in sql format or b64 generated with the odoo webservice
+    Args:
+        backup (str): Backup file name or object storage url
+        odoo_config (dict): Odoo configuration, the database is created
+        working_dir (str): Folder where the rest of the members are extracted
+        filestore_folder (str): Folder where the filestore is extracted
+        profile (str): Optional profiles.PROFILES name or file applied to the dump
+        post_data_jobs (int): If set the indexes and constraints are built after the data
+                              is loaded, on this number of connections (see start_psql)
+    Returns:
+        Tuple (folder of the backup inside working_dir, True if the database was
+        restored, None if there was no sql dump to pipe, False if the restore failed)
+    """
+    sql_member = re.compile(r'^{0}(\.\d{{5}})?$'.format(re.escape(DUMP_FORMATS['plain'][1])))
+    process = None
+    restored = None
+    base_folder = ''
+    with metrics.stage('restore_stream') as stage:
+        reader = open_compressed(backup)
+        tar = tarfile.open(fileobj=reader, mode='r|')
+        try:
+            for member in tar:
+                base_folder, _, rel_name = member.name.partition('/')
+                if member.isreg() and sql_member.match(rel_name):
+                    if process is None:
+                        logger.info('Restoring %s while it is extracted', rel_name)
+                        if not createdb_direct(odoo_config):
+                            return os.path.join(working_dir, base_folder), False
+                        process = start_psql(odoo_config, profile, post_data_jobs)
+                    try:
+                        shutil.copyfileobj(tar.extractfile(member), process.writer,
+                                           1024 * 1024)
+                    except IOError:
+                        # psql exited, wait_psql tells why
+                        break
+                    stage['bytes_out'] = stage.get('bytes_out', 0) + member.size
+                    continue
+                if process is not None and restored is None:
+                    restored = bool(wait_psql(process))
+                    if not restored:
+                        break
+                if rel_name == 'filestore' or rel_name.startswith('filestore/'):
+                    member.name = rel_name[len('filestore/'):]
+                    if member.name:
+                        tar.extract(member, filestore_folder)
+                else:
+                    tar.extract(member, working_dir)
+                stage['bytes_out'] = stage.get('bytes_out', 0) + member.size
+        finally:
+            tar.close()
+            reader.close()
+        if process is not None and restored is None:
+            restored = bool(wait_psql(process))
+        stage['bytes_in'] = storage.size_of(backup)
+    if restored is False:
+        dropdb_direct(odoo_config)
+    dest_folder = os.path.join(working_dir, base_folder)
+    join_dump_parts(dest_folder, DUMP_FORMATS['custom'][1])
+    join_dump_parts(dest_folder, WS_ZIP_NAME)
+    return dest_folder, restored
+
+
+def restore_direct(backup, odoo_config, working_dir, jobs=1, object_store=None, profile=None,
+                   stream=False, deferred=False):
+    """ Restore a pg_dump in sql, custom or directory format or b64 generated with
+        the odoo webservice
 
     Args:
-        backup (str): full path to the backup you want to restore
+        backup (str): full path or object storage url (s3://bucket/key, streamed) of the
+                      backup you want to restore
         odoo_config (dict): dictionary with the required odoo configuration
         working_dir (str): full path to the temp directory where the files will be extracted
         container_name (str): optional docker container name or id that contains
                               the configuration to be used
+        jobs (int): Number of pg_restore jobs for custom and directory format dumps, and
+                    of connections that build the indexes and constraints of deferred
+                    restores
+        object_store (str): Content addressed store of incremental backups, by default
+                            OBJECT_STORE_NAME folder next to the backup
+        profile (str): Optional profiles.PROFILES name or file, the data of its tables is
+                       not restored
+        stream (bool): If True the archive is restored with restore_stream, sql dumps are
+                       piped into psql and the filestore is extracted next to the one of
+                       the instance, so no temp space is needed for them
+        deferred (bool): If True the indexes and constraints of sql dumps (and of the
+                         dump.sql of WS backups) are built after the data is loaded, on
+                         jobs connections
+
+    backup can also be a snapshot folder made by backup_database_snapshot, its filestore
+    is hard-linked into the instance when they are in the same filesystem. The dump of
+    delta backups is rebuilt from the chain of backups next to it
     """
+    snapshot = os.path.isfile(os.path.join(backup, SNAPSHOT_NAME))
     logger.info('Extracting files')
-    logger.debug('Extracting %s into %s', backup, working_dir)
-    dest_dir = decompress_files(backup, working_dir)
-    dump_name = os.path.join(dest_dir, 'database_dump.sql')
-    filestore_folder = os.path.join(dest_dir, 'filestore')
-    if os.path.exists(os.path.join(dest_dir, 'database_dump.b64')):
-        logger.debug('Is a backup generated with WS')
-        destination_file = os.path.join(dest_dir, 'backup.zip')
-        decode_b64_file(os.path.join(dest_dir, 'database_dump.b64'), destination_file)
-        zfile = zipfile.ZipFile(destination_file)
-        logger.info('Unziping backup')
-        try:
-            zfile.extractall(dest_dir)
-        except IOError as error:
-            logger.error('Could not extract database_dump.b64: %s', error.message)
+    archive = backup
+    if snapshot:
+        logger.debug('Is a snapshot backup')
+        snapshot_info = load_json(os.path.join(backup, SNAPSHOT_NAME))
+        archive = os.path.join(backup, snapshot_info['dump'])
+        filestore_folder = os.path.join(backup, 'filestore')
+    restored = None
+    post_data_jobs = jobs if deferred else None
+    staging = os.path.join(working_dir, 'filestore')
+    if not snapshot and 'odoo_container' not in odoo_config:
+        # in the filesystem of the instance, so it is installed with a rename
+        staging = filestore_staging(os.path.join(odoo_config.get('data_dir'), 'filestore',
+                                                 odoo_config.get('database')))
+    if stream:
+        clean_files(staging)
+        logger.debug('Restoring %s while it is extracted into %s', archive, working_dir)
+        dest_dir, restored = restore_stream(archive, odoo_config, working_dir,
+                                            staging, profile, post_data_jobs)
+        if restored is False:
+            clean_files(staging)
             return None
-        dump_name = os.path.join(dest_dir, 'dump.sql')
-    pgrestore_database(dump_name, odoo_config)
-    if 'odoo_container' in odoo_config:
-        restore_docker_filestore(filestore_folder, odoo_config)
     else:
-        restore_instance_filestore(filestore_folder, odoo_config)
+        logger.debug('Extracting %s into %s', archive, working_dir)
+        if not snapshot:
+            clean_files(staging)
+        dest_dir = decompress_files(archive, working_dir, None if snapshot else staging)
+    if not snapshot:
+        filestore_folder = staging
+    dump_name = find_dump(dest_dir)
+    if os.path.exists(os.path.join(dest_dir, DELTA_DUMP_NAME)):
+        logger.debug('Is a delta backup')
+        dump_name = restore_delta_dump(backup, dest_dir, working_dir)
+    filestore_index = os.path.join(dest_dir, FILESTORE_INDEX_NAME)
+    if os.path.exists(filestore_index):
+        logger.debug('Is an incremental backup')
+        if not object_store:
+            object_store = os.path.join(os.path.dirname(os.path.abspath(backup)),
+                                        OBJECT_STORE_NAME)
+        with metrics.stage('filestore') as stage:
+            objects = load_json(filestore_index)
+            restore_filestore_objects(objects, object_store, filestore_folder)
+            stage['bytes_out'] = sum(item['size'] for item in objects)
+    for ws_name in [WS_ZIP_NAME, 'database_dump.b64']:
+        if restored is None and os.path.exists(os.path.join(dest_dir, ws_name)):
+            logger.debug('Is a backup generated with WS')
+            logger.info('Restoring %s', ws_name)
+            try:
+                restored = restore_odoo_zip(os.path.join(dest_dir, ws_name), odoo_config,
+                                            filestore_folder, profile, post_data_jobs)
+            except (IOError, RuntimeError) as error:
+                logger.error('Could not restore %s: %s', ws_name, error)
+                dropdb_direct(odoo_config)
+                return None
+            if not restored:
+                return None
+    if restored is None:
+        pgrestore_database(dump_name, odoo_config, jobs, profile, deferred)
+    with metrics.stage('install_filestore') as stage:
+        stage['bytes_in'] = metrics.path_size(filestore_folder)
+        if 'odoo_container' in odoo_config:
+            # streamed from filestore_folder, so the snapshot is kept as it is
+            restore_docker_filestore(filestore_folder, odoo_config)
+        else:
+            restore_instance_filestore(filestore_folder, odoo_config, link=snapshot)
     return True
 
 
@@ -463,68 +2707,415 @@ def pase_odoo_configfile(filename):
     return res
 
 
-def pgdump_database(dest_folder, database_config):
-    """ Dumps database using pg_dump in sql format
+def pg_env(database_config):
+    """ Environment needed by the postgres client tools, it is given to every process
+        instead of being set in os.environ so databases from different servers can be
+        backed up at the same time
+
+    Args:
+        database_config (dict): Database configuration parameters
+    Returns:
+        dict with the environment variables
+    """
+    res = {}
+    if database_config.get('db_password') not in [None, 'False']:
+        res.update({'PGPASSWORD': database_config.get('db_password')})
+    return res
+
+
+def pgdump_database(dest_folder, database_config, dump_format='plain', jobs=1, profile=None):
+    """ Dumps database using pg_dump in sql, custom or directory format
 
     Args:
         dest_folder (str): Folder where the function will save the dump
         database_config (dict): Database configuration parameters needed to execute pg_dump
+        dump_format (str): One of DUMP_FORMATS
+        jobs (int): Number of tables dumped in parallel, only for directory format
+        profile (str): Optional profiles.PROFILES name or file, the data of its tables is
+                       not dumped
+    Returns:
+        The full dump path and name (.sql file, .dump file or directory)
+    """
+    logger.debug("Dumping database %s into %s folder in %s format",
+                 database_config.get('database'), dest_folder, dump_format)
+    if dump_format not in DUMP_FORMATS:
+        raise RuntimeError('Unknown dump format "{}"'.format(dump_format))
+    dump_name = os.path.join(dest_folder, DUMP_FORMATS[dump_format][1])
+    dump_cmd = 'pg_dump {database} -O -F{0} -f {1} -p {db_port} -h {db_host} -U {db_user}' \
+        .format(DUMP_FORMATS[dump_format][0], dump_name, **database_config)
+    if dump_format == 'directory':
+        # pg_dump refuses to write into an existing directory
+        clean_files(dump_name)
+        if jobs > 1:
+            dump_cmd += ' -j {0}'.format(jobs)
+    with metrics.stage('dump') as stage:
+        shell = spur.LocalShell()
+        try:
+            shell.run(shlex.split(dump_cmd) + profile_dump_args(profile),
+                      update_env=pg_env(database_config))
+        except spur.results.RunProcessError as error:
+            if 'does not exist' in error.stderr_output:
+                logger.error('Database does not exists, check name and try again')
+            else:
+                logger.error('Could not dump database, error message: %s', error.stderr_output)
+            return None
+        stage['bytes_out'] = metrics.path_size(dump_name)
+        return dump_name
+
+
+def pgdump_database_stream(database_config, dump_format='plain', profile=None):
+    """ Starts pg_dump in sql or custom format writing to its stdout so the dump can be
+        streamed into the backup without an intermediate file
+
+    Args:
+        database_config (dict): Database configuration parameters needed to execute pg_dump
+        dump_format (str): plain or custom, directory format can not be streamed
+        profile (str): Optional profile, the data of its tables is not dumped
+    Returns:
+        The running process, the dump must be read from its stdout and
+        wait_pgdump must be called once it was consumed
+    """
+    logger.debug("Streaming dump of database %s", database_config.get('database'))
+    if dump_format not in ['plain', 'custom']:
+        raise RuntimeError('Dump format "{}" can not be streamed'.format(dump_format))
+    dump_cmd = 'pg_dump {database} -O -F{0} -p {db_port} -h {db_host} -U {db_user}' \
+        .format(DUMP_FORMATS[dump_format][0], **database_config)
+    stderr_file = TemporaryFile()
+    process = subprocess.Popen(shlex.split(dump_cmd) + profile_dump_args(profile),
+                               stdout=subprocess.PIPE,
+                               stderr=stderr_file,
+                               env=dict(os.environ, **pg_env(database_config)))
+    process.stderr_file = stderr_file
+    return process
+
+
+def profile_dump_args(profile):
+    """ pg_dump arguments of a profile name, none if it is not set
+    """
+    if not profile:
+        return []
+    return profiles.pg_dump_args(profiles.get_profile(profile))
+
+
+def wait_pgdump(process):
+    """ Waits for a pg_dump started with pgdump_database_stream and checks its result
+
+    Args:
+        process (Popen): The pg_dump process
+    Returns:
+        True if the dump was successful, None otherwise
+    """
+    process.stdout.close()
+    if process.wait() == 0:
+        process.stderr_file.close()
+        return True
+    process.stderr_file.seek(0)
+    stderr_output = process.stderr_file.read()
+    process.stderr_file.close()
+    if 'does not exist' in stderr_output:
+        logger.error('Database does not exists, check name and try again')
+    else:
+        logger.error('Could not dump database, error message: %s', stderr_output)
+    return None
+
+
+def kill_pgdump(process):
+    """ Stops a pg_dump started with pgdump_database_stream whose output is not read
+        anymore, so it does not stay blocked writing into its pipe
+
+    Args:
+        process (Popen): The pg_dump process
+    """
+    try:
+        process.kill()
+    except OSError:
+        # it already exited
+        pass
+    process.wait()
+    process.stdout.close()
+    process.stderr_file.close()
+
+
+def get_odoo_version(database_config):
+    """ Get the version of the base module installed in a database
+
+    Args:
+        database_config (dict): Database configuration parameters needed to execute psql
     Returns:
-        The full dump path and name with .sql extension
+        The version or None if it could not be gotten
     """
-    logger.debug("Dumping database %s into %s folder",
-                 database_config.get('database'), dest_folder)
-    dump_name = os.path.join(dest_folder, 'database_dump.sql')
-    if database_config.get('db_password') != 'False':
-        os.environ['PGPASSWORD'] = database_config.get('db_password')
-    dump_cmd = 'pg_dump {database} -O -f {0} -p {db_port} -h {db_host} -U {db_user}' \
-        .format(dump_name, **database_config)
+    query_cmd = 'psql {database} -At -p {db_port} -h {db_host} -U {db_user} -c'.format(
+        **database_config)
+    query = "SELECT latest_version FROM ir_module_module WHERE name = 'base'"
     shell = spur.LocalShell()
     try:
-        shell.run(shlex.split(dump_cmd))
+        res = shell.run(shlex.split(query_cmd) + [query], update_env=pg_env(database_config))
     except spur.results.RunProcessError as error:
-        if 'does not exist' in error.stderr_output:
-            logger.error('Database does not exists, check name and try again')
-        else:
-            logger.error('Could not dump database, error message: %s', error.stderr_output)
+        logger.warn('Could not get Odoo version: %s', error.stderr_output)
         return None
-    return dump_name
+    return res.output.strip() or None
+
+
+def get_active_connections(database_config):
+    """ Count the active connections of the postgres server of a database, the ones
+        waiting for the client (idle) are not counted
+
+    Args:
+        database_config (dict): Database configuration parameters needed to execute psql
+    Returns:
+        The number of connections or None if it could not be gotten
+    """
+    query_cmd = 'psql {database} -At -p {db_port} -h {db_host} -U {db_user} -c'.format(
+        **database_config)
+    query = "SELECT count(*) FROM pg_stat_activity WHERE state = 'active' " \
+            "AND pid <> pg_backend_pid()"
+    shell = spur.LocalShell()
+    try:
+        res = shell.run(shlex.split(query_cmd) + [query], update_env=pg_env(database_config))
+    except spur.results.RunProcessError as error:
+        logger.warn('Could not count active connections: %s', error.stderr_output)
+        return None
+    return int(res.output.strip())
 
 
-def pgrestore_database(dump_name, database_config):
-    """ Restores a database dump in sql plain format, tries to create database if not exists
+def pgrestore_database(dump_name, database_config, jobs=1, profile=None, deferred=False):
+    """ Restores a database dump in sql plain format with psql or in custom or directory
+        format with pg_restore, tries to create database if not exists
 
     Args:
-        dump_name (str): Full path and name of the sql dump to restore
+        dump_name (str): Full path and name of the dump to restore, anything not ending
+                         with .sql is restored with pg_restore
         database_config (dict): Database configuration parameters needed to execute restore
+        jobs (int): Number of pg_restore jobs, for sql dumps the number of connections that
+                    build the indexes and constraints if deferred is set
+        profile (str): Optional profiles.PROFILES name or file, the data of its tables is
+                       not restored: sql dumps are filtered on their way to psql and the
+                       TABLE DATA entries are removed from the pg_restore list, the
+                       foreign keys to those tables are created NOT VALID
+        deferred (bool): If True the indexes and constraints of sql dumps are built after
+                         the data is loaded and on jobs connections (see start_psql)
     Returns:
         None if could not restore database, True otherwise
     """
+    if dump_name.endswith('.sql'):
+        restore_cmd = 'psql {database} -f {0} -p {db_port} -h {db_host} -U {db_user}' \
+            .format(dump_name, **database_config)
+    else:
+        restore_cmd = ('pg_restore -d {database} -O -j {0} -p {db_port} -h {db_host}'
+                       ' -U {db_user} {1}').format(jobs, dump_name, **database_config)
+    if not createdb_direct(database_config):
+        return None
+
+    shell = spur.LocalShell()
+    with metrics.stage('restore_db') as stage:
+        try:
+            if (profile or deferred) and dump_name.endswith('.sql'):
+                process = start_psql(database_config, profile, jobs if deferred else None)
+                with open(dump_name, 'rb') as fin:
+                    shutil.copyfileobj(fin, process.writer, 1024 * 1024)
+                if not wait_psql(process):
+                    dropdb_direct(database_config)
+                    return None
+            elif profile:
+                profile_info = profiles.get_profile(profile)
+                toc = shell.run(['pg_restore', '-l', dump_name]).output
+                fks = profiles.not_valid_fks(
+                    shell.run(['pg_restore', '--section=post-data', dump_name]).output,
+                    profile_info)
+                list_name = '{0}.list'.format(dump_name.rstrip('/'))
+                with open(list_name, 'w') as fout:
+                    fout.write(profiles.filter_toc(toc, profile_info, fks))
+                shell.run(shlex.split(restore_cmd) + ['-L', list_name],
+                          update_env=pg_env(database_config))
+                clean_files(list_name)
+                if fks:
+                    logger.info('Creating %s foreign keys to the profile tables NOT VALID',
+                                len(fks))
+                    if not run_psql(database_config, ''.join(fks.values())):
+                        dropdb_direct(database_config)
+                        return None
+            else:
+                shell.run(shlex.split(restore_cmd), update_env=pg_env(database_config))
+        except spur.results.RunProcessError as error:
+            logger.error('Could not restore database, error message: %s', error.stderr_output)
+            dropdb_direct(database_config)
+            return None
+        stage['bytes_in'] = metrics.path_size(dump_name)
+    return True
+
+
+def createdb_direct(database_config):
+    """ Create the database of database_config
+
+    Returns:
+        True if it was created, None otherwise
+    """
     logger.debug("Creating database %s", database_config.get('database'))
-    if database_config.get('db_password') != 'False':
-        os.environ['PGPASSWORD'] = database_config.get('db_password')
     createdb_cmd = ('createdb {database} -T template1 -E utf8'
                     ' -U {db_user} -p {db_port} -h {db_host}')
     createdb_cmd = createdb_cmd.format(**database_config)
-    restore_cmd = 'psql {database} -f {0} -p {db_port} -h {db_host} -U {db_user}' \
-        .format(dump_name, **database_config)
-
     shell = spur.LocalShell()
     try:
-        shell.run(shlex.split(createdb_cmd))
+        shell.run(shlex.split(createdb_cmd), update_env=pg_env(database_config))
     except spur.results.RunProcessError as error:
         logger.error('Could not create database, error message: %s', error.stderr_output)
         return None
+    return True
+
+
+def start_psql(database_config, profile=None, post_data_jobs=None):
+    """ Starts psql reading a sql dump from its stdin, the dump goes through
+        profiles.filter_sql in a thread when a profile is given
 
+    Args:
+        database_config (dict): Database configuration parameters needed to execute psql
+        profile (str): Optional profiles.PROFILES name or file
+        post_data_jobs (int): If set the data is loaded with DEFERRED_SETTINGS and the
+                              post-data section (indexes, constraints...) is kept by a
+                              sections.SectionSplitter, wait_psql builds it afterwards
+                              with build_post_data on this number of connections
+    Returns:
+        The running process, the dump must be written into its writer attribute and
+        wait_psql must be called once it was written
+    """
+    restore_cmd = 'psql {database} -q -p {db_port} -h {db_host} -U {db_user}'.format(
+        **database_config)
+    stderr_file = TemporaryFile()
+    # close_fds, so the pipes of other psql started by the threads of build_post_data
+    # (or of the profile filter) are not inherited and all of them get their EOF
+    process = subprocess.Popen(shlex.split(restore_cmd), stdin=subprocess.PIPE,
+                               stdout=stderr_file, stderr=stderr_file, close_fds=True,
+                               env=dict(os.environ, **pg_env(database_config)))
+    process.stderr_file = stderr_file
+    process.sink = process.stdin
+    process.splitter = None
+    if post_data_jobs:
+        process.stdin.write(DEFERRED_SETTINGS)
+        process.splitter = process.sink = sections.SectionSplitter(process.stdin)
+        process.database_config = database_config
+        process.post_data_jobs = post_data_jobs
+    process.writer = process.sink
+    process.filter_thread = None
+    if profile:
+        profile_info = profiles.get_profile(profile)
+        read_fd, write_fd = os.pipe()
+        process.writer = os.fdopen(write_fd, 'wb')
+
+        def run_filter():
+            # the read end is closed on errors so the writer does not block
+            with os.fdopen(read_fd, 'rb') as fin:
+                process.filter_stats = profiles.filter_sql(fin, process.sink, profile_info)
+
+        process.filter_thread = threading.Thread(target=run_filter)
+        process.filter_thread.daemon = True
+        process.filter_thread.start()
+    return process
+
+
+def wait_psql(process, warn=False):
+    """ Waits for a psql started with start_psql and checks its result, the post-data
+        of deferred restores is built once the data was loaded
+
+    Args:
+        process (Popen): The psql process
+        warn (bool): Log the output of psql as a warning when it succeeds, without
+                     ON_ERROR_STOP it only fails if it can not run the sql at all
+    Returns:
+        True if the dump was restored, None otherwise
+    """
     try:
-        shell.run(shlex.split(restore_cmd))
-    except spur.results.RunProcessError as error:
-        logger.error('Could not restore database, error message: %s', error.stderr_output)
-        dropdb_direct(database_config)
+        process.writer.close()
+    except IOError:
+        # psql already exited, its output tells why
+        pass
+    if process.filter_thread:
+        process.filter_thread.join()
+        try:
+            process.sink.close()
+        except IOError:
+            pass
+    returncode = process.wait()
+    process.stderr_file.seek(0)
+    stderr_output = process.stderr_file.read()
+    process.stderr_file.close()
+    if returncode != 0:
+        logger.error('Could not restore database, error message: %s', stderr_output)
         return None
+    if warn and stderr_output:
+        logger.warn('psql output: %s', stderr_output)
+    stats = getattr(process, 'filter_stats', None)
+    if process.filter_thread and stats is None:
+        logger.error('Could not filter the dump with the profile')
+        return None
+    if stats:
+        logger.info('%s rows skipped and %s changed by the profile, %s foreign keys'
+                    ' NOT VALID', stats['skipped'], stats['changed'], stats['not_valid'])
+    if process.splitter:
+        return build_post_data(process.splitter.entries, process.database_config,
+                               process.post_data_jobs)
     return True
 
 
+def run_psql(database_config, sql):
+    """ Runs sql with psql, the errors of the statements are logged as warnings
+
+    Returns:
+        True if psql could run it, None otherwise
+    """
+    process = start_psql(database_config)
+    try:
+        process.writer.write(sql)
+    except IOError:
+        # psql exited, wait_psql tells why
+        pass
+    return wait_psql(process, warn=True)
+
+
+def build_post_data(entries, database_config, jobs=1):
+    """ Builds the post-data section of a plain dump, split by sections.SectionSplitter,
+        running the jobs of sections.post_data_jobs on up to jobs psql connections with
+        DEFERRED_SETTINGS. Like pg_restore -j, a job does not start while another one
+        that uses the same tables is running, so they neither wait for nor deadlock
+        each other
+
+    Args:
+        entries (list): Post-data entries of the SectionSplitter
+        database_config (dict): Database configuration parameters needed to execute psql
+        jobs (int): Number of connections
+    Returns:
+        True if every job could be run, None otherwise
+    """
+    res = True
+    done = Queue.Queue()
+
+    def run_job(job):
+        done.put((job, run_psql(database_config, DEFERRED_SETTINGS + job['sql'])))
+
+    with metrics.stage('post_data') as stage:
+        phases = sections.post_data_jobs(entries)
+        logger.info('Building %s post-data entries with %s jobs', len(entries), jobs)
+        for phase in phases:
+            pending = list(phase)
+            running = []
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    if any(job['locks'] & other['locks'] for other in running):
+                        continue
+                    pending.remove(job)
+                    running.append(job)
+                    thread = threading.Thread(target=run_job, args=(job,))
+                    thread.daemon = True
+                    thread.start()
+                job, result = done.get()
+                running.remove(job)
+                if not result:
+                    res = None
+        stage['bytes_in'] = sum(len(job['sql']) for phase in phases for job in phase)
+    return res
+
+
 def get_docker_env(container_name, docker_url="unix://var/run/docker.sock"):
     """ Get env vars from a docker container
     Args:
@@ -551,15 +3142,187 @@ def get_docker_env(container_name, docker_url="unix://var/run/docker.sock"):
     return res
 
 
+def read_container_file(cli, container_name, path):
+    """ Read a file of a container with the Docker archive API
+
+    Args:
+        cli (Client): Docker client
+        container_name (str): Container name or id
+        path (str): Full path to the file in the container
+    Returns:
+        The content of the file
+    """
+    stream, _ = cli.get_archive(container_name, path)
+    tar = tarfile.open(fileobj=stream, mode='r|')
+    try:
+        for member in tar:
+            if member.isreg():
+                return tar.extractfile(member).read()
+    finally:
+        tar.close()
+        stream.close()
+    raise RuntimeError('{0} is not a file in the container {1}'.format(path, container_name))
+
+
+def container_data_dir(cli, container_name, env_vars):
+    """ data_dir of the Odoo config file of a container, the file is the one set in its
+        ODOO_CONFIG_FILE env var
+
+    Returns:
+        The data_dir, None if the config file could not be read
+    """
+    odoo_config_file = env_vars.get('ODOO_CONFIG_FILE')
+    try:
+        config = read_container_file(cli, container_name, odoo_config_file)
+    except docker.errors.APIError as error:
+        logger.error("Could not get the config file '%s': %s", odoo_config_file,
+                     error.explanation)
+        return None
+    for line in config.split('\n'):
+        if line.strip().startswith("data_dir"):
+            return line.split("=")[1].strip()
+    logger.error("There is no data_dir in the config file '%s'", odoo_config_file)
+    return None
+
+
+def container_filestore_stream(odoo_config, docker_url="unix://var/run/docker.sock"):
+    """ Open the filestore of the database in a docker container as a tar stream with the
+        archive API (get_archive), so it can be added to a backup while it is read
+
+    Args:
+        odoo_config (dict): configuration with odoo_container and database
+        docker_url (str): url to use in docker cli client
+    Returns:
+        File like object with the tar data, its top folder is the database name,
+        None if there is no filestore in the container
+    """
+    container_name = odoo_config.get('odoo_container')
+    cli = Client(base_url=docker_url, timeout=3000)
+    env_vars = get_docker_env(container_name, docker_url)
+    if env_vars is None:
+        return None
+    data_dir = container_data_dir(cli, container_name, env_vars)
+    if not data_dir:
+        return None
+    fs_name = os.path.join(data_dir, "filestore", odoo_config.get('database'))
+    try:
+        stream, _ = cli.get_archive(container_name, fs_name)
+    except docker.errors.APIError as error:
+        logger.warn('Folder "%s:%s" could not be read, attachments are not being added'
+                    ' to the backup: %s', container_name, fs_name, error.explanation)
+        return None
+    logger.info('Streaming the filestore from %s:%s', container_name, fs_name)
+    return stream
+
+
+def container_exec(cli, container_name, cmd):
+    """ Run a command in a container and wait for it to finish
+
+    Args:
+        cli (Client): Docker client
+        container_name (str): Container name or id
+        cmd (list): Command and its arguments
+    Returns:
+        The output of the command
+    Raises:
+        RuntimeError if the command failed
+    """
+    exec_id = cli.exec_create(container_name, cmd)
+    res = cli.exec_start(exec_id.get('Id'))
+    exit_code = cli.exec_inspect(exec_id.get('Id')).get('ExitCode')
+    if exit_code:
+        raise RuntimeError('"{0}" failed in the container {1} ({2}): {3}'.format(
+            ' '.join(cmd), container_name, exit_code, res))
+    return res
+
+
+def container_user(cli, container_name, user):
+    """ uid and gid of a user of a container, read from its /etc/passwd
+
+    Returns:
+        Tuple (uid, gid)
+    """
+    for line in read_container_file(cli, container_name, '/etc/passwd').splitlines():
+        fields = line.split(':')
+        if len(fields) > 3 and fields[0] == user:
+            return int(fields[2]), int(fields[3])
+    raise RuntimeError('There is no user {0} in the container {1}'.format(user,
+                                                                         container_name))
+
+
+def tar_folder_stream(src_folder, arcname, owner=None, user=None):
+    """ Generate a tar with a folder by chunks, so it can be uploaded while it is made
+        without writing it anywhere, the folders of arcname are added too. Only
+        folders and regular files are added
+
+    Args:
+        src_folder (str): Folder to add
+        arcname (str): Name of the folder in the tar
+        owner (tuple): Optional (uid, gid) set in the headers of every member
+        user (str): User and group name set with owner
+    Yields:
+        The tar data
+    """
+    def header(name, full_name=None):
+        info = tarfile.TarInfo(name)
+        info.mode = 0o755
+        info.mtime = time.time()
+        info.type = tarfile.DIRTYPE
+        if full_name:
+            file_stat = os.stat(full_name)
+            info.mode = file_stat.st_mode & 0o7777
+            info.mtime = file_stat.st_mtime
+            if not os.path.isdir(full_name):
+                info.type = tarfile.REGTYPE
+                info.size = file_stat.st_size
+        if owner:
+            info.uid, info.gid = owner
+            info.uname = info.gname = user or ''
+        return info
+
+    parents = arcname.strip('/').split('/')[:-1]
+    for pos in range(len(parents)):
+        yield header('/'.join(parents[:pos + 1])).tobuf(tarfile.GNU_FORMAT)
+    for root, dirs, fnames in os.walk(src_folder):
+        dirs.sort()
+        folder = os.path.normpath(os.path.join(arcname, os.path.relpath(root, src_folder)))
+        yield header(folder, root).tobuf(tarfile.GNU_FORMAT)
+        for fname in sorted(fnames):
+            full_name = os.path.join(root, fname)
+            if not os.path.isfile(full_name):
+                logger.warn('Skipping %s, it is not a regular file', full_name)
+                continue
+            info = header(os.path.join(folder, fname), full_name)
+            yield info.tobuf(tarfile.GNU_FORMAT)
+            with open(full_name, 'rb') as fin:
+                size = 0
+                for data in iter(lambda: fin.read(min(ZIP_READ_SIZE, info.size - size)), ''):
+                    size += len(data)
+                    yield data
+            if size != info.size:
+                raise RuntimeError('{0} changed while it was added'.format(full_name))
+            if size % tarfile.BLOCKSIZE:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
 def restore_docker_filestore(src_folder, odoo_config,
                              docker_url="unix://var/run/docker.sock"):
-    """ Restore a filestore folder into a docker container that is already running
-        and has the /tmp folder mounted as a volume un the host
+    """ Restore a filestore folder into a docker container that is already running, it
+        is streamed into the data_dir of the container as a tar with the archive API
+        (put_archive) with the owner of the Odoo user and the permissions in the tar
+        headers, so no volume mounted in the host nor chown are needed. It is uploaded
+        into a staging folder next to the filestore, which is swapped in only once the
+        upload succeeded
 
     Args:
         src_folder (str): Full path to the folder thar contains the filestore you want to restore
         odoo_config (dict): configuration
         docker_url (str): url to use in docker cli client
+    Returns:
+        True if the filestore was restored, None otherwise
+    Raises:
+        RuntimeError if the upload or the swap failed
     """
     container_name = odoo_config.get('odoo_container')
     cli = Client(base_url=docker_url, timeout=3000)
@@ -575,116 +3338,413 @@ def restore_docker_filestore(src_folder, odoo_config,
     if not ports:
         logger.error('Container "%s" is not running', container_name)
         return None
-
-    mounts = inspected.get('Mounts')
-    for mount in mounts:
-        if '/tmp' in mount['Destination']:
-            dest_folder = mount['Source']
-            break
-    else:
-        logger.error("Could not restore filestore into %s container", container_name)
-        logger.error("You should run the docker with a volume in /tmp")
+    if not os.path.isdir(src_folder):
+        logger.warn("No filestore in the backup file")
         return None
-    try:
-        shutil.move(src_folder, dest_folder)
-    except shutil.Error as error:
-        if "already exists" in error.message:
-            folder = os.path.basename(src_folder)
-            logger.info("%s folder already exists, replacing", folder)
-            clean_files(os.path.join(dest_folder, folder))
-            shutil.move(src_folder, dest_folder)
-        else:
-            raise
-    except IOError as error:
-        if "No such file or directory" in error.strerror:
-            logger.warn("No filestore in the backup file")
-        else:
-            raise
-    env_vars = get_docker_env(container_name)
-    odoo_config_file = env_vars.get('ODOO_CONFIG_FILE')
-    try:
-        res = cli.copy(container_name, odoo_config_file)
-    except docker.errors.APIError as error:
-        if "Could not find the file" in error.message:
-            logger.error("Odoo config file is not in the path '%s'", odoo_config_file)
-        else:
-            logger.error("Could not get the config file '%s'", error.message)
+    env_vars = get_docker_env(container_name, docker_url)
+    data_dir = container_data_dir(cli, container_name, env_vars)
+    if not data_dir:
         return None
-    for line in res.data.split('\n'):
-        if line.strip().startswith("data_dir"):
-            data_dir = line.split("=")[1].strip()
-            break
+    user = env_vars.get('ODOO_USER') or 'odoo'
+    owner = container_user(cli, container_name, user)
     fs_name = os.path.join(data_dir, "filestore", odoo_config.get('database'))
-    exec_id = cli.exec_create(container_name, "rm -rf {0}".format(fs_name))
-    res = cli.exec_start(exec_id.get('Id'))
-    if res:
-        logger.info("Removing previous filestore returned '%s'", res)
-    exec_id = cli.exec_create(container_name, "mv /tmp/filestore {0}".format(fs_name))
-    res = cli.exec_start(exec_id.get('Id'))
-    if res:
-        logger.info("Moving filestore returned '%s'", res)
-    exec_id = cli.exec_create(container_name, "chown -R {0}:{0} {1}"
-                              .format(env_vars.get('ODOO_USER'), fs_name))
-    res = cli.exec_start(exec_id.get('Id'))
-    if res:
-        logger.info("Changing filestore owner returned '%s'", res)
+    staging = filestore_staging(fs_name)
+    old_name = os.path.join(os.path.dirname(fs_name), '.{0}.old'.format(
+        odoo_config.get('database')))
+    container_exec(cli, container_name, ['rm', '-rf', staging, old_name])
+    logger.info('Streaming the filestore into %s:%s', container_name, staging)
+    try:
+        uploaded = cli.put_archive(container_name, data_dir, tar_folder_stream(
+            src_folder, os.path.relpath(staging, data_dir), owner, user))
+    except docker.errors.APIError as error:
+        logger.error('Upload of the filestore failed: %s', error.explanation)
+        uploaded = False
+    if not uploaded:
+        container_exec(cli, container_name, ['rm', '-rf', staging])
+        raise RuntimeError('The filestore could not be uploaded to {0}:{1}, the previous one'
+                           ' was kept'.format(container_name, fs_name))
+    # like swap_folder, the previous filestore is only removed once the new one is in place
+    container_exec(cli, container_name, [
+        'sh', '-c', 'if [ -e "$1" ]; then mv "$1" "$3"; fi && mv "$2" "$1" && rm -rf "$3"',
+        'sh', fs_name, staging, old_name])
+    return True
+
+
+def filestore_staging(dest_folder):
+    """ Staging folder of a filestore, next to it so it is in the same filesystem and
+        install_filestore can put it in place with a rename
+    """
+    return os.path.join(os.path.dirname(dest_folder.rstrip('/')),
+                        '.{0}.restoring'.format(os.path.basename(dest_folder.rstrip('/'))))
+
+
+def copy_folder_files(args):
+    """ Copy the files of a folder keeping their times, run by the threads of copy_tree
+
+    Returns:
+        Tuple (number of files, bytes) copied
+    """
+    src, dest, fnames = args
+    size = 0
+    for fname in fnames:
+        shutil.copy2(os.path.join(src, fname), os.path.join(dest, fname))
+        size += os.path.getsize(os.path.join(dest, fname))
+    return len(fnames), size
+
 
+def copy_tree(src_folder, dest_folder, jobs=FILESTORE_COPY_JOBS):
+    """ Copy a folder with a pool of threads, the folders are made while src_folder
+        is walked and their files are copied by the threads, so with millions of small
+        attachments (spread by Odoo in 256 folders) many of them are being read and
+        written at the same time. Only the pending folders are queued, not every file
+
+    Args:
+        src_folder (str): Folder to copy
+        dest_folder (str): Destination folder, it must not exist
+        jobs (int): Number of threads
+    Returns:
+        dict with the number of files and bytes copied
+    """
+    def walk():
+        for root, _, fnames in os.walk(src_folder):
+            target = os.path.normpath(os.path.join(dest_folder, os.path.relpath(root,
+                                                                                src_folder)))
+            os.makedirs(target)
+            yield root, target, fnames
+
+    stats = {'copied': 0, 'copied_bytes': 0}
+    pool = ThreadPool(jobs)
+    try:
+        for copied, size in pool.imap_unordered(copy_folder_files, walk()):
+            stats['copied'] += copied
+            stats['copied_bytes'] += size
+    finally:
+        pool.terminate()
+        pool.join()
+    return stats
+
+
+def swap_folder(src_folder, dest_folder):
+    """ Put src_folder in place of dest_folder with a rename, they must be in the same
+        filesystem. An existing dest_folder is renamed out of the way first and removed
+        once src_folder is in place
+    """
+    old_folder = None
+    if os.path.exists(dest_folder):
+        old_folder = os.path.join(os.path.dirname(dest_folder.rstrip('/')),
+                                  '.{0}.old'.format(os.path.basename(dest_folder.rstrip('/'))))
+        clean_files(old_folder)
+        os.rename(dest_folder, old_folder)
+    os.rename(src_folder, dest_folder)
+    if old_folder:
+        clean_files(old_folder)
+
+
+def install_filestore(src_folder, dest_folder, jobs=FILESTORE_COPY_JOBS):
+    """ Move a restored filestore to dest_folder: if src_folder is in the same
+        filesystem it is just renamed, otherwise it is copied with copy_tree into the
+        staging folder (filestore_staging) and then renamed, so dest_folder is never
+        seen half copied
 
-def restore_instance_filestore(src_folder, odoo_config):
+    Args:
+        src_folder (str): Restored filestore, it is removed
+        dest_folder (str): Filestore folder of the database
+        jobs (int): Number of threads used to copy it
+    Returns:
+        dict with the number of files and bytes copied, 0 if it was renamed
+    """
+    stats = {'copied': 0, 'copied_bytes': 0}
+    parent = os.path.dirname(dest_folder.rstrip('/'))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    staging = src_folder
+    if os.stat(src_folder).st_dev != os.stat(parent).st_dev:
+        staging = filestore_staging(dest_folder)
+        clean_files(staging)
+        logger.info('Copying the filestore from another filesystem with %s threads', jobs)
+        stats = copy_tree(src_folder, staging, jobs)
+        clean_files(src_folder)
+    swap_folder(staging, dest_folder)
+    return stats
+
+
+def restore_instance_filestore(src_folder, odoo_config, link=False):
     """ Restore filestore to a instance directly
     Args:
         src_folder (str): Full path to the folder thar contains the filestore you want to restore
         odoo_config (dict): Odoo configuration
+        link (bool): Keep src_folder and hard-link its files (copy them if they are in
+                     another filesystem) instead of moving it
 
     """
     dest_folder = os.path.join(odoo_config.get('data_dir'),
                                'filestore',
                                odoo_config.get('database'))
-    shutil.move(src_folder, dest_folder)
+    if not os.path.isdir(src_folder):
+        logger.warn("No filestore in the backup file")
+        return
+    if link:
+        staging = filestore_staging(dest_folder)
+        clean_files(staging)
+        stats = link_tree(src_folder, staging, src_folder)
+        swap_folder(staging, dest_folder)
+        logger.info('Filestore restored, %s files linked and %s copied',
+                    stats['linked'], stats['copied'])
+    else:
+        stats = install_filestore(src_folder, dest_folder)
+        if stats['copied']:
+            logger.info('Filestore restored, %s files copied', stats['copied'])
 
 
 def backup_database_direct(odoo_config, dest_folder, reason=False,
-                           tmp_dir=False, cformat='bz2'):
+                           tmp_dir=False, cformat='bz2', stream=False, jobs=1,
+                           level=None, dump_format='plain', incremental=False, index=False,
+                           throttle=None, snapshot=False, delta=False, full_every=7,
+                           profile=None, delta_max_size=DELTA_MAX_SIZE):
     """ Receive database name and back it up
 
     Args:
         odoo_config (dict): Odoo config for the backup process
-        dest_folder (str): Folder where the backup will be stored
+        dest_folder (str): Folder or object storage url (s3://bucket/prefix) where the
+                           backup will be stored
         reason (str): Optional parameter that is used in case
                       there is a particular reason for the backup
         tmp_dir (str): Optional parameter to store the temporary working dir, default is /tmp
+        stream (bool): If True pg_dump output is piped straight into the compressed file
+                       instead of being written into tmp_dir first
+        jobs (int): Number of processes used to compress the backup and
+                    of pg_dump jobs in directory format
+        cformat (str): Compression format, one of COMPRESSION_FORMATS
+        level (int): Compression level
+        dump_format (str): pg_dump format, one of DUMP_FORMATS
+        incremental (bool): If True the filestore files are stored in the content addressed
+                            store OBJECT_STORE_NAME inside dest_folder and only the list
+                            of files is added to the backup
+        index (bool): If True an index to extract single files is saved next to the backup
+        throttle (Throttle): Optional throttle.Throttle for the compression
+        snapshot (bool): If True a snapshot folder is made with backup_database_snapshot
+        delta (bool): If True the plain dump is stored as a patch against the dump of the
+                      previous backup (see delta_dump)
+        full_every (int): Backups in a delta chain, the full one included, DELTA_MAX_CHAIN
+                          at most
+        profile (str): Optional profiles.PROFILES name or file, the data of its tables is
+                       not dumped
+        delta_max_size (int): Bytes of the biggest dump stored as a delta, DELTA_MAX_SIZE
+                              at most
 
     Returns:
         Full path to the backup
     """
+    if storage.is_url(dest_folder) and (snapshot or incremental or delta):
+        raise RuntimeError('Snapshot, incremental and delta backups need a local backup dir')
+    if delta and (snapshot or stream or dump_format != 'plain'):
+        raise RuntimeError('Delta backups need a plain dump written to the temp dir'
+                           ' (no stream) and can not be snapshots')
+    if delta and full_every > DELTA_MAX_CHAIN:
+        logger.warn('Delta chains have %s backups at most, not %s', DELTA_MAX_CHAIN,
+                    full_every)
+    if delta and delta_max_size > DELTA_MAX_SIZE:
+        logger.warn('zstd can not patch dumps of more than %s bytes, bigger dumps are'
+                    ' backed up full', DELTA_MAX_SIZE)
+    if snapshot:
+        return backup_database_snapshot(odoo_config, dest_folder, reason, tmp_dir, cformat,
+                                        stream, jobs, level, dump_format, throttle, profile)
     if not tmp_dir:
         tmp_dir = gettempdir()
-    dump_name = pgdump_database(tmp_dir, odoo_config)
-    if not dump_name:
-        logger.error('Database could not be dumped')
+    dump_name, dump_process = start_dump(odoo_config, tmp_dir, dump_format, jobs, stream,
+                                         profile)
+    if not (dump_name or dump_process):
         return None
+    streams = []
+    if stream:
+        streams.append((dump_process.stdout, DUMP_FORMATS[dump_format][1]))
     bkp_name = generate_backup_name(odoo_config.get('database'), reason)
-    files2backup = [dump_name]
+    files2backup = [dump_name] if dump_name else []
+    delta_name, delta_info = None, {}
+    if delta:
+        delta_name, delta_info = delta_dump(dump_name, dest_folder, odoo_config.get('database'),
+                                            tmp_dir, full_every,
+                                            level if cformat == 'zstd' else None, jobs,
+                                            delta_max_size)
+        if delta_name:
+            files2backup = [(delta_name, DELTA_DUMP_NAME)]
+    filestore_index = None
+    archives = []
     if odoo_config.get('data_dir'):
         attachments_folder = os.path.join(odoo_config.get('data_dir'),
                                           'filestore',
                                           odoo_config.get('database'))
-        if os.path.exists(attachments_folder):
+        if os.path.exists(attachments_folder) and incremental:
+            logger.debug('Attachments folder "%s" (incremental)', attachments_folder)
+            with metrics.stage('filestore') as stage:
+                objects = store_filestore_objects(attachments_folder,
+                                                  os.path.join(dest_folder, OBJECT_STORE_NAME))
+                stage['bytes_in'] = sum(item['size'] for item in objects)
+            filestore_index = save_json(objects, os.path.join(tmp_dir, '{0}_{1}'.format(
+                bkp_name, FILESTORE_INDEX_NAME)))
+            files2backup.append((filestore_index, FILESTORE_INDEX_NAME))
+        elif os.path.exists(attachments_folder):
             logger.debug('Attachments folder "%s"', attachments_folder)
             files2backup.append((attachments_folder, 'filestore'))
         else:
             logger.warn(('Folder "%s" does not exists,'
                          ' attachments are not being added to the backup'), attachments_folder)
+    elif odoo_config.get('odoo_container'):
+        if incremental:
+            logger.warn('Incremental backups need the data_dir mounted in the host,'
+                        ' the whole filestore is added')
+        filestore_stream = container_filestore_stream(odoo_config)
+        if filestore_stream:
+            archives.append((filestore_stream, 'filestore'))
     else:
         logger.info('There is not attachments folder to backup')
     logger.info('Compressing files')
     logger.debug('Files : %s', str(files2backup))
-    full_name = compress_files(bkp_name, files2backup, dest_folder=dest_folder, cformat=cformat)
+    info = {
+        'database': odoo_config.get('database'),
+        'dump_format': dump_format,
+        'odoo_version': get_odoo_version(odoo_config),
+        'incremental': bool(filestore_index),
+        'profile': profile or None,
+    }
+    info.update(delta_info)
+    compressed = False
+    try:
+        full_name = compress_files(bkp_name, files2backup, dest_folder=dest_folder,
+                                   cformat=cformat, streams=streams, jobs=jobs,
+                                   level=level, info=info, index=index, throttle=throttle,
+                                   archives=archives)
+        compressed = True
+    finally:
+        if stream and not compressed:
+            kill_pgdump(dump_process)
+        for filestore_stream, _ in archives:
+            filestore_stream.close()
+    if filestore_index:
+        clean_files(filestore_index)
+    if delta_name:
+        clean_files(delta_name)
+    if stream and not wait_pgdump(dump_process):
+        logger.error('Database could not be dumped')
+        target = storage.get_storage(dest_folder)
+        if target:
+            for name in target.list(os.path.basename(full_name)):
+                target.delete(name)
+        else:
+            clean_files([full_name, full_name + INDEX_EXTENSION])
+        return None
     logger.info('Compressed backup, cleaning')
-    clean_files(dump_name)
+    if delta:
+        save_delta_base(dump_name, full_name, odoo_config.get('database'),
+                        delta_info['delta_depth'])
+    elif dump_name:
+        clean_files(dump_name)
+    if not storage.is_url(full_name):
+        catalog.record_backup(full_name, odoo_config.get('database'), reason)
     return full_name
 
 
+def start_dump(odoo_config, tmp_dir, dump_format='plain', jobs=1, stream=False, profile=None):
+    """ Dump the database into tmp_dir or start pg_dump writing to its stdout
+
+    Returns:
+        (dump name, None) or (None, pg_dump process) if stream is True,
+        (None, None) if the database could not be dumped
+    """
+    if stream:
+        return None, pgdump_database_stream(odoo_config, dump_format, profile)
+    dump_name = pgdump_database(tmp_dir, odoo_config, dump_format, jobs, profile)
+    if not dump_name:
+        logger.error('Database could not be dumped')
+    return dump_name, None
+
+
+def backup_database_snapshot(odoo_config, dest_folder, reason=False, tmp_dir=False,
+                             cformat='bz2', stream=False, jobs=1, level=None,
+                             dump_format='plain', throttle=None, profile=None):
+    """ Backup a database into a snapshot folder, like rsync --link-dest: the dump is
+        compressed into SNAPSHOT_DUMP_NAME.tar.<ext> and the filestore is copied as plain
+        files, hard-linking the ones that did not change since the previous snapshot of
+        the database, so only new attachments are written. Removing a snapshot does
+        not affect the others
+
+    Args:
+        odoo_config (dict): Odoo config for the backup process
+        dest_folder (str): Folder where the snapshot folder will be created, it must be in
+                           the same filesystem as the previous snapshots
+        reason (str): Optional reason of the backup
+        tmp_dir (str): Temporary working dir, default is /tmp
+        cformat (str): Compression format of the dump, one of COMPRESSION_FORMATS
+        stream (bool): If True pg_dump output is piped straight into the compressed dump
+        jobs (int): Number of processes used to compress the dump and of pg_dump jobs
+        level (int): Compression level
+        dump_format (str): pg_dump format, one of DUMP_FORMATS
+        throttle (Throttle): Optional throttle.Throttle for the compression
+        profile (str): Optional profile, the data of its tables is not dumped
+
+    Returns:
+        Full path to the snapshot folder
+    """
+    if not tmp_dir:
+        tmp_dir = gettempdir()
+    database_name = odoo_config.get('database')
+    previous = find_snapshot(dest_folder, database_name)
+    snapshot_dir = os.path.join(dest_folder, generate_backup_name(database_name, reason))
+    partial_dir = snapshot_dir + '.partial'
+    os.makedirs(partial_dir)
+    dump_name, dump_process = start_dump(odoo_config, tmp_dir, dump_format, jobs, stream,
+                                         profile)
+    if not (dump_name or dump_process):
+        clean_files(partial_dir)
+        return None
+    info = {
+        'database': database_name,
+        'created': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'dump_format': dump_format,
+        'odoo_version': get_odoo_version(odoo_config),
+        'previous': os.path.basename(previous) if previous else None,
+        'profile': profile or None,
+    }
+    streams = [(dump_process.stdout, DUMP_FORMATS[dump_format][1])] if stream else []
+    logger.info('Compressing dump')
+    compressed = False
+    try:
+        dump_archive = compress_files(SNAPSHOT_DUMP_NAME, [dump_name] if dump_name else [],
+                                      dest_folder=partial_dir, cformat=cformat,
+                                      streams=streams, jobs=jobs, level=level, info=info,
+                                      throttle=throttle)
+        compressed = True
+    finally:
+        if not compressed:
+            if stream:
+                kill_pgdump(dump_process)
+            clean_files(partial_dir)
+    if dump_name:
+        clean_files(dump_name)
+    if stream and not wait_pgdump(dump_process):
+        logger.error('Database could not be dumped')
+        clean_files(partial_dir)
+        return None
+    info['dump'] = os.path.basename(dump_archive)
+    attachments_folder = os.path.join(odoo_config.get('data_dir') or '', 'filestore',
+                                      database_name)
+    if odoo_config.get('data_dir') and os.path.exists(attachments_folder):
+        logger.info('Snapshot of the filestore, previous snapshot: %s', previous)
+        with metrics.stage('filestore') as stage:
+            info.update(link_tree(attachments_folder, os.path.join(partial_dir, 'filestore'),
+                                  os.path.join(previous, 'filestore') if previous else None))
+            stage['bytes_in'] = info['linked_bytes'] + info['copied_bytes']
+            stage['bytes_out'] = info['copied_bytes']
+        logger.info('%s files linked and %s copied', info['linked'], info['copied'])
+    else:
+        logger.warn('Folder "%s" does not exists, attachments are not being added to the'
+                    ' backup', attachments_folder)
+    save_json(info, os.path.join(partial_dir, SNAPSHOT_NAME))
+    os.rename(partial_dir, snapshot_dir)
+    catalog.record_backup(snapshot_dir, database_name, reason)
+    return snapshot_dir
+
+
 def parse_docker_config(container_name, docker_url="unix://var/run/docker.sock"):
     """Parse env vars from a container to get the needed parameters to dump the database
 
@@ -723,11 +3783,8 @@ def parse_docker_config(container_name, docker_url="unix://var/run/docker.sock")
             res.update({'data_dir': mount['Source']})
             break
     else:
-        logger.error('Datadir not found, wont be able to backup attachments')
-
-    if not res.get('data_dir'):
-        logger.error(('The attachments dicrectory was not mounted from the host,'
-                      ' wont be able to backup attachments'))
+        logger.info('The attachments directory was not mounted from the host,'
+                    ' they will be read with the docker archive API')
     res.update({'odoo_container': container_name})
     return res
 
@@ -739,13 +3796,11 @@ def dropdb_direct(database_config):
     return:
         True if success or None otherwise
     """
-    if database_config.get('db_password') != 'False':
-        os.environ['PGPASSWORD'] = database_config.get('db_password')
     dropdb_cmd = 'dropdb {database} -U {db_user} -p {db_port} -h {db_host}' \
                  .format(**database_config)
     shell = spur.LocalShell()
     try:
-        shell.run(shlex.split(dropdb_cmd))
+        shell.run(shlex.split(dropdb_cmd), update_env=pg_env(database_config))
     except spur.results.RunProcessError as error:
         if 'does not exist' in error.stderr_output:
             return True
@@ -761,25 +3816,14 @@ def remove_attachments(odoo_config):
         odoo_config (dict): Odoo configuration
     """
     if 'odoo_container' in odoo_config:
-        env_vars = get_docker_env(odoo_config.get('odoo_container'))
-        odoo_config_file = env_vars.get('ODOO_CONFIG_FILE')
+        container_name = odoo_config.get('odoo_container')
+        env_vars = get_docker_env(container_name)
         cli = Client()
-        try:
-            res = cli.copy(odoo_config.get('odoo_container'), odoo_config_file)
-        except docker.errors.APIError as error:
-            if "Could not find the file" in error.message:
-                logger.error("Odoo config file is not in the path '%s'", odoo_config_file)
-            else:
-                logger.error("Could not get the config file '%s'", error.message)
+        data_dir = container_data_dir(cli, container_name, env_vars)
+        if not data_dir:
             return None
-
-        for i in res.data.split('\n'):
-            if i.strip().startswith("data_dir"):
-                data_dir = i.split("=")[1].strip()
-                break
         fs_name = os.path.join(data_dir, "filestore", odoo_config.get('database'))
-        exec_id = cli.exec_create(odoo_config.get('odoo_container'), "rm -r {}".format(fs_name))
-        res = cli.exec_start(exec_id.get('Id'))
+        res = container_exec(cli, container_name, ['rm', '-rf', fs_name])
         if res:
             logger.info("Removing previous filestore returned '%s'", res)
     else:
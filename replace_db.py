@@ -8,6 +8,7 @@ import logging
 import configargparse
 import sys
 from lib import utils
+from lib import metrics
 from tempfile import mkdtemp, gettempdir
 
 logging.basicConfig(level=logging.DEBUG,
@@ -33,8 +34,32 @@ def main(main_args):
                help='Config file path', is_config_file=True)
     parser.add("-t", "--temp_dir", help="Temp working dir",
                default=gettempdir())
-    parser.add("-b", "--backup", help="Backup file to be restored",
+    parser.add("-b", "--backup", help="Backup file, snapshot folder or s3:// url to be restored",
                default=False, required=True)
+    parser.add("-j", "--jobs",
+               help=("Number of pg_restore jobs for custom and directory format dumps, and"
+                     " of connections that build the indexes of --deferred restores"),
+               type=int, default=1)
+    parser.add("-s", "--object_store",
+               help="Filestore objects folder of incremental backups (next to the backup by default)",
+               default=None)
+    parser.add("--profile",
+               help=("Restore the schema but not the data of the log-like tables of this"
+                     " profile (logs, test) or Json file"),
+               default=None)
+    parser.add("--stream",
+               help=("Pipe the sql dump into psql and extract the filestore next to the one"
+                     " of the instance while the backup is decompressed (no temp dump)"),
+               action='store_true', default=False)
+    parser.add("--deferred",
+               help=("Build the indexes and constraints of sql dumps after loading the"
+                     " data, on -j connections"),
+               action='store_true', default=False)
+    parser.add("--metrics_json", help="Json file where the stage timings are saved",
+               default=False)
+    parser.add("--metrics_prom",
+               help="Prometheus textfile collector file where the stage timings are saved",
+               default=False)
 
     args = parser.parse_args(main_args)
     utils.check_installation()
@@ -49,10 +74,15 @@ def main(main_args):
         odoo_cfg = utils.pase_odoo_configfile(args.odoo_configfile)
     odoo_cfg.update({'database': args.database})
     working_dir = mkdtemp(prefix='vxRestore_', dir=args.temp_dir)
+    metrics.start_run('restore', database=args.database)
+    res = None
     if utils.dropdb_direct(odoo_cfg):
         utils.remove_attachments(odoo_cfg)
-        utils.restore_direct(args.backup, odoo_cfg, working_dir)
+        res = utils.restore_direct(args.backup, odoo_cfg, working_dir, args.jobs,
+                                   args.object_store, args.profile, args.stream,
+                                   args.deferred)
     utils.clean_files(working_dir)
+    metrics.save_run(metrics.finish_run(res), args.metrics_json, args.metrics_prom)
 
 if __name__ == '__main__':
     logger.info("Starting backup process")
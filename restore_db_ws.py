@@ -8,6 +8,7 @@ import logging
 import configargparse
 import sys
 from lib import utils
+from lib import metrics
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -21,12 +22,22 @@ def main(main_args):
     """
     parser = configargparse.ArgumentParser()
     parser.add_argument("db", help="Database name", default=False)
-    parser.add_argument("-f", "--file", help="Backup name to resore", default=False, required=True)
+    parser.add_argument("-f", "--file", help="Backup name or s3:// url to resore",
+                        default=False, required=True)
     parser.add_argument("-t", "--temp_dir", help="Temp working dir", default="/tmp")
     parser.add_argument("-H", "--host", help="Host running Odoo", default="localhost")
     parser.add_argument("-p", "--port", help="Odoo xmlrpc port", default=8069)
     parser.add_argument("-u", "--user", help="Odoo super user", default="admin")
     parser.add_argument("-w", "--password", help="Odoo super user pass", default="admin")
+    parser.add_argument("-s", "--stream",
+                        help=("Upload the backup by chunks read straight from the archive,"
+                              " without extracting it in the temp dir (bounded memory)"),
+                        action='store_true', default=False)
+    parser.add_argument("--metrics_json", help="Json file where the stage timings are saved",
+                        default=False)
+    parser.add_argument("--metrics_prom",
+                        help="Prometheus textfile collector file where the stage timings are saved",
+                        default=False)
 
     args = parser.parse_args(main_args)
     if not utils.test_connection(args.db, args.host, args.port,
@@ -35,9 +46,14 @@ def main(main_args):
     if utils.database_exists(args.db, args.host, args.port):
         logger.error("Database %s already exits, aborting program", args.db)
         return 1
-    dump_dest = utils.decompress_files(args.file, args.temp_dir)
-    utils.restore_database(dump_dest, args.db, args.password, args.host, args.port)
-    utils.clean_files([dump_dest])
+    metrics.start_run('restore', database=args.db)
+    if args.stream:
+        utils.restore_database_stream(args.file, args.db, args.password, args.host, args.port)
+    else:
+        dump_dest = utils.decompress_files(args.file, args.temp_dir)
+        utils.restore_database(dump_dest, args.db, args.password, args.host, args.port)
+        utils.clean_files([dump_dest])
+    metrics.save_run(metrics.finish_run(), args.metrics_json, args.metrics_prom)
     return 0
 
 if __name__ == '__main__':
@@ -8,8 +8,10 @@ import os
 import datetime
 import logging
 import configargparse
+from tempfile import mkdtemp
 
 from lib import utils
+from lib import catalog
 from deactivate_ws import deactivate
 
 parser = configargparse.ArgumentParser()
@@ -29,6 +31,16 @@ parser.add_argument("--active-config-file",
                     help="Active database config file. Same as test database by default",
                     default=False)
 parser.add_argument("--temp-dir", help="Temp working dir", default="/tmp")
+parser.add_argument("--backup-database",
+                    help=("Database whose latest backup in --backup-path is used, the"
+                          " newest backup of any database if not set"),
+                    default=None)
+parser.add_argument("--rescan", help="Rebuild the backup catalog of --backup-path first",
+                    action="store_true", default=False)
+parser.add_argument("--profile",
+                    help=("Skip the data of the log-like tables of this profile (logs, test)"
+                          " or Json file"),
+                    default=None)
 
 args = parser.parse_args()
 level = getattr(logging, args.log_level.upper(), None)
@@ -39,38 +51,13 @@ logger = logging.getLogger("testbd_creator")
 
 db_file = args.backup_file
 path = args.backup_path
+backup_database = args.backup_database
 json_file = args.config_file
 active_json_file = args.active_config_file
 config = args.config
 tmp = args.temp_dir
 database = args.database
-
-
-def get_date(db_file):
-    """This function takes the creation date of a backup file, from its name
-
-    :param db_file: Backup file
-    :return: Backup date if succesfull. '0001-01-01 00:00:00' otherwise
-    """
-    date_str = os.path.basename(db_file).split(".")[0]
-    str_list = date_str.split("-")
-    str_list = str_list[len(str_list) - 1].split("_")
-    date_str = str_list[len(str_list) - 2]
-    time_str = str_list[len(str_list) - 1]
-    try:
-        year = int(date_str[0:4])
-        month = int(date_str[4:6])
-        day = int(date_str[6:])
-        hour = int(time_str[0:2])
-        minute = int(time_str[2:4])
-        second = int(time_str[4:])
-        file_date = datetime.datetime(year=year, month=month, day=day,
-                                      hour=hour, minute=minute, second=second)
-    except Exception as e:
-        file_date = datetime.datetime(year=datetime.MINYEAR, month=1, day=1,
-                                      hour=0, minute=0, second=0)
-        logger.error("File: %s - %s", os.path.basename(db_file), e)
-    return file_date
+profile = args.profile
 
 
 def restore_database(db_name, db_config, dump_dest, port):
@@ -106,19 +93,25 @@ def restore_database(db_name, db_config, dump_dest, port):
     return db_name
 
 
-def create_test_db(prefix, db_file, db_config, temp_dir):
+def create_test_db(prefix, db_file, db_config, temp_dir, profile=None):
     """This function creates a test database from backup file with determined config
 
     :param prefix: Prefix for database name
-    :param db_file: Backup file for database
+    :param db_file: Backup file or snapshot folder for database
     :param db_config: Dict with database configuration
     :param temp_dir: Temporary directory for dump
+    :param profile: Profile whose tables data is not restored
     :return: Database name if succesfull, 1 otherwise
     """
     str_list = os.path.basename(db_file).split(".")[0].split("-")
     db_name = prefix + "_" + str_list[len(str_list) - 1].split("_", 1)[1]
     logger.debug("Database name: %s", db_name)
-    dump_dest = utils.decompress_files(db_file, temp_dir)
+    if os.path.isdir(db_file):
+        dump_dest = utils.extract_snapshot(db_file, temp_dir)
+    else:
+        dump_dest = utils.decompress_files(db_file, temp_dir)
+    if profile:
+        utils.filter_backup_folder(dump_dest, profile)
     result = restore_database(db_name, db_config, dump_dest, "xmlrpc")
     if result == 1:
         result = restore_database(db_name, db_config, dump_dest, "opt")
@@ -126,7 +119,8 @@ def create_test_db(prefix, db_file, db_config, temp_dir):
     return result
 
 
-def copy_database(prefix, database, db_config, temp_dir, active_config):
+def copy_database(prefix, database, db_config, temp_dir, active_config,
+                  profile=None):
     """This function creates a test database from an active database
     with determined config
 
@@ -134,21 +128,26 @@ def copy_database(prefix, database, db_config, temp_dir, active_config):
     :param database: database to be copied
     :param db_config: Dict with database configuration
     :param temp_dir: Temporary directory for dump
+    :param profile: Profile whose tables data is not restored
     :return: Database name if succesfull, 1 otherwise
     """
     db_name = '%s_%s_%s'% \
               (prefix, database,
                datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
+    # restore_database takes the folder of the dump
+    dbase = mkdtemp(prefix='vxCopy_', dir=temp_dir)
     try:
-        dbase = utils.dump_database(temp_dir, database,
-                                    active_config['superpswd'],
-                                    active_config['host'],
-                                    active_config['port']['xmlrpc'])
+        utils.dump_database_zip(dbase, database,
+                                active_config['superpswd'],
+                                active_config['host'],
+                                active_config['port']['xmlrpc'])
     except:
-        dbase = utils.dump_database(temp_dir, database,
-                                    active_config['superpswd'],
-                                    active_config['host'],
-                                    active_config['port']['opt'])
+        utils.dump_database_zip(dbase, database,
+                                active_config['superpswd'],
+                                active_config['host'],
+                                active_config['port']['opt'])
+    if profile:
+        utils.filter_backup_folder(dbase, profile)
     result = restore_database(db_name, db_config, dbase, "xmlrpc")
     if result == 1:
         result = restore_database(db_name, db_config, dbase, "opt")
@@ -156,30 +155,41 @@ def copy_database(prefix, database, db_config, temp_dir, active_config):
     return result
 
 
-def select_file(path):
-    """This function selects the most recent backup file in 'path' dir
+def select_file(path, database=None):
+    """This function selects the most recent backup of 'database' in 'path' dir
+    using its catalog, the catalog is rebuilt if the dir does not have one or it
+    changed after the last backup was cataloged
 
     :param path: Backup path directory
-    :return: Most recent db_file
+    :param database: Database whose backup is selected, the newest backup of
+                     any database if it is not given
+    :return: Most recent db_file, an archive or a snapshot folder
     """
     logger.debug("Selecting backup file to be restored")
-    db_select = os.listdir(path)[0]
-    for dfile in os.listdir(path):
-        if get_date(dfile) > get_date(db_select):
-            db_select = dfile
+    if args.rescan or catalog.is_stale(path):
+        logger.info("Building backup catalog of %s", path)
+        catalog.rescan(path)
+    if not database:
+        # the catalog can not tell a database from a reason in the names of
+        # the backups copied by hand, so the newest backup of the dir is used
+        logger.info("Without --backup-database, using the newest backup of %s",
+                    path)
+    db_select = catalog.latest_backup(path, database)
+    if not db_select:
+        raise RuntimeError("There are no backups%s in %s" %
+                           (' of %s' % database if database else '', path))
     logger.info("File %s selected", os.path.basename(db_select))
     return db_select
 
-
 if __name__ == '__main__':
     db_config = utils.load_json(json_file)
     if db_file:
         logger.info("Creating %s database from %s backup", config, db_file)
-        db = create_test_db(config, db_file, db_config[config], tmp)
+        db = create_test_db(config, db_file, db_config[config], tmp, profile)
     if path:
-        db_file = select_file(path)
+        db_file = select_file(path, backup_database)
         logger.info("Creating %s database from %s backup", config, db_file)
-        db = create_test_db(config, db_file, db_config[config], tmp)
+        db = create_test_db(config, db_file, db_config[config], tmp, profile)
     if database:
         logger.info("Creating %s database from %s active database", config,
                     database)
@@ -188,6 +198,6 @@ if __name__ == '__main__':
         else:
             db_active_config = db_config
         db = copy_database(config, database, db_config[config], tmp,
-                           db_active_config)
+                           db_active_config, profile)
     if db != 1:
         logger.info("Database %s created", db)
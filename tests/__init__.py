@@ -0,0 +1,4 @@
+import logging
+
+# the failures the tests cause on purpose are logged as errors
+logging.disable(logging.ERROR)
@@ -0,0 +1,397 @@
+"""
+In-process stand-ins of the servers the backups talk to, so the streaming paths can
+be tested without Odoo, S3 or docker: every one runs in a daemon thread and keeps
+what it received in its state attribute.
+"""
+import os
+import re
+import cgi
+import hmac
+import json
+import uuid
+import time
+import base64
+import urllib
+import hashlib
+import zipfile
+import xmlrpclib
+import shutil
+import tarfile
+import urlparse
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Request handler with the helpers shared by the stand-ins, self.server.standin
+        is the stand-in that owns the server. Connections are closed after every
+        response, so no handler thread is left waiting when the stand-in is stopped
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self):
+        return 'standin'
+
+    def reply(self, code, body='', headers=None, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Connection', 'close')
+        self.send_header('Content-Type', content_type)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def read_body(self):
+        """ Read the request body, chunked or with a Content-Length
+        """
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            self.server.standin.state['chunked'] = True
+            body = StringIO()
+            while True:
+                size = int(self.rfile.readline().strip().split(';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                body.write(self.rfile.read(size))
+                self.rfile.readline()
+            return body.getvalue()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def route(self):
+        url = urlparse.urlparse(self.path)
+        return url.path, dict((key, values[0]) for key, values in
+                              urlparse.parse_qs(url.query, keep_blank_values=True).items())
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Standin(object):
+    """ Base of the stand-ins, start returns the url to connect to it
+    """
+    handler = None
+
+    def __init__(self):
+        self.state = {}
+        self.server = None
+
+    def _serve(self, server):
+        server.standin = self
+        self.server = server
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def start(self):
+        self._serve(ThreadingHTTPServer(('127.0.0.1', 0), self.handler))
+        return 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def odoo_zip(files):
+    """ Zip like the ones of the Odoo database manager with the given members
+    """
+    data = StringIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zfile:
+        for name in sorted(files):
+            zfile.writestr(name, files[name])
+    return data.getvalue()
+
+
+class OdooHandler(StandinHandler):
+    """ The xmlrpc db service and the backup and restore controllers of the database
+        manager, the backup is sent in chunks without a Content-Length like Odoo
+        streams its temp file
+    """
+
+    def do_POST(self):
+        standin = self.server.standin
+        path, _ = self.route()
+        if path.startswith('/xmlrpc'):
+            params, method = xmlrpclib.loads(self.read_body())
+            res = standin.xmlrpc(method, params)
+            return self.reply(200, xmlrpclib.dumps((res,), methodresponse=True,
+                                                   allow_none=True), content_type='text/xml')
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST'})
+        fields = dict((key, form.getvalue(key)) for key in form.keys()
+                      if not form[key].filename)
+        if path == '/web/database/backup':
+            standin.state['backups'].append(fields)
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for pos in range(0, len(standin.dump), 65536):
+                chunk = standin.dump[pos:pos + 65536]
+                self.wfile.write('{0:x}\r\n{1}\r\n'.format(len(chunk), chunk))
+            self.wfile.write('0\r\n\r\n')
+            return None
+        if path == '/web/database/restore':
+            file_field = [key for key in form.keys() if form[key].filename][0]
+            standin.restored(fields.get('name') or fields.get('new_db'),
+                             form[file_field].file.read(), fields, file_field)
+            return self.reply(303, '', {'Location': '/web'}, 'text/html')
+        return self.reply(404, '', content_type='text/html')
+
+
+class OdooStandin(Standin):
+    """ Odoo server of the given version whose database manager dumps the dump zip,
+        the databases restored are kept in the restores state
+    """
+    handler = OdooHandler
+
+    def __init__(self, dump, version='8.0'):
+        super(OdooStandin, self).__init__()
+        self.dump = dump
+        self.version = version
+        self.state.update({'backups': [], 'restores': {}, 'chunked': False})
+
+    def restored(self, database_name, data, fields=None, file_field=None):
+        self.state['restores'][database_name] = {
+            'zip': data, 'fields': fields, 'file_field': file_field}
+
+    def xmlrpc(self, method, params):
+        if method == 'server_version':
+            return self.version
+        if method == 'db_exist':
+            return params[0] in self.state['restores']
+        if method == 'list':
+            return sorted(self.state['restores'])
+        if method == 'dump':
+            return base64.b64encode(self.dump)
+        if method == 'restore':
+            self.restored(params[1], base64.b64decode(params[2]))
+            return True
+        raise xmlrpclib.Fault(1, 'Unknown method {0}'.format(method))
+
+    def start(self):
+        url = super(OdooStandin, self).start()
+        self.port = self.server.server_address[1]
+        return url
+
+
+class S3Handler(StandinHandler):
+    """ Path style S3 API: objects, multipart uploads and list-type=2, every request
+        must be signed with signature version 4 and carry the hash of its body
+    """
+
+    def check_signature(self, path, query):
+        standin = self.server.standin
+        match = re.match(r'AWS4-HMAC-SHA256 Credential=([^/]+)/(\d+)/([^/]+)/s3/aws4_request, '
+                         r'SignedHeaders=([^,]+), Signature=(\w+)',
+                         self.headers.get('Authorization', ''))
+        if not match:
+            return False
+        _, date_stamp, region, signed_headers, signature = match.groups()
+        pairs = sorted((urllib.quote(urllib.unquote(name), safe='~'),
+                        urllib.quote(urllib.unquote(value), safe='~'))
+                       for name, _, value in [item.partition('=')
+                                              for item in query.split('&') if item])
+        canonical = '\n'.join([
+            self.command, path, '&'.join('{0}={1}'.format(*pair) for pair in pairs),
+            ''.join('{0}:{1}\n'.format(name, self.headers.get(name).strip())
+                    for name in signed_headers.split(';')),
+            signed_headers, self.headers.get('x-amz-content-sha256')])
+        scope = '{0}/{1}/s3/aws4_request'.format(date_stamp, region)
+        to_sign = '\n'.join(['AWS4-HMAC-SHA256', self.headers.get('x-amz-date'), scope,
+                             hashlib.sha256(canonical).hexdigest()])
+        key = hmac.new('AWS4' + standin.secret_key, date_stamp, hashlib.sha256).digest()
+        for part in [region, 's3', 'aws4_request']:
+            key = hmac.new(key, part, hashlib.sha256).digest()
+        return hmac.new(key, to_sign, hashlib.sha256).hexdigest() == signature
+
+    def handle_request(self):
+        standin = self.server.standin
+        url = urlparse.urlparse(self.path)
+        path, query = self.route()
+        body = self.read_body()
+        if not self.check_signature(url.path, url.query):
+            standin.state['bad_signatures'] += 1
+            return self.reply(403, '<Error><Code>SignatureDoesNotMatch</Code></Error>')
+        if hashlib.sha256(body).hexdigest() != self.headers.get('x-amz-content-sha256'):
+            return self.reply(400, '<Error><Code>BadDigest</Code></Error>')
+        bucket, _, key = urllib.unquote(path).lstrip('/').partition('/')
+        objects, uploads = standin.state['objects'], standin.state['uploads']
+        if self.command == 'POST' and 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            uploads[upload_id] = {}
+            return self.reply(200, '<InitiateMultipartUploadResult><UploadId>{0}</UploadId>'
+                              '</InitiateMultipartUploadResult>'.format(upload_id))
+        if self.command == 'PUT' and 'uploadId' in query:
+            return self.upload_part(uploads[query['uploadId']], int(query['partNumber']), body)
+        if self.command == 'POST' and 'uploadId' in query:
+            parts = uploads.pop(query['uploadId'])
+            numbers = [int(number) for number in
+                       re.findall(r'<PartNumber>(\d+)</PartNumber>', body)]
+            if numbers != sorted(parts):
+                return self.reply(200, '<Error><Code>InvalidPart</Code></Error>')
+            objects[(bucket, key)] = ''.join(parts[number] for number in numbers)
+            return self.reply(200, '<CompleteMultipartUploadResult><Key>{0}</Key>'
+                              '</CompleteMultipartUploadResult>'.format(key))
+        if self.command == 'DELETE' and 'uploadId' in query:
+            uploads.pop(query['uploadId'], None)
+            return self.reply(204)
+        if self.command == 'PUT':
+            objects[(bucket, key)] = body
+            return self.reply(200, '', {'ETag': '"{0}"'.format(hashlib.md5(body).hexdigest())})
+        if self.command == 'GET' and query.get('list-type') == '2':
+            keys = sorted(name for name_bucket, name in objects
+                          if name_bucket == bucket and name.startswith(query.get('prefix', '')))
+            return self.reply(200, '<ListBucketResult>{0}</ListBucketResult>'.format(
+                ''.join('<Contents><Key>{0}</Key></Contents>'.format(name) for name in keys)))
+        if (bucket, key) not in objects:
+            return self.reply(404, '<Error><Code>NoSuchKey</Code></Error>')
+        if self.command == 'DELETE':
+            del objects[(bucket, key)]
+            return self.reply(204)
+        if self.command == 'HEAD':
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.send_header('Content-Length', str(len(objects[(bucket, key)])))
+            self.end_headers()
+            return None
+        return self.reply(200, objects[(bucket, key)], content_type='binary/octet-stream')
+
+    def upload_part(self, parts, number, body):
+        standin = self.server.standin
+        with standin.lock:
+            standin.state['in_flight'] += 1
+            standin.state['max_in_flight'] = max(standin.state['max_in_flight'],
+                                                 standin.state['in_flight'])
+        # slow enough for the parts of a writer to overlap
+        time.sleep(0.02)
+        with standin.lock:
+            standin.state['in_flight'] -= 1
+            standin.state['parts'] += 1
+            failed = standin.state['parts'] == standin.state['fail_part']
+        if failed:
+            return self.reply(400, '<Error><Code>EntityTooSmall</Code></Error>')
+        parts[number] = body
+        return self.reply(200, '', {'ETag': '"{0}"'.format(hashlib.md5(body).hexdigest())})
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = handle_request
+
+
+class S3Standin(Standin):
+    """ S3 compatible server, objects are kept in the objects state by (bucket, key)
+        and the multipart uploads in progress in uploads. The part number fail_part
+        (counted from the start) is rejected
+    """
+    handler = S3Handler
+
+    def __init__(self, secret_key='secret'):
+        super(S3Standin, self).__init__()
+        self.secret_key = secret_key
+        self.lock = threading.Lock()
+        self.state.update({'objects': {}, 'uploads': {}, 'parts': 0, 'in_flight': 0,
+                           'max_in_flight': 0, 'bad_signatures': 0, 'fail_part': None,
+                           'chunked': False})
+
+
+class DockerHandler(StandinHandler):
+    """ The endpoints of the Docker Engine API used by utils: inspect, archive and exec
+    """
+
+    def do_GET(self):
+        standin = self.server.standin
+        path, query = self.route()
+        parts = path.split('/')[2:]
+        if parts[0] == 'containers' and parts[2] == 'json':
+            return self.reply(200, json.dumps({
+                'Id': parts[1], 'Config': {'Env': standin.env},
+                'NetworkSettings': {'Ports': {'8069/tcp': [{'HostPort': '8069'}]}},
+                'Mounts': []}))
+        if parts[0] == 'containers' and parts[2] == 'archive':
+            full_name = standin.path(query['path'])
+            if not os.path.exists(full_name):
+                return self.reply(404, json.dumps(
+                    {'message': 'Could not find the file {0}'.format(query['path'])}))
+            data = StringIO()
+            tar = tarfile.open(fileobj=data, mode='w')
+            tar.add(full_name, os.path.basename(query['path'].rstrip('/')))
+            tar.close()
+            stat = base64.b64encode(json.dumps({'name': os.path.basename(query['path'])}))
+            return self.reply(200, data.getvalue(), {'X-Docker-Container-Path-Stat': stat},
+                              'application/x-tar')
+        if parts[0] == 'exec' and parts[2] == 'json':
+            return self.reply(200, json.dumps(
+                {'ExitCode': standin.state['execs'][int(parts[1])][1]}))
+        self.reply(404, '{}')
+
+    def do_POST(self):
+        standin = self.server.standin
+        path, _ = self.route()
+        parts = path.split('/')[2:]
+        body = self.read_body()
+        if parts[0] == 'containers' and parts[2] == 'exec':
+            standin.state['execs'].append([json.loads(body)['Cmd'], None])
+            return self.reply(201, json.dumps({'Id': str(len(standin.state['execs']) - 1)}))
+        if parts[0] == 'exec' and parts[2] == 'start':
+            execution = standin.state['execs'][int(parts[1])]
+            execution[1] = standin.run(execution[0])
+            return self.reply(200, '', content_type='application/vnd.docker.raw-stream')
+        self.reply(404, '{}')
+
+    def do_PUT(self):
+        standin = self.server.standin
+        _, query = self.route()
+        body = self.read_body()
+        if standin.state['fail_put'] or not os.path.isdir(standin.path(query['path'])):
+            return self.reply(404, json.dumps({'message': 'no such directory'}))
+        standin.state['puts'].append((query['path'], len(body)))
+        tar = tarfile.open(fileobj=StringIO(body), mode='r:')
+        for member in tar:
+            standin.state['members'].append(member)
+            tar.extract(member, standin.path(query['path']))
+        self.reply(200, '')
+
+
+class DockerStandin(Standin):
+    """ Docker daemon with a single container whose filesystem is the root folder,
+        commands run in the container are run in the host with their absolute
+        path arguments moved into root
+    """
+    handler = DockerHandler
+
+    def __init__(self, root, env):
+        super(DockerStandin, self).__init__()
+        self.root = root
+        self.env = env
+        self.state.update({'execs': [], 'puts': [], 'members': [], 'chunked': False,
+                           'fail_put': False})
+
+    def path(self, name):
+        return os.path.join(self.root, name.lstrip('/'))
+
+    def run(self, cmd):
+        args = [self.path(arg) if arg.startswith('/') else arg for arg in cmd]
+        return subprocess.call(args)
+
+    def start(self):
+        sock = os.path.join(self.root, '..', 'docker.sock')
+        if os.path.exists(sock):
+            os.remove(sock)
+        self._serve(ThreadingUnixServer(sock, self.handler))
+        return 'unix://' + os.path.abspath(sock)
+
+    def stop(self):
+        super(DockerStandin, self).stop()
+        shutil.rmtree(self.root, True)
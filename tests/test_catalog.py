@@ -0,0 +1,69 @@
+"""
+Catalog of a backup folder: database filter, snapshot folders and backups copied into
+the folder after the catalog was built
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from lib import catalog
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def backup(self, name, record=True):
+        full_name = os.path.join(self.tmp, name)
+        with open(full_name, 'wb') as fout:
+            fout.write('backup')
+        if record:
+            self.assertTrue(catalog.record_backup(full_name))
+        return full_name
+
+    def snapshot(self, name):
+        full_name = os.path.join(self.tmp, name)
+        os.makedirs(os.path.join(full_name, 'filestore'))
+        for fname in [catalog.SNAPSHOT_NAME, 'filestore/abcdef']:
+            with open(os.path.join(full_name, fname), 'w') as fout:
+                fout.write('{}')
+        self.assertTrue(catalog.record_backup(full_name, 'db'))
+        return full_name
+
+    def test_latest_by_database(self):
+        self.backup('db_20200101_000000.tar.gz')
+        self.backup('other_20200102_000000.tar.gz')
+        self.assertEqual(catalog.latest_backup(self.tmp, 'db'),
+                         os.path.join(self.tmp, 'db_20200101_000000.tar.gz'))
+        self.assertEqual(catalog.latest_backup(self.tmp),
+                         os.path.join(self.tmp, 'other_20200102_000000.tar.gz'))
+
+    def test_snapshot_folder(self):
+        self.backup('db_20200101_000000.tar.gz')
+        snapshot = self.snapshot('db_20200102_000000')
+        os.makedirs(os.path.join(self.tmp, 'db_20200103_000000.partial'))
+        self.assertEqual(catalog.latest_backup(self.tmp, 'db'), snapshot)
+        self.assertEqual(catalog.list_backups(self.tmp)[0]['size'], 4)
+        self.assertEqual(catalog.rescan(self.tmp), 2)
+        self.assertEqual(catalog.latest_backup(self.tmp, 'db'), snapshot)
+
+    def test_stale(self):
+        self.assertTrue(catalog.is_stale(self.tmp))
+        self.backup('db_20200101_000000.tar.gz')
+        self.assertFalse(catalog.is_stale(self.tmp))
+        # copied by hand, mtimes of some filesystems have a resolution of seconds
+        time.sleep(1.1)
+        copied = self.backup('db_20200102_000000.tar.gz', record=False)
+        self.assertTrue(catalog.is_stale(self.tmp))
+        catalog.rescan(self.tmp)
+        self.assertFalse(catalog.is_stale(self.tmp))
+        self.assertEqual(catalog.latest_backup(self.tmp, 'db'), copied)
+
+
+if __name__ == '__main__':
+    unittest.main()
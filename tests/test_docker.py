@@ -0,0 +1,99 @@
+"""
+Filestores streamed into and out of containers with the Docker archive API, against
+the DockerStandin daemon
+"""
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from lib import utils
+from tests.standins import DockerStandin
+
+ENV = ['ODOO_CONFIG_FILE=/etc/odoo/odoo.conf', 'ODOO_USER=odoo', 'DB_HOST=db']
+
+
+def make_filestore(folder, files=60):
+    for pos in range(files):
+        sub_folder = os.path.join(folder, '{0:02x}'.format(pos % 8))
+        if not os.path.isdir(sub_folder):
+            os.makedirs(sub_folder)
+        with open(os.path.join(sub_folder, 'f{0:04d}'.format(pos) + 'x' * (pos % 3 * 60)),
+                  'wb') as fout:
+            fout.write(os.urandom(pos * 997 % 70000))
+    os.makedirs(os.path.join(folder, 'empty'))
+
+
+def read_tree(folder):
+    res = {}
+    for root, dirs, fnames in os.walk(folder):
+        for name in dirs + fnames:
+            full_name = os.path.join(root, name)
+            res[os.path.relpath(full_name, folder)] = \
+                None if os.path.isdir(full_name) else open(full_name, 'rb').read()
+    return res
+
+
+class DockerFilestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        root = os.path.join(self.tmp, 'root')
+        os.makedirs(os.path.join(root, 'etc/odoo'))
+        with open(os.path.join(root, 'etc/odoo/odoo.conf'), 'w') as fout:
+            fout.write('[options]\ndata_dir = /var/lib/odoo\nadmin_passwd = x\n')
+        with open(os.path.join(root, 'etc/passwd'), 'w') as fout:
+            fout.write('root:x:0:0:root:/root:/bin/bash\n'
+                       'odoo:x:101:102::/var/lib/odoo:/bin/false\n')
+        self.filestore = os.path.join(root, 'var/lib/odoo/filestore/db')
+        make_filestore(self.filestore, 5)
+        self.docker = DockerStandin(root, ENV)
+        self.url = self.docker.start()
+        self.config = {'odoo_container': 'odoo1', 'database': 'db'}
+
+    def tearDown(self):
+        self.docker.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_restore_filestore(self):
+        src = os.path.join(self.tmp, 'src')
+        make_filestore(src)
+        self.assertTrue(utils.restore_docker_filestore(src, self.config, self.url))
+        self.assertEqual(read_tree(self.filestore), read_tree(src))
+        self.assertEqual(os.listdir(os.path.dirname(self.filestore)), ['db'])
+        self.assertTrue(self.docker.state['chunked'])
+        self.assertEqual(set((member.uid, member.gid, member.uname)
+                             for member in self.docker.state['members']),
+                         set([(101, 102, 'odoo')]))
+
+    def test_restore_failed_upload(self):
+        src = os.path.join(self.tmp, 'src')
+        make_filestore(src)
+        previous = read_tree(self.filestore)
+        self.docker.state['fail_put'] = True
+        with self.assertRaises(RuntimeError):
+            utils.restore_docker_filestore(src, self.config, self.url)
+        self.assertEqual(read_tree(self.filestore), previous)
+        self.assertEqual(os.listdir(os.path.dirname(self.filestore)), ['db'])
+
+    def test_backup_filestore(self):
+        stream = utils.container_filestore_stream(self.config, self.url)
+        try:
+            name = utils.compress_files('db_backup', [], self.tmp, cformat='gz',
+                                        archives=[(stream, 'filestore')])
+        finally:
+            stream.close()
+        self.assertEqual(utils.verify_archive(name)[1], [])
+        tar = tarfile.open(name)
+        tar.extractall(self.tmp)
+        tar.close()
+        self.assertEqual(read_tree(os.path.join(self.tmp, 'db_backup', 'filestore')),
+                         read_tree(self.filestore))
+
+    def test_backup_without_filestore(self):
+        self.config['database'] = 'other'
+        self.assertIsNone(utils.container_filestore_stream(self.config, self.url))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""
+WS backups and restores through the database manager HTTP endpoints
+(/web/database/backup and /web/database/restore), against the OdooStandin server
+"""
+import os
+import base64
+import shutil
+import zipfile
+import tempfile
+import unittest
+from cStringIO import StringIO
+from lib import utils
+from tests.standins import OdooStandin, odoo_zip
+
+FILES = {
+    'dump.sql': 'SELECT 1;\n' * 100000,
+    'manifest.json': '{"version": "8.0"}',
+    'filestore/ab/abcdef': os.urandom(100000),
+    'filestore/cd/cdef01': 'attachment',
+}
+
+
+def zip_members(data):
+    zfile = zipfile.ZipFile(StringIO(data))
+    return dict((name, zfile.read(name)) for name in zfile.namelist()
+                if not name.endswith('/'))
+
+
+class OdooHttpTest(unittest.TestCase):
+    version = '8.0'
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.odoo = OdooStandin(odoo_zip(FILES), self.version)
+        self.odoo.start()
+
+    def tearDown(self):
+        self.odoo.stop()
+        shutil.rmtree(self.tmp)
+
+    def backup(self, stream):
+        name = utils.backup_database_ws('db', self.tmp, 'admin', 'admin', '127.0.0.1',
+                                        self.odoo.port, tmp_dir=self.tmp, cformat='gz',
+                                        stream=stream)
+        self.assertEqual(utils.verify_archive(name)[1], [])
+        work_dir = os.path.join(self.tmp, 'work')
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        return name, utils.decompress_files(name, work_dir)
+
+    def test_backup_stream(self):
+        _, folder = self.backup(True)
+        self.assertEqual(open(os.path.join(folder, utils.WS_ZIP_NAME), 'rb').read(),
+                         self.odoo.dump)
+        fields = self.odoo.state['backups'][0]
+        if self.version == '8.0':
+            self.assertEqual(fields['backup_db'], 'db')
+        else:
+            self.assertEqual((fields['name'], fields['backup_format']), ('db', 'zip'))
+
+    def test_backup_members(self):
+        _, folder = self.backup(False)
+        self.assertEqual(open(os.path.join(folder, 'database_dump.sql')).read(),
+                         FILES['dump.sql'])
+        self.assertEqual(open(os.path.join(folder, 'filestore/ab/abcdef'), 'rb').read(),
+                         FILES['filestore/ab/abcdef'])
+        self.assertFalse(os.path.exists(os.path.join(folder, utils.WS_ZIP_NAME)))
+
+    def test_dump_database_zip(self):
+        name = utils.dump_database_zip(self.tmp, 'db', 'admin', '127.0.0.1', self.odoo.port)
+        self.assertEqual(open(name, 'rb').read(), self.odoo.dump)
+
+    def test_restore_http(self):
+        _, folder = self.backup(True)
+        utils.restore_database(folder, 'new', 'admin', '127.0.0.1', self.odoo.port)
+        restore = self.odoo.state['restores']['new']
+        self.assertEqual(restore['zip'], self.odoo.dump)
+        self.assertEqual(restore['file_field'],
+                         'db_file' if self.version == '8.0' else 'backup_file')
+
+    def test_restore_members_http(self):
+        _, folder = self.backup(False)
+        utils.restore_database(folder, 'new', 'admin', '127.0.0.1', self.odoo.port)
+        restore = self.odoo.state['restores']['new']
+        self.assertIsNotNone(restore['file_field'])
+        self.assertEqual(zip_members(restore['zip']), FILES)
+        # the zip built for the upload is removed
+        self.assertFalse(os.path.exists(os.path.join(folder, utils.WS_ZIP_NAME)))
+
+    def test_restore_b64_xmlrpc(self):
+        with open(os.path.join(self.tmp, 'database_dump.b64'), 'w') as fout:
+            fout.write(base64.encodestring(self.odoo.dump))
+        utils.restore_database(self.tmp, 'new', 'admin', '127.0.0.1', self.odoo.port)
+        restore = self.odoo.state['restores']['new']
+        self.assertIsNone(restore['file_field'])
+        self.assertEqual(restore['zip'], self.odoo.dump)
+
+    def test_restore_filtered(self):
+        _, folder = self.backup(True)
+        zip_name = utils.filter_backup_folder(folder, 'test')
+        self.assertEqual(sorted(os.listdir(folder)), [utils.WS_ZIP_NAME, utils.MANIFEST_NAME])
+        utils.restore_database(folder, 'new', 'admin', '127.0.0.1', self.odoo.port)
+        self.assertEqual(self.odoo.state['restores']['new']['zip'], open(zip_name).read())
+        self.assertEqual(zip_members(open(zip_name).read()), FILES)
+
+    def test_filter_member_out_of_folder(self):
+        folder = os.path.join(self.tmp, 'backup')
+        os.makedirs(folder)
+        files = dict(FILES, **{'filestore/../../evil': 'x'})
+        with open(os.path.join(folder, utils.WS_ZIP_NAME), 'wb') as fout:
+            fout.write(odoo_zip(files))
+        with self.assertRaises(RuntimeError):
+            utils.filter_backup_folder(folder, 'test')
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'evil')))
+        with self.assertRaises(RuntimeError):
+            utils.member_path(folder, '/etc/passwd')
+        self.assertEqual(utils.member_path(folder, 'filestore/ab/../cd'),
+                         os.path.join(folder, 'filestore', 'cd'))
+
+    def test_restore_stream_zip(self):
+        name, _ = self.backup(True)
+        utils.restore_database_stream(name, 'new', 'admin', '127.0.0.1', self.odoo.port)
+        self.assertEqual(self.odoo.state['restores']['new']['zip'], self.odoo.dump)
+
+    def test_restore_stream_members(self):
+        name, _ = self.backup(False)
+        utils.restore_database_stream(name, 'new', 'admin', '127.0.0.1', self.odoo.port)
+        uploaded = self.odoo.state['restores']['new']['zip']
+        self.assertIsNone(zipfile.ZipFile(StringIO(uploaded)).testzip())
+        self.assertEqual(zip_members(uploaded), FILES)
+
+    def test_restore_stream_b64(self):
+        b64_name = os.path.join(self.tmp, 'database_dump.b64')
+        with open(b64_name, 'w') as fout:
+            fout.write(base64.encodestring(self.odoo.dump))
+        name = utils.compress_files('db_old', [b64_name], self.tmp, cformat='gz')
+        utils.restore_database_stream(name, 'new', 'admin', '127.0.0.1', self.odoo.port)
+        self.assertEqual(self.odoo.state['restores']['new']['zip'], self.odoo.dump)
+
+
+class OdooHttpV10Test(OdooHttpTest):
+    version = '10.0'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+Profiles: data of the excluded tables skipped and the foreign keys to them restored
+NOT VALID, for sql dumps and pg_restore lists
+"""
+import unittest
+from cStringIO import StringIO
+from lib import profiles
+
+DUMP = '''COPY public.mail_message (id, body) FROM stdin;
+1\tHello
+\\.
+
+COPY public.res_partner (id, name) FROM stdin;
+1\tAdmin
+\\.
+
+ALTER TABLE ONLY public.rating_rating
+    ADD CONSTRAINT rating_rating_message_id_fkey FOREIGN KEY (message_id) REFERENCES public.mail_message(id) ON DELETE CASCADE;
+
+ALTER TABLE ONLY public.x_survey
+    ADD CONSTRAINT x_survey_message_id_fkey FOREIGN KEY (message_id) REFERENCES public.mail_message(id) ON DELETE SET NULL;
+
+ALTER TABLE ONLY public.x_survey
+    ADD CONSTRAINT x_survey_partner_id_fkey FOREIGN KEY (partner_id) REFERENCES public.res_partner(id);
+'''
+
+TOC = '''3001; 0 16400 TABLE DATA public mail_message odoo
+3002; 0 16410 TABLE DATA public res_partner odoo
+3003; 2606 16420 FK CONSTRAINT public x_survey x_survey_message_id_fkey odoo
+3004; 2606 16430 FK CONSTRAINT public x_survey x_survey_partner_id_fkey odoo
+'''
+
+
+class ProfilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profile = profiles.get_profile('test')
+
+    def test_filter_sql(self):
+        fout = StringIO()
+        stats = profiles.filter_sql(StringIO(DUMP), fout, self.profile)
+        self.assertEqual(stats, {'skipped': 1, 'changed': 0, 'not_valid': 2})
+        res = fout.getvalue()
+        self.assertNotIn('Hello', res)
+        self.assertIn('REFERENCES public.mail_message(id) ON DELETE CASCADE NOT VALID;\n',
+                      res)
+        self.assertIn('ON DELETE SET NULL NOT VALID;\n', res)
+        self.assertIn('REFERENCES public.res_partner(id);\n', res)
+
+    def test_filter_toc(self):
+        fks = profiles.not_valid_fks(DUMP, self.profile)
+        self.assertEqual(sorted(fks), [('rating_rating', 'rating_rating_message_id_fkey'),
+                                       ('x_survey', 'x_survey_message_id_fkey')])
+        self.assertTrue(fks[('x_survey', 'x_survey_message_id_fkey')].startswith(
+            'ALTER TABLE ONLY public.x_survey\n'))
+        self.assertEqual(profiles.filter_toc(TOC, self.profile, fks).splitlines(),
+                         [TOC.splitlines()[1], TOC.splitlines()[3]])
+
+
+if __name__ == '__main__':
+    unittest.main()
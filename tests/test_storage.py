@@ -0,0 +1,110 @@
+"""
+S3 storage target: multipart uploads, aborts and backups streamed to and from a
+bucket, against the S3Standin server
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+from lib import utils
+from lib import storage
+from tests.standins import S3Standin
+
+PART_SIZE = 64 * 1024
+
+
+class S3StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s3 = S3Standin()
+        self.environ = dict(os.environ)
+        os.environ.update({'S3_ENDPOINT_URL': self.s3.start(), 'AWS_ACCESS_KEY_ID': 'key',
+                           'AWS_SECRET_ACCESS_KEY': self.s3.secret_key})
+        self.storage = storage.S3Storage('bucket', 'daily', part_size=PART_SIZE, jobs=2)
+
+    def tearDown(self):
+        self.s3.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        self.assertEqual(self.s3.state['bad_signatures'], 0)
+
+    def write(self, name, data, chunk_size=10000):
+        writer = self.storage.open_write(name)
+        for pos in range(0, len(data), chunk_size):
+            writer.write(data[pos:pos + chunk_size])
+        return writer
+
+    def test_multipart_upload(self):
+        data = os.urandom(PART_SIZE * 5 + 1234)
+        self.write('backup.tar.gz', data).close()
+        self.assertEqual(self.s3.state['objects'][('bucket', 'daily/backup.tar.gz')], data)
+        self.assertEqual(self.s3.state['parts'], 6)
+        self.assertEqual(self.s3.state['max_in_flight'], 2)
+        self.assertEqual(self.s3.state['uploads'], {})
+        self.assertEqual(self.storage.size('backup.tar.gz'), len(data))
+        self.assertEqual(self.storage.open_read('backup.tar.gz').read(), data)
+
+    def test_small_object(self):
+        self.write('small', 'hello').close()
+        self.assertEqual(self.s3.state['parts'], 0)
+        self.assertEqual(self.storage.list(), ['small'])
+        self.storage.delete('small')
+        self.assertEqual(self.storage.list(), [])
+
+    def test_abort(self):
+        writer = self.write('backup.tar.gz', os.urandom(PART_SIZE * 3))
+        writer.abort()
+        self.assertEqual(self.s3.state['objects'], {})
+        self.assertEqual(self.s3.state['uploads'], {})
+
+    def test_failed_part(self):
+        self.s3.state['fail_part'] = 2
+        writer = self.storage.open_write('backup.tar.gz')
+        # the error is raised by the write that waits for the part, or by close
+        with self.assertRaises(RuntimeError):
+            for _ in range(4):
+                writer.write(os.urandom(PART_SIZE))
+            writer.close()
+        writer.abort()
+        self.assertEqual(self.s3.state['objects'], {})
+        self.assertEqual(self.s3.state['uploads'], {})
+
+    def test_failed_backup(self):
+        self.s3.state['fail_part'] = 1
+        data = StringIO(os.urandom(storage.PART_SIZE + 1024))
+        with self.assertRaises(RuntimeError):
+            utils.compress_files('db', [], 's3://bucket/daily', cformat='gz', jobs=2,
+                                 streams=[(data, 'database_dump.sql')])
+        self.assertEqual(self.s3.state['objects'], {})
+        self.assertEqual(self.s3.state['uploads'], {})
+
+    def test_backup_to_bucket(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            filestore = os.path.join(tmp, 'filestore')
+            os.makedirs(os.path.join(filestore, 'ab'))
+            with open(os.path.join(filestore, 'ab', 'abcdef'), 'wb') as fout:
+                fout.write(os.urandom(PART_SIZE * 3))
+            with open(os.path.join(tmp, 'database_dump.sql'), 'w') as fout:
+                fout.write('SELECT 1;\n' * 50000)
+            for cformat, index in [('gz', False), ('bz2', True)]:
+                url = utils.compress_files(
+                    'db_' + cformat, [os.path.join(tmp, 'database_dump.sql'),
+                                      (filestore, 'filestore')],
+                    's3://bucket/daily', cformat=cformat, jobs=2, index=index)
+                self.assertEqual(url, 's3://bucket/daily/db_{0}.tar.{0}'.format(cformat))
+                self.assertEqual(utils.verify_archive(url)[1], [])
+                work_dir = os.path.join(tmp, cformat)
+                os.makedirs(work_dir)
+                folder = utils.decompress_files(url, work_dir)
+                self.assertEqual(open(os.path.join(folder, 'filestore', 'ab', 'abcdef'),
+                                      'rb').read(),
+                                 open(os.path.join(filestore, 'ab', 'abcdef'), 'rb').read())
+            self.assertIn('db_bz2.tar.bz2.idx', self.storage.list())
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+This script checks backups against the manifest stored inside them
+without extracting them to disk
+"""
+import os
+import logging
+import configargparse
+import sys
+from lib import utils
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('verify')
+
+
+def main(main_args):
+    """ Main function
+    """
+    parser = configargparse.ArgumentParser()
+    parser.add_argument("backups", nargs='+',
+                        help="Backup files or folders with backups to verify")
+    parser.add_argument("-j", "--jobs", help="Number of backups verified in parallel",
+                        type=int, default=None)
+
+    args = parser.parse_args(main_args)
+    names = []
+    for path in args.backups:
+        if os.path.isdir(path):
+            names.extend(os.path.join(path, fname) for fname in sorted(os.listdir(path))
+                         if '.tar.' in fname and not fname.endswith(utils.INDEX_EXTENSION))
+        else:
+            names.append(path)
+    res = utils.verify_archives(names, args.jobs)
+    failed = [name for name, errors in res.items() if errors]
+    logger.info("%s backups verified, %s corrupt", len(res), len(failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    logger.info("Starting verification process")
+    sys.exit(main(sys.argv[1:]))